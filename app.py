@@ -1,12 +1,21 @@
-from flask import Flask, redirect, render_template, request, url_for
-from PIL import Image
+from flask import Flask, Response, jsonify, redirect, render_template, request, send_file, url_for
 import sys
 import os
+import io
+import json
+import shutil
 from werkzeug.utils import secure_filename
 from datetime import datetime
 
-from classes.wfc import setup
-from classes.dotify import dotify
+from classes.wfc_grid import GRID_NAME, render_grid_file
+from classes.wfc_jobs import JobManager
+from classes.wfc_pool import CityPool
+from classes.wfc_registry import get_tileset
+from classes.wfc_steplog import ATLAS_NAME, LOG_NAME
+from classes.tilesets import list_tilesets, load_tileset
+from classes.ingest import UploadError
+from classes.dotify import DIFFUSION_KERNELS, SHAPES, dotify, dotify_svg
+from classes.pixelart import PALETTES, pixelate
 
 
 app = Flask(__name__)
@@ -17,6 +26,37 @@ ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif"}
 GENERATED_FOLDER = "static/images/generated"
 os.makedirs(GENERATED_FOLDER, exist_ok=True)
 
+# Largest dot spacing of the dotted page; a PNG band holds at least one row of
+# dots, so this bounds the memory of a request
+DOT_MAX_MULTIPLIER = 200
+
+GALLERY_FOLDER = "static/images/gallery"
+os.makedirs(GALLERY_FOLDER, exist_ok=True)
+
+# Pre-generated cities for the WFC page
+WFC_POOL_FOLDER = "static/images/WFC/pool"
+WFC_POOL_SIZE = 4
+
+city_pool = None
+
+
+def get_city_pool():
+    # Started on first use so the Flask reloader's parent process doesn't run a producer too
+    global city_pool
+    if city_pool is None:
+        city_pool = CityPool(WFC_POOL_FOLDER, size=WFC_POOL_SIZE, tile_size=16, output_width=160,
+                             output_height=160, use_config=True, step_format='log')
+        city_pool.start()
+    return city_pool
+
+
+# Background WFC jobs for the API
+WFC_JOBS_FOLDER = "static/images/WFC/jobs"
+WFC_MAX_TILES = 256  # Largest width/height in tiles a job may ask for
+WFC_MAX_OVERLAP_TILES = 24  # The same for the overlapping model (4 pattern cells per tile)
+
+wfc_jobs = JobManager(WFC_JOBS_FOLDER, workers=2)
+
 @app.route('/')
 def home():
     return render_template("index.html")
@@ -24,54 +64,193 @@ def home():
 
 @app.route('/wavefunctioncollapse')
 def wavefunctioncollapsepage():
-    # Run WFC on every page load
+    # Serve a pre-generated city from the pool; the pool refills in the background
     print("\n" + "="*60)
-    print("Running WFC from web request...")
+    print("Serving WFC city from web request...")
     print("="*60)
+
+    # A seed in the URL replays that exact city, otherwise take the next ready one
+    seed = request.args.get('seed', type=int)
+    # Cities of another tileset package are generated on the spot
+    tileset = request.args.get('tileset') or None
+    if tileset is not None and tileset not in list_tilesets():
+        return f"Unknown tileset: {tileset}", 404
+
     try:
-        setup(tile_size=16, output_width=160, output_height=160, save_steps=True, use_config=True)
-        print("WFC generation complete!")
+        city = get_city_pool().get(seed, tileset)
     except Exception as e:
         print(f"Error running WFC: {e}")
-    
-    return render_template('WFC.html')
+        return f"Error generating the city: {e}", 500
 
+    # Save a copy of every city that is shown to the gallery
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    shutil.copyfile(city['image'], os.path.join(GALLERY_FOLDER, f"city_{timestamp}.png"))
 
-# @app.route('/pixelArt', methods=['GET'])
-# def pixelArt_page():
-#     return render_template("pixelArt.html")
+    return render_template('WFC.html', seed=city['seed'], tileset=city.get('tileset'),
+                           tilesets=list_tilesets(), tile_size=city.get('tile_size', 16),
+                           log_url=f"/{city['dir']}/steps/{LOG_NAME}", atlas_url=f"/{city['dir']}/steps/{ATLAS_NAME}")
 
-# @app.route('/pixelArt', methods=['POST'])
-# def pixelArt_image():
-#     file = request.files['image']
-#     pixel_size = int(request.form['pixel_size'])
 
+@app.route('/api/wfc/jobs', methods=['POST'])
+def create_wfc_job():
+    # Start a generation job and return right away; the client polls or streams its progress
+    params = request.get_json(silent=True) or request.form
 
+    try:
+        tiles_x = int(params.get('width', 10))
+        tiles_y = int(params.get('height', 10))
+        tile_size = int(params.get('tile_size', 16))
+        seed = params.get('seed')
+        seed = int(seed) if seed not in (None, '') else None
+    except (ValueError, TypeError):
+        return jsonify(error="width, height, tile_size and seed must be integers"), 400
+
+    if not (1 <= tiles_x <= WFC_MAX_TILES and 1 <= tiles_y <= WFC_MAX_TILES):
+        return jsonify(error=f"width and height must be between 1 and {WFC_MAX_TILES} tiles"), 400
+    if not 1 <= tile_size <= 64:
+        return jsonify(error="tile_size must be between 1 and 64"), 400
+
+    weights = params.get('weights')
+    if isinstance(weights, str):
+        try:
+            weights = json.loads(weights)
+        except ValueError:
+            return jsonify(error="weights must be a JSON object of tile name -> weight"), 400
+    if weights is not None and not isinstance(weights, dict):
+        return jsonify(error="weights must be a JSON object of tile name -> weight"), 400
+
+    tileset = params.get('tileset') or None
+    if tileset is not None and tileset not in list_tilesets():
+        return jsonify(error=f"Unknown tileset: {tileset}"), 400
+
+    model = params.get('model') or 'tiled'
+    if model not in ('tiled', 'overlapping'):
+        return jsonify(error="model must be 'tiled' or 'overlapping'"), 400
+    if model == 'overlapping' and max(tiles_x, tiles_y) > WFC_MAX_OVERLAP_TILES:
+        return jsonify(error=f"width and height must be at most {WFC_MAX_OVERLAP_TILES} tiles "
+                             f"with the overlapping model"), 400
+
+    if weights is not None:
+        # Weights are checked here so a bad one is a 400, not a failed job
+        if model == 'tiled':
+            tiles = load_tileset(tileset)[0] if tileset is not None else get_tileset()[0]
+            names = {tile['name'] for tile in tiles} | {tile.get('base', tile['name']) for tile in tiles}
+        for name, weight in weights.items():
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not 0 <= weight < float('inf'):
+                return jsonify(error=f"The weight of '{name}' must be a number of at least 0"), 400
+            if model == 'tiled' and name not in names:
+                return jsonify(error=f"Unknown tile in weights: {name}"), 400
+
+    job = wfc_jobs.submit(tiles_x, tiles_y, tile_size, seed, weights, tileset, model)
+
+    return jsonify(id=job.id,
+                   status_url=url_for('wfc_job_status', job_id=job.id),
+                   events_url=url_for('wfc_job_events', job_id=job.id),
+                   result_url=url_for('wfc_job_result', job_id=job.id)), 202
+
+
+@app.route('/api/wfc/jobs/<job_id>')
+def wfc_job_status(job_id):
+    job = wfc_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/wfc/jobs/<job_id>/events')
+def wfc_job_events(job_id):
+    # Server-Sent Events with the job's progress until it finishes
+    job = wfc_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    return Response(wfc_jobs.stream(job), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/wfc/jobs/<job_id>/result')
+def wfc_job_result(job_id):
+    job = wfc_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    if job.status == 'failed':
+        return jsonify(error=job.error), 500
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 409
+
+    # Other scales are rendered from the saved grid instead of solving again
+    scale = request.args.get('scale', type=int)
+    if scale is None or scale == 2:
+        return send_file(job.image_path, mimetype='image/png')
+    if not 1 <= scale <= 8:
+        return jsonify(error="scale must be between 1 and 8"), 400
+    grid_path = os.path.join(os.path.dirname(job.image_path), GRID_NAME)
+    if not os.path.exists(grid_path):
+        return jsonify(error="This job has no saved grid, only scale 2 is available"), 409
+
+    if job.params['tileset'] is not None:
+        tiles, _, tile_size = load_tileset(job.params['tileset'])
+    else:
+        tiles, tile_size = get_tileset()[0], job.params['tile_size']
+    img = render_grid_file(grid_path, tiles, tile_size, scale)
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    buffer.seek(0)
+    return send_file(buffer, mimetype='image/png')
+
+
+@app.route('/api/wfc/jobs/<job_id>/reroll', methods=['POST'])
+def wfc_job_reroll(job_id):
+    # Solve one rectangle of a finished city again; the grid and image are updated in place
+    job = wfc_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown job"), 404
+    if job.status != 'done':
+        return jsonify(job.to_dict()), 409
+
+    params = request.get_json(silent=True) or request.form
+    try:
+        rect = tuple(int(params[name]) for name in ('x', 'y', 'width', 'height'))
+        seed = params.get('seed')
+        seed = int(seed) if seed not in (None, '') else None
+    except KeyError:
+        return jsonify(error="x, y, width and height are required"), 400
+    except (ValueError, TypeError):
+        return jsonify(error="x, y, width, height and seed must be integers"), 400
+    if rect[2] < 1 or rect[3] < 1:
+        return jsonify(error="width and height must be at least 1"), 400
 
-@app.route('/filter', methods=['GET'])
-def filter_page():
-    return render_template("filter.html")
-
-    img = Image.open(file)
-    width, height = img.size
-    pixelated = Image.new("RGB", (width, height))
+    try:
+        reroll = wfc_jobs.reroll(job, rect, seed=seed)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
 
-    for y in range(0, height, pixel_size):
-        for x in range(0, width, pixel_size):
-            r, g, b = img.getpixel((x, y))
+    return jsonify(seed=reroll['seed'], solved=reroll['solved'], changed=reroll['changed'],
+                   result_url=url_for('wfc_job_result', job_id=job.id)), 200 if reroll['solved'] else 422
 
-            for yy in range(y, min(y + pixel_size, height)):
-                for xx in range(x, min(x + pixel_size, width)):
-                    pixelated.putpixel((xx, yy), (r, g, b))
 
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-    output_filename = f"pixelated_{timestamp}.png"
-    output_path = os.path.join(GALLERY_FOLDER, output_filename)
-    pixelated.save(output_path)
+@app.route('/filter', methods=['GET'])
+def filter_page():
+    return render_template("filter.html")
 
-  
-    return render_template("pixelArt.html", output_image=f"/{GALLERY_FOLDER}/{output_filename}")
 
+def halftone_options(form):
+    # Halftone options of the dotted form, falling back to the plain dot grid
+    try:
+        angle = float(form.get('angle') or 0)
+    except ValueError:
+        angle = 0
+    try:
+        gamma = min(max(float(form.get('gamma') or 1), 0.1), 10)
+    except ValueError:
+        gamma = 1.0
+    return {
+        'mode': 'cmyk' if form.get('mode') == 'cmyk' else 'mono',
+        'angle': angle,
+        'shape': form.get('shape') if form.get('shape') in SHAPES else 'circle',
+        'gamma': gamma,
+        'screen': 'fm' if form.get('screen') == 'fm' else 'am',
+        'diffusion': form.get('diffusion') if form.get('diffusion') in DIFFUSION_KERNELS else 'floyd-steinberg'
+    }
 
 
 @app.route('/dotted', methods=['GET', 'POST'])
@@ -84,24 +263,44 @@ def dotted_page():
         ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'png'
         if ext not in ALLOWED_EXTENSIONS:
             ext = 'png'
+        output_format = 'svg' if request.form.get('format') == 'svg' else 'png'
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
-        out_name = f"dotted_{timestamp}.png"
+        out_name = f"dotted_{timestamp}.{output_format}"
         out_path = os.path.join(GENERATED_FOLDER, out_name)
         bg_color = request.form.get('bg_color', '#ffffff')
         dot_color = request.form.get('dot_color', '#000000')
         try:
-            multiplier = int(request.form.get('multiplier', 50))
+            multiplier = min(max(int(request.form.get('multiplier', 50)), 1), DOT_MAX_MULTIPLIER)
         except Exception:
             multiplier = 50
-        dotify(file, out_path, multiplier=multiplier, bg_color=bg_color, dot_color=dot_color)
+        try:
+            dotify(file, out_path, multiplier=multiplier, bg_color=bg_color, dot_color=dot_color,
+                   output_format=output_format, **halftone_options(request.form))
+        except UploadError as e:
+            return render_template('dotted.html', result_url=None, error_message=str(e)), 400
         result_url = f"/{GENERATED_FOLDER}/{out_name}"
         return render_template('dotted.html', result_url=result_url)
     return render_template('dotted.html')
 
 
-GALLERY_FOLDER = "static/images/gallery"
+@app.route('/dotted/svg', methods=['POST'])
+def dotted_svg():
+    # Stream the dotted image as SVG straight into the response, one row of dots at a time
+    file = request.files.get('image')
+    if not file or file.filename == '':
+        return "No image uploaded", 400
+    try:
+        multiplier = min(max(int(request.form.get('multiplier', 50)), 1), DOT_MAX_MULTIPLIER)
+    except Exception:
+        multiplier = 50
+    try:
+        svg = dotify_svg(file, multiplier=multiplier, bg_color=request.form.get('bg_color', '#ffffff'),
+                         dot_color=request.form.get('dot_color', '#000000'), **halftone_options(request.form))
+    except UploadError as e:
+        return str(e), 400
+    return Response(svg, mimetype='image/svg+xml',
+                    headers={'Content-Disposition': 'attachment; filename=dotted.svg'})
 
-os.makedirs(GALLERY_FOLDER, exist_ok=True)
 
 @app.route('/gallery')
 def gallery():
@@ -133,16 +332,20 @@ def pixelArt_image():
         except (ValueError, TypeError):
             return render_template('pixelArt.html', error_message="Invalid pixel size. Please enter a positive number.")
         
+        palette = request.form.get('palette', 'none')
+        if palette not in ('none', 'kmeans', *PALETTES):
+            return render_template('pixelArt.html', error_message=f"Unknown palette '{palette}'")
         try:
-            # Open and process the image
-            img = Image.open(file.stream)
-            
-            # Apply pixelation
-            small = img.resize(
-                (img.width // pixel_size, img.height // pixel_size),
-                Image.NEAREST
-            )
-            result = small.resize(img.size, Image.NEAREST)
+            colors = int(request.form.get('colors', 16))
+            if not 2 <= colors <= 256:
+                raise ValueError("Colors must be between 2 and 256")
+        except (ValueError, TypeError):
+            return render_template('pixelArt.html', error_message="Invalid number of colors. Please enter 2 to 256.")
+
+        try:
+            # Block-averaged pixel art, optionally snapped to a palette
+            result = pixelate(file.stream, pixel_size, None if palette == 'none' else palette, colors,
+                              dither='dither' in request.form, outline='outline' in request.form)
             
             # Save the result
             output_path = 'static/images/pixelated_output.png'
@@ -151,6 +354,8 @@ def pixelArt_image():
             # Return template with output image
             return render_template('pixelArt.html', output_image=url_for('static', filename='images/pixelated_output.png'))
             
+        except UploadError as e:
+            return render_template('pixelArt.html', error_message=str(e))
         except Exception as e:
             return render_template('pixelArt.html', error_message=f"Error processing image: {str(e)}")
     
@@ -1,38 +1,412 @@
 from PIL import Image, ImageDraw
+from functools import lru_cache
+import math
 import numpy as np
 import os
+import struct
+import zlib
+
+from classes.ingest import open_upload
+
+# Pixels rendered at a time when writing a PNG (about this many bytes of mask)
+BAND_PIXELS = 4_000_000
+
+# Dot shapes a screen can use
+SHAPES = ("circle", "square", "line", "diamond")
+
+# Error diffusion kernels for FM screening: (dy, dx, share of the error)
+DIFFUSION_KERNELS = {
+    "floyd-steinberg": [(0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)],
+    # Atkinson only passes on 6/8 of the error, which keeps highlights and shadows clean
+    "atkinson": [(0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8)],
+}
+
+# Process inks with their usual screen angles, printed in this order
+CMYK_INKS = [
+    ("cyan", (0, 255, 255), 15),
+    ("magenta", (255, 0, 255), 75),
+    ("yellow", (255, 255, 0), 0),
+    ("black", (0, 0, 0), 45),
+]
 
 def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip('#')
     lv = len(hex_color)
     return tuple(int(hex_color[i:i+lv//3], 16) for i in range(0, lv, lv//3))
 
-def dotify(input_file, output_path, max_dots=140, multiplier=50, bg_color="#ffffff", dot_color="#000000"):
-    im = Image.open(input_file).convert("L")
-    width, height = im.size
-    if height == max(height, width):
-        downsized_image = im.resize((int(height * (max_dots / width)), max_dots))
-    else:
-        downsized_image = im.resize((max_dots, int(height * (max_dots / width))))
-    downsized_image_width, downsized_image_height = downsized_image.size
-    blank_img_height = downsized_image_height * multiplier
-    blank_img_width = downsized_image_width * multiplier
+def color_of(color):
+    return hex_to_rgb(color) if isinstance(color, str) else tuple(color)
+
+def dot_radii(levels, multiplier):
+    # Radius of every dot: darker pixels get bigger dots, up to 0.6 * multiplier
+    return ((0.6 * multiplier) * ((255 - np.asarray(levels, dtype=np.float64)) / 255)).astype(np.int32)
+
+def tone_levels(levels, gamma=1.0, tone_curve=None):
+    # Apply a gamma to the lightness and then an optional tone curve, a list of
+    # (input, output) ink coverage points in 0..1, e.g. [(0, 0), (0.5, 0.3), (1, 1)].
+    # Without either the levels are returned untouched, so dots keep their exact size.
+    if gamma != 1.0:
+        levels = 255 * (np.asarray(levels, dtype=np.float64) / 255) ** gamma
+    if tone_curve:
+        points = sorted(tone_curve)
+        ink = (255 - np.asarray(levels, dtype=np.float64)) / 255
+        ink = np.interp(ink, [p[0] for p in points], [p[1] for p in points])
+        levels = 255 - 255 * ink
+    return levels
+
+def cmyk_levels(rgb):
+    # Split an RGB image into cyan, magenta, yellow and black separations with full
+    # gray component replacement. Each is returned as levels (255 = no ink).
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    black = 1 - rgb.max(axis=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inks = [np.where(black < 1, (1 - rgb[..., c] - black) / (1 - black), 0) for c in range(3)]
+    return [255 * (1 - ink) for ink in inks + [black]]
+
+def error_diffuse(tone, kernel):
+    # Error diffusion on a grid of tones in 0..1, returning which cells get a dot.
+    # Cells are processed in wavefronts x + 2y = t: every cell a kernel pushes error
+    # into lies on a later wavefront, so each wavefront is one vectorized step.
+    rows, cols = tone.shape
+    reach = max(dy for dy, _, _ in kernel)
+    left = max(-dx for _, dx, _ in kernel)
+    error = np.zeros((rows + reach, cols + left + max(dx for _, dx, _ in kernel)))
+    on = np.zeros((rows, cols), dtype=bool)
+    for t in range(cols + 2 * (rows - 1)):
+        ys = np.arange(max(0, (t - cols + 2) // 2), min(rows - 1, t // 2) + 1)
+        xs = t - 2 * ys
+        value = tone[ys, xs] + error[ys, xs + left]
+        dots = value >= 0.5
+        on[ys, xs] = dots
+        residual = value - dots
+        for dy, dx, share in kernel:
+            # Neighboring cells of one wavefront can share a target
+            np.add.at(error, (ys + dy, xs + dx + left), residual * share)
+    return on
+
+def dot_margin(multiplier):
+    # How far the biggest dot (radius 0.6 * multiplier) reaches past its cell
     padding = int(multiplier / 2)
-    bg_rgb = hex_to_rgb(bg_color) if isinstance(bg_color, str) else tuple(bg_color)
-    dot_rgb = hex_to_rgb(dot_color) if isinstance(dot_color, str) else tuple(dot_color)
-    blank_image = np.full(((blank_img_height), (blank_img_width), 3), bg_rgb, dtype=np.uint8)
-    pil_image = Image.fromarray(blank_image)
-    draw = ImageDraw.Draw(pil_image)
-    downsized_image = np.array(downsized_image)
-    for y in range(0, downsized_image_height):
-        for x in range(0, downsized_image_width):
-            k = (x * multiplier) + padding
-            m = (y * multiplier) + padding
-            r = int((0.6 * multiplier) * ((255 - downsized_image[y][x]) / 255))
-            leftUpPoint = (k - r, m - r)
-            rightDownPoint = (k + r, m + r)
-            twoPointList = [leftUpPoint, rightDownPoint]
-            draw.ellipse(twoPointList, fill=dot_rgb)
+    max_r = int(0.6 * multiplier)
+    margin = max(0, max_r - padding, padding + max_r + 1 - multiplier)
+    if multiplier + 2 * margin > 2 * multiplier:
+        raise ValueError(f"Dots of radius {max_r} do not fit a multiplier of {multiplier}")
+    return margin
+
+@lru_cache(maxsize=8)
+def dot_stamps(multiplier, margin, shape="circle"):
+    # The pixels ImageDraw fills for every possible radius, each centered in a cell
+    # window of multiplier + 2 * margin pixels: shape (radii + 1, window, window).
+    # The extra last stamp is empty, so a radius of -1 means no dot at all.
+    padding = int(multiplier / 2)
+    window = multiplier + 2 * margin
+    max_r = int(0.6 * multiplier)
+    center = margin + padding
+    stamps = np.zeros((max_r + 2, window, window), dtype=bool)
+    for r in range(max_r + 1):
+        stamp = Image.new("L", (window, window), 0)
+        draw = ImageDraw.Draw(stamp)
+        if shape == "circle":
+            draw.ellipse([(center - r, center - r), (center + r, center + r)], fill=255)
+        elif shape == "square":
+            draw.rectangle([(center - r, center - r), (center + r, center + r)], fill=255)
+        elif shape == "diamond":
+            draw.polygon([(center, center - r), (center + r, center), (center, center + r), (center - r, center)],
+                         fill=255)
+        else:
+            # Lines run through the whole window and join up with the next cell's
+            draw.rectangle([(0, center - r), (window - 1, center + r)], fill=255)
+        stamps[r] = np.array(stamp) > 0
+    return stamps
+
+def dot_canvas(radii, multiplier, shape="circle"):
+    # Mask of the dotted pixels with a margin on every side, composited with one
+    # NumPy operation per parity class. Returns (mask, margin).
+    # Dots can reach past their own cell, so each cell gets a window of
+    # multiplier + 2 * margin pixels. Cells of the same (x % 2, y % 2) class are
+    # 2 * multiplier apart, so their windows never overlap and can be written at once.
+    rows, cols = radii.shape
+    margin = dot_margin(multiplier)
+    window = multiplier + 2 * margin
+    block = 2 * multiplier
+    stamps = dot_stamps(multiplier, margin, shape)
+
+    # Canvas with the margin on every side, rounded up to whole blocks
+    height = ((rows + 1) // 2 + 1) * block
+    width = ((cols + 1) // 2 + 1) * block
+    mask = np.zeros((height, width), dtype=bool)
+
+    for py in range(2):
+        for px in range(2):
+            cells = radii[py::2, px::2]
+            if cells.size == 0:
+                continue
+            top, left = py * multiplier, px * multiplier
+            blocks = mask[top:top + (height - top) // block * block, left:left + (width - left) // block * block]
+            blocks = blocks.reshape(blocks.shape[0] // block, block, blocks.shape[1] // block, block)
+            blocks = blocks.transpose(0, 2, 1, 3)
+            blocks[:cells.shape[0], :cells.shape[1], :window, :window] |= stamps[cells]
+
+    return mask, margin
+
+def dot_band(radii, multiplier, first_row, last_row, shape="circle"):
+    # Mask of the pixel rows of dot rows first_row..last_row (exclusive). Dots reach
+    # less than a cell past their own, so only one dot row above and below is needed.
+    context = max(first_row - 1, 0)
+    rows, cols = radii.shape
+    mask, margin = dot_canvas(radii[context:last_row + 1], multiplier, shape)
+    # Drop the margin; dots are clipped at the image border like ImageDraw does
+    top = margin + (first_row - context) * multiplier
+    return mask[top:top + (last_row - first_row) * multiplier, margin:margin + cols * multiplier]
+
+def dot_mask(radii, multiplier, shape="circle"):
+    # Mask of all dotted pixels
+    return dot_band(radii, multiplier, 0, radii.shape[0], shape)
+
+class Screen:
+    # One halftone screen: a lattice of dots, rotated by angle degrees, for one ink.
+    # The lattice is drawn axis-aligned with the dot stamps and only mapped onto the
+    # image afterwards, so a rotated screen costs about as much as a straight one.
+
+    def __init__(self, levels, multiplier, angle=0, shape="circle", diffusion=None):
+        # levels: (rows, cols) image levels, 255 = no ink
+        # diffusion: None for AM screening (dot size follows the tone), or a kernel
+        # of DIFFUSION_KERNELS for FM screening (full-size dots, spaced by the tone)
+        if shape not in SHAPES:
+            raise ValueError(f"Unknown dot shape: {shape}")
+        rows, cols = levels.shape
+        self.multiplier = multiplier
+        self.shape = shape
+        self.angle = angle % 360
+        self.width, self.height = cols * multiplier, rows * multiplier
+        padding = int(multiplier / 2)
+
+        if self.angle == 0:
+            # The lattice is the image grid itself
+            self.origin = (0, 0)
+            lattice = levels
+        else:
+            a = math.radians(self.angle)
+            self.cos, self.sin = math.cos(a), math.sin(a)
+            xs = np.array([0, self.width, 0, self.width])
+            ys = np.array([0, 0, self.height, self.height])
+            us, vs = xs * self.cos + ys * self.sin, -xs * self.sin + ys * self.cos
+            # One spare cell on every side, so dots reaching into the image are kept
+            self.origin = (us.min() - multiplier, vs.min() - multiplier)
+            lattice_cols = int((us.max() - us.min()) // multiplier) + 3
+            lattice_rows = int((vs.max() - vs.min()) // multiplier) + 3
+
+            # Sample the image under the center of every lattice dot (paper outside it)
+            u = self.origin[0] + np.arange(lattice_cols) * multiplier + padding + 0.5
+            v = self.origin[1] + np.arange(lattice_rows)[:, None] * multiplier + padding + 0.5
+            cx = np.floor((u * self.cos - v * self.sin) / multiplier).astype(np.int64)
+            cy = np.floor((u * self.sin + v * self.cos) / multiplier).astype(np.int64)
+            inside = (cx >= 0) & (cx < cols) & (cy >= 0) & (cy < rows)
+            lattice = np.where(inside, np.asarray(levels)[cy.clip(0, rows - 1), cx.clip(0, cols - 1)], 255)
+
+        if diffusion is None:
+            self.radii = dot_radii(lattice, multiplier)
+        else:
+            tone = (255 - np.asarray(lattice, dtype=np.float64)) / 255
+            self.radii = np.where(error_diffuse(tone, diffusion), np.int32(0.6 * multiplier), -1).astype(np.int32)
+        if shape == "line":
+            # A zero-radius line would be a hairline right through blank paper
+            self.radii[self.radii == 0] = -1
+
+    def band(self, y0, y1):
+        # Mask of the image rows y0..y1 (y0 a multiple of multiplier for straight screens)
+        m = self.multiplier
+        if self.angle == 0:
+            band = dot_band(self.radii, m, y0 // m, min(-(-y1 // m), self.radii.shape[0]), self.shape)
+            return band[:y1 - y0]
+
+        out = np.zeros((y1 - y0, self.width), dtype=bool)
+        tile = max(y1 - y0, 256)
+        u0, v0 = self.origin
+        for x0 in range(0, self.width, tile):
+            x1 = min(x0 + tile, self.width)
+            # Lattice cells under this tile, with one cell of context around it
+            xs = np.array([x0, x1, x0, x1])
+            ys = np.array([y0, y0, y1, y1])
+            us = xs * self.cos + ys * self.sin - u0
+            vs = -xs * self.sin + ys * self.cos - v0
+            c0 = max(int(us.min() // m) - 1, 0)
+            c1 = min(int(us.max() // m) + 2, self.radii.shape[1])
+            r0 = max(int(vs.min() // m) - 1, 0)
+            r1 = min(int(vs.max() // m) + 2, self.radii.shape[0])
+            cells = self.radii[r0:r1, c0:c1]
+            if cells.size == 0 or cells.max() < 0:
+                continue
+            mask, margin = dot_canvas(cells, m, self.shape)
+            ox, oy = c0 * m - margin, r0 * m - margin
+
+            # Map every pixel of the tile back onto the straight lattice
+            data = (self.cos, self.sin, x0 * self.cos + y0 * self.sin - u0 - ox,
+                    -self.sin, self.cos, -x0 * self.sin + y0 * self.cos - v0 - oy)
+            tile_img = Image.fromarray(mask.view(np.uint8)).transform((x1 - x0, y1 - y0), Image.Transform.AFFINE,
+                                                                      data, resample=Image.Resampling.NEAREST)
+            out[:, x0:x1] = np.asarray(tile_img) > 0
+        return out
+
+    def svg(self, fill, style=""):
+        # Yields the dots as one SVG group, a row of the lattice at a time. A dot covers
+        # the same pixels as the raster version: ImageDraw fills k-r..k+r inclusive, a
+        # shape of radius r + 0.5 around the pixel center k + 0.5. Zero-radius dots are
+        # left out.
+        m = self.multiplier
+        padding = int(m / 2)
+        transform = ""
+        if self.angle != 0:
+            transform = f' transform="rotate({self.angle:g}) translate({self.origin[0]:g} {self.origin[1]:g})"'
+        yield f'<g fill="rgb{tuple(fill[:3])}"{transform}{style}>\n'
+        for y, radii in enumerate(self.radii.tolist()):
+            cy = y * m + padding + 0.5
+            row = [self._svg_dot(x * m + padding + 0.5, cy, r + 0.5, x * m) for x, r in enumerate(radii) if r > 0]
+            if row:
+                yield "\n".join(row) + "\n"
+        yield "</g>\n"
+
+    def _svg_dot(self, cx, cy, r, left):
+        if self.shape == "circle":
+            return f'<circle cx="{cx}" cy="{cy}" r="{r}"/>'
+        if self.shape == "square":
+            return f'<rect x="{cx - r}" y="{cy - r}" width="{2 * r}" height="{2 * r}"/>'
+        if self.shape == "diamond":
+            return f'<path d="M{cx} {cy - r}L{cx + r} {cy}L{cx} {cy + r}L{cx - r} {cy}Z"/>'
+        return f'<rect x="{left}" y="{cy - r}" width="{self.multiplier}" height="{2 * r}"/>'
+
+def halftone_palette(bg_rgb, colors, multiply):
+    # Color of every combination of inks (bit i set = ink i printed): the inks either
+    # multiply with each other and the paper, or a single ink simply covers it
+    palette = []
+    for code in range(2 ** len(colors)):
+        color = list(bg_rgb[:3])
+        for i, ink in enumerate(colors):
+            if code >> i & 1:
+                color = [c * k // 255 for c, k in zip(color, ink)] if multiply else list(ink[:3])
+        palette.append(color)
+    return palette
+
+def write_palette_png(f, width, height, palette, bands):
+    # Incremental palette PNG encoder: bands yields (rows, width) arrays of palette
+    # indices, which are packed at the smallest bit depth the palette allows and fed
+    # into one zlib stream, so the whole image never has to be in memory
+    depth = next(d for d in (1, 2, 4, 8) if len(palette) <= 2 ** d)
+    per_byte = 8 // depth
+
+    def chunk(kind, data):
+        f.write(struct.pack(">I", len(data)) + kind + data)
+        f.write(struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    f.write(b"\x89PNG\r\n\x1a\n")
+    # Width, height, bit depth, color type 3 (palette), default compression/filter, no interlace
+    chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, depth, 3, 0, 0, 0))
+    chunk(b"PLTE", bytes(int(c) for color in palette for c in color[:3]))
+
+    compressor = zlib.compressobj(6)
+    for band in bands:
+        # Each scanline is a filter type byte (0 = none) and the packed pixels
+        scanlines = np.zeros((band.shape[0], 1 + (width + per_byte - 1) // per_byte), dtype=np.uint8)
+        if depth == 1:
+            scanlines[:, 1:] = np.packbits(band.astype(bool), axis=1)
+        elif depth == 8:
+            scanlines[:, 1:] = band
+        else:
+            padded = np.zeros((band.shape[0], (scanlines.shape[1] - 1) * per_byte), dtype=np.uint8)
+            padded[:, :width] = band
+            padded = padded.reshape(band.shape[0], -1, per_byte)
+            for k in range(per_byte):
+                scanlines[:, 1:] |= padded[:, :, k] << (8 - depth * (k + 1))
+        data = compressor.compress(scanlines.tobytes())
+        if data:
+            chunk(b"IDAT", data)
+    chunk(b"IDAT", compressor.flush())
+    chunk(b"IEND", b"")
+
+def write_dots_png(f, screens, palette, band_pixels=BAND_PIXELS):
+    # Render the screens in bands of whole dot rows and write them as one palette PNG
+    # whose index is the set of inks printed on each pixel. Memory is bounded by the
+    # band size, whatever the multiplier.
+    multiplier = screens[0].multiplier
+    width, height = screens[0].width, screens[0].height
+    band_height = max(1, band_pixels // max(width * multiplier, 1)) * multiplier
+
+    def bands():
+        for y0 in range(0, height, band_height):
+            y1 = min(y0 + band_height, height)
+            code = np.zeros((y1 - y0, width), dtype=np.uint8)
+            for i, screen in enumerate(screens):
+                code |= screen.band(y0, y1).view(np.uint8) << i
+            yield code
+
+    write_palette_png(f, width, height, palette, bands())
+
+def dot_grid_size(width, height, max_dots):
+    # Size of the dot grid of a width x height image
+    if height == max(height, width):
+        return int(height * (max_dots / width)), max_dots
+    return max_dots, int(height * (max_dots / width))
+
+def dot_levels(input_file, max_dots, mode="L"):
+    # Image downsized to at most max_dots dots across, grayscale or RGB. The upload is
+    # only decoded at about the size of the dot grid (see classes/ingest.py).
+    im, (width, height) = open_upload(input_file, lambda w, h: dot_grid_size(w, h, max_dots), mode)
+    return np.array(im.resize(dot_grid_size(width, height, max_dots)))
+
+def halftone_screens(input_file, max_dots=140, multiplier=50, dot_color="#000000", mode="mono", angle=0,
+                     shape="circle", gamma=1.0, tone_curve=None, screen="am", diffusion="floyd-steinberg"):
+    # Build the screens of an image and the ink color of each.
+    # mode: "mono" for one screen in dot_color, "cmyk" for four separations at the
+    #       usual process angles (turned by angle), composited with multiply
+    # screen: "am" varies the dot size, "fm" varies the dot spacing by error diffusion
+    # diffusion: kernel of the FM screen, "floyd-steinberg" or "atkinson"
+    if mode not in ("mono", "cmyk"):
+        raise ValueError(f"Unknown halftone mode: {mode}")
+    if screen not in ("am", "fm"):
+        raise ValueError(f"Unknown screen: {screen}")
+    if screen == "fm" and diffusion not in DIFFUSION_KERNELS:
+        raise ValueError(f"Unknown error diffusion: {diffusion}")
+    kernel = DIFFUSION_KERNELS[diffusion] if screen == "fm" else None
+
+    if mode == "mono":
+        levels = tone_levels(dot_levels(input_file, max_dots), gamma, tone_curve)
+        return [Screen(levels, multiplier, angle, shape, kernel)], [color_of(dot_color)]
+
+    separations = cmyk_levels(dot_levels(input_file, max_dots, "RGB"))
+    screens = [Screen(tone_levels(levels, gamma, tone_curve), multiplier, ink_angle + angle, shape, kernel)
+               for levels, (_, _, ink_angle) in zip(separations, CMYK_INKS)]
+    return screens, [ink for _, ink, _ in CMYK_INKS]
+
+def dot_svg(screens, colors, bg_rgb, multiply=False):
+    # Yields the SVG document piece by piece, one row of dots at a time, so memory
+    # does not depend on multiplier
+    width, height = screens[0].width, screens[0].height
+    yield (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+           f'viewBox="0 0 {width} {height}">\n')
+    yield f'<rect width="100%" height="100%" fill="rgb{tuple(bg_rgb[:3])}"/>\n'
+    style = ' style="mix-blend-mode:multiply"' if multiply else ""
+    for screen, color in zip(screens, colors):
+        yield from screen.svg(color, style)
+    yield "</svg>\n"
+
+def dotify_svg(input_file, max_dots=140, multiplier=50, bg_color="#ffffff", dot_color="#000000", **options):
+    # Generator of the dotted image as SVG, e.g. for a streamed response
+    # (options are the halftone options of halftone_screens())
+    screens, colors = halftone_screens(input_file, max_dots, multiplier, dot_color, **options)
+    return dot_svg(screens, colors, color_of(bg_color), multiply=len(screens) > 1)
+
+def dotify(input_file, output_path, max_dots=140, multiplier=50, bg_color="#ffffff", dot_color="#000000",
+           output_format="png", **options):
+    # output_format "svg" streams the dots to output_path as vector shapes instead
+    # of rasterizing them. options are the halftone options of halftone_screens():
+    # mode, angle, shape, gamma, tone_curve, screen and diffusion.
+    bg_rgb = color_of(bg_color)
+    screens, colors = halftone_screens(input_file, max_dots, multiplier, dot_color, **options)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    pil_image.save(output_path)
+    if output_format == "svg":
+        with open(output_path, "w") as f:
+            f.writelines(dot_svg(screens, colors, bg_rgb, multiply=len(screens) > 1))
+        return output_path
+    with open(output_path, "wb") as f:
+        write_dots_png(f, screens, halftone_palette(bg_rgb, colors, multiply=len(screens) > 1))
     return output_path
@@ -0,0 +1,305 @@
+"""
+Pixel art from photos
+
+An upload is turned into a grid of big square pixels, every step working on
+whole arrays so a 12 MP photo takes a fraction of a second:
+
+- each block of pixel_size x pixel_size pixels becomes the mean of its
+  pixels (Image.reduce() does the block averaging in C), instead of the
+  colour of one sampled pixel;
+- the blocks can be snapped to a fixed retro palette (PICO-8, NES, Game Boy)
+  or to a palette fitted to the image with k-means. The nearest palette
+  colour of every 5-bit RGB value is precomputed once per palette, so
+  quantizing is a single table lookup per block;
+- ordered (Bayer) dithering spreads the rounding error over neighbouring
+  blocks, and dark outlines can be drawn where the image changes from light
+  to dark;
+- the grid is scaled back up with nearest neighbour, as a palette image when
+  a palette is used so the PNG stays small.
+"""
+
+from functools import lru_cache
+import math
+
+import numpy as np
+from PIL import Image
+
+from classes.ingest import open_upload
+
+
+PALETTES = {
+    'pico-8': [
+        "000000", "1D2B53", "7E2553", "008751", "AB5236", "5F574F", "C2C3C7", "FFF1E8",
+        "FF004D", "FFA300", "FFEC27", "00E436", "29ADFF", "83769C", "FF77A8", "FFCCAA",
+    ],
+    'nes': [
+        "7C7C7C", "0000FC", "0000BC", "4428BC", "940084", "A80020", "A81000", "881400",
+        "503000", "007800", "006800", "005800", "004058", "000000", "BCBCBC", "0078F8",
+        "0058F8", "6844FC", "D800CC", "E40058", "F83800", "E45C10", "AC7C00", "00B800",
+        "00A800", "00A844", "008888", "F8F8F8", "3CBCFC", "6888FC", "9878F8", "F878F8",
+        "F85898", "F87858", "FCA044", "F8B800", "B8F818", "58D854", "58F898", "00E8D8",
+        "787878", "FCFCFC", "A4E4FC", "B8B8F8", "D8B8F8", "F8B8F8", "F8A4C0", "F0D0B0",
+        "FCE0A8", "F8D878", "D8F878", "B8F8B8", "B8F8D8", "00FCFC", "F8D8F8",
+    ],
+    'gameboy': ["0F380F", "306230", "8BAC0F", "9BBC0F"],
+}
+
+# Weights of the RGB channels when comparing colours (green matters most to the eye)
+CHANNEL_WEIGHTS = np.array([2.0, 4.0, 3.0])
+
+LUMA = np.array([0.299, 0.587, 0.114])
+
+# Bits per channel of the palette lookup table (32 x 32 x 32 entries)
+LUT_BITS = 5
+
+# 4x4 Bayer threshold matrix, scaled to -0.5 .. 0.5
+BAYER_4 = (np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5],
+]) + 0.5) / 16 - 0.5
+
+
+def palette_colors(palette):
+    """
+    Args:
+        palette: Name of one of PALETTES, or a list of "RRGGBB" strings or
+                 (r, g, b) tuples
+
+    Returns:
+        Tuple of (r, g, b) tuples
+
+    Raises:
+        ValueError: If the palette name is unknown or the palette is empty
+    """
+    if isinstance(palette, str):
+        if palette not in PALETTES:
+            raise ValueError(f"Unknown palette '{palette}', choose one of {', '.join(PALETTES)}")
+        palette = PALETTES[palette]
+
+    colors = tuple(tuple(bytes.fromhex(c.lstrip('#'))) if isinstance(c, str) else tuple(int(v) for v in c)
+                   for c in palette)
+    if not colors:
+        raise ValueError("The palette has no colours")
+    return colors
+
+
+def block_mean(img, full_size, pixel_size):
+    """
+    Average every pixel_size x pixel_size block of the full resolution image.
+
+    Args:
+        img: RGB image from open_upload(); may already be decoded at a fraction
+             of the full size
+        full_size: (width, height) of the full resolution upload
+        pixel_size: Size of a block in full resolution pixels
+
+    Returns:
+        uint8 array of shape (blocks_y, blocks_x, 3); blocks on the right and
+        bottom edge that stick out of the image average what is inside
+    """
+    grid = (math.ceil(full_size[0] / pixel_size), math.ceil(full_size[1] / pixel_size))
+
+    # Blocks are whole pixels of the decoded image when its scale divides pixel_size;
+    # reduce() averages the partial blocks on the edges over the pixels they hold
+    scale = max(round(full_size[0] / img.width), 1)
+    if (img.size == (math.ceil(full_size[0] / scale), math.ceil(full_size[1] / scale))
+            and pixel_size % scale == 0):
+        factor = pixel_size // scale
+        return np.asarray(img.reduce(factor) if factor > 1 else img)
+
+    # Otherwise box-resize the full blocks and the partial edge blocks separately,
+    # each from its exact source box, so the edge blocks are not stretched
+    block_x = pixel_size * img.width / full_size[0]
+    block_y = pixel_size * img.height / full_size[1]
+    full_x, full_y = full_size[0] // pixel_size, full_size[1] // pixel_size
+    columns = [(0, full_x, 0, full_x * block_x), (full_x, grid[0], full_x * block_x, img.width)]
+    rows = [(0, full_y, 0, full_y * block_y), (full_y, grid[1], full_y * block_y, img.height)]
+
+    blocks = np.empty((grid[1], grid[0], 3), dtype=np.uint8)
+    for c0, c1, x0, x1 in columns:
+        for r0, r1, y0, y1 in rows:
+            if c1 > c0 and r1 > r0:
+                part = img.resize((c1 - c0, r1 - r0), Image.BOX, box=(x0, y0, x1, y1))
+                blocks[r0:r1, c0:c1] = np.asarray(part)
+    return blocks
+
+
+@lru_cache(maxsize=16)
+def palette_lut(colors):
+    """
+    Precompute the nearest palette colour of every 5-bit RGB value.
+
+    Args:
+        colors: Tuple of (r, g, b) tuples (hashable, so tables are cached)
+
+    Returns:
+        uint8 array of shape (32, 32, 32) of palette indices
+    """
+    size = 1 << LUT_BITS
+    step = 256 // size
+    centers = np.arange(size) * step + step // 2
+    r, g, b = np.meshgrid(centers, centers, centers, indexing='ij')
+    values = np.stack([r, g, b], axis=-1).reshape(-1, 1, 3).astype(np.float32)
+
+    palette = np.array(colors, dtype=np.float32)
+    distance = (((values - palette) ** 2) * CHANNEL_WEIGHTS.astype(np.float32)).sum(axis=-1)
+    return distance.argmin(axis=1).astype(np.uint8).reshape(size, size, size)
+
+
+def kmeans_palette(grid, colors=16, iterations=10, sample=20_000, seed=0):
+    """
+    Fit a palette to the colours of an image with k-means.
+
+    Args:
+        grid: uint8 array of shape (..., 3)
+        colors: Number of colours of the palette
+        iterations: Number of k-means iterations
+        sample: Largest number of pixels the palette is fitted on
+        seed: Seed of the pixel sample and of the initial centres
+
+    Returns:
+        Tuple of (r, g, b) tuples (fewer than colors if the image has fewer
+        distinct colours)
+    """
+    rng = np.random.default_rng(seed)
+    pixels = grid.reshape(-1, 3).astype(np.float32)
+    if len(pixels) > sample:
+        pixels = pixels[rng.integers(len(pixels), size=sample)]
+    colors = max(1, min(int(colors), 256, len(np.unique(pixels, axis=0))))
+
+    # k-means++: each new centre is picked far from the ones already chosen
+    centers = pixels[[rng.integers(len(pixels))]]
+    closest = ((pixels - centers[0]) ** 2).sum(axis=1)
+    for _ in range(colors - 1):
+        chosen = rng.choice(len(pixels), p=closest / closest.sum())
+        centers = np.vstack([centers, pixels[chosen]])
+        closest = np.minimum(closest, ((pixels - pixels[chosen]) ** 2).sum(axis=1))
+
+    for _ in range(iterations):
+        label = (((pixels[:, None, :] - centers[None]) ** 2).sum(axis=-1)).argmin(axis=1)
+        counts = np.bincount(label, minlength=colors)
+        sums = np.stack([np.bincount(label, pixels[:, c], minlength=colors) for c in range(3)], axis=1)
+        # Centres that lost all their pixels stay where they are
+        used = counts > 0
+        centers[used] = sums[used] / counts[used, None]
+
+    return tuple(tuple(int(v) for v in c) for c in np.rint(centers).clip(0, 255))
+
+
+def dither_spread(colors):
+    """
+    Args:
+        colors: Tuple of (r, g, b) tuples
+
+    Returns:
+        Strength of the ordered dither for a palette: the mean distance from
+        each colour to the nearest other colour
+    """
+    palette = np.array(colors, dtype=np.float64)
+    if len(palette) < 2:
+        return 0.0
+    distance = np.sqrt(((palette[:, None] - palette[None]) ** 2).sum(axis=-1))
+    np.fill_diagonal(distance, np.inf)
+    return float(distance.min(axis=1).mean())
+
+
+def quantize(grid, colors, dither=False):
+    """
+    Snap every block to the nearest palette colour.
+
+    Args:
+        grid: uint8 array of shape (blocks_y, blocks_x, 3)
+        colors: Tuple of (r, g, b) tuples
+        dither: Add a 4x4 Bayer pattern before the lookup, so areas between
+                two palette colours become a mix of both
+
+    Returns:
+        uint8 array of shape (blocks_y, blocks_x) of palette indices
+    """
+    if dither:
+        height, width = grid.shape[:2]
+        threshold = np.tile(BAYER_4, (height // 4 + 1, width // 4 + 1))[:height, :width]
+        grid = (grid + (threshold * dither_spread(colors))[..., None]).clip(0, 255).astype(np.uint8)
+
+    shift = 8 - LUT_BITS
+    return palette_lut(colors)[grid[..., 0] >> shift, grid[..., 1] >> shift, grid[..., 2] >> shift]
+
+
+def outline_mask(grid, threshold=48):
+    """
+    Find the blocks that border a clearly lighter block, so outlines are one
+    block wide and sit on the dark side of each edge.
+
+    Args:
+        grid: uint8 array of shape (blocks_y, blocks_x, 3)
+        threshold: Difference in luminance (0-255) that counts as an edge
+
+    Returns:
+        Boolean array of shape (blocks_y, blocks_x)
+    """
+    lum = grid.astype(np.float32) @ LUMA.astype(np.float32)
+    mask = np.zeros(lum.shape, dtype=bool)
+    mask[:-1] |= lum[1:] - lum[:-1] > threshold
+    mask[1:] |= lum[:-1] - lum[1:] > threshold
+    mask[:, :-1] |= lum[:, 1:] - lum[:, :-1] > threshold
+    mask[:, 1:] |= lum[:, :-1] - lum[:, 1:] > threshold
+    return mask
+
+
+def pixelate(file, pixel_size=10, palette=None, colors=16, dither=False, outline=False):
+    """
+    Turn an uploaded image into pixel art.
+
+    Args:
+        file: Path or file object of the upload
+        pixel_size: Size of a pixel art pixel in pixels of the upload
+        palette: None to keep the averaged colours, 'kmeans' to fit a palette
+                 of the given number of colours, or a palette for
+                 palette_colors()
+        colors: Number of colours of a k-means palette
+        dither: Use ordered dithering when snapping to the palette
+        outline: Draw dark outlines on the dark side of strong edges (in the
+                 darkest palette colour, or black without a palette)
+
+    Returns:
+        PIL Image of the full size of the upload ('P' mode when a palette is
+        used, 'RGB' otherwise)
+
+    Raises:
+        UploadError: If the upload cannot be decoded
+        ValueError: If pixel_size is below 1 or the palette is unknown
+    """
+    pixel_size = int(pixel_size)
+    if pixel_size < 1:
+        raise ValueError("Pixel size must be at least 1")
+
+    # Decode JPEGs at the smallest scale (1/2, 1/4 or 1/8) that divides the block
+    # size, so every block is made of whole decoded pixels; other formats are
+    # decoded at full size and averaged by block_mean() alone
+    scale = math.gcd(pixel_size, 8)
+    img, full_size = open_upload(
+        file, lambda width, height: (math.ceil(width / scale), math.ceil(height / scale)), 'RGB', reduce=False)
+    grid = block_mean(img, full_size, pixel_size)
+
+    if palette is None:
+        edges = outline_mask(grid) if outline else None
+        if edges is not None:
+            grid = grid.copy()
+            grid[edges] = 0
+        small = Image.fromarray(grid, 'RGB')
+    else:
+        palette = kmeans_palette(grid, colors) if palette == 'kmeans' else palette_colors(palette)
+        index = quantize(grid, palette, dither)
+        if outline:
+            luma = np.array(palette) @ LUMA
+            index[outline_mask(grid)] = int(luma.argmin())
+        small = Image.fromarray(index, 'P')
+        small.putpalette([v for c in palette for v in c])
+
+    print(f"Pixelated {full_size[0]}x{full_size[1]} into {grid.shape[1]}x{grid.shape[0]} blocks of {pixel_size}px")
+
+    width, height = small.size
+    result = small.resize((width * pixel_size, height * pixel_size), Image.NEAREST)
+    return result.crop((0, 0, *full_size)) if result.size != full_size else result
@@ -0,0 +1,275 @@
+"""
+Tileset packages and compiled tileset bundles
+
+A tileset package is a folder under static/images/WFC/WFCTiles with the
+tile images and a tileset.json manifest:
+
+    {
+        "name": "basic_tiles",
+        "description": "...",
+        "tile_size": 16,
+        "tiles": [
+            {"name": "vertical_road", "file": "v_road.png", "symmetry": "I",
+             "connections": {"up": "road", "down": "road", "left": null, "right": null},
+             "weight": 1.0, "description": "..."},
+            ...
+        ]
+    }
+
+A tile with a "symmetry" class (X, I, L, T, \\ or F, see
+classes.wfc.SYMMETRY_VARIANTS) only needs to be drawn once: its rotated and
+mirrored variants are generated when the package is compiled.
+
+compile_tileset() turns a package into one binary bundle (tileset.bundle.npz)
+holding the tile atlas, the adjacency rules as bitmasks and the weights.
+At runtime the solver loads the bundle with a single file read: no JSON,
+no PNG decoding and no adjacency building.
+
+Compile a package from the command line with:
+    python -m classes.tilesets basic_tiles
+"""
+
+import io
+import json
+import os
+import sys
+import threading
+
+from PIL import Image
+import numpy as np
+
+from classes.wfc import (
+    SYMMETRY_VARIANTS,
+    compile_adjacency_rules,
+    expand_symmetry,
+    setup_adjacency_rules_from_connections,
+)
+from classes.wfc_render import TileAtlas, cache_tile_atlas
+
+
+TILESETS_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             "..", "static", "images", "WFC", "WFCTiles"))
+MANIFEST_NAME = "tileset.json"
+BUNDLE_NAME = "tileset.bundle.npz"
+BUNDLE_VERSION = 2
+
+_lock = threading.Lock()
+_bundles = {}  # tileset name -> (bundle mtime, bundle info, tiles, rules, tile_size)
+
+
+def package_dir(name):
+    """
+    Args:
+        name: Name of a tileset package
+
+    Returns:
+        Path of the package folder
+    """
+    return os.path.join(TILESETS_DIR, name)
+
+
+def list_tilesets():
+    """
+    Returns:
+        Sorted list of the names of all tileset packages
+    """
+    if not os.path.isdir(TILESETS_DIR):
+        return []
+    return sorted(name for name in os.listdir(TILESETS_DIR)
+                  if os.path.exists(os.path.join(TILESETS_DIR, name, MANIFEST_NAME)))
+
+
+def load_manifest(name):
+    """
+    Read the manifest of a tileset package.
+
+    Args:
+        name: Name of the tileset package
+
+    Returns:
+        Manifest dictionary
+
+    Raises:
+        ValueError: If the package does not exist or the manifest is invalid
+    """
+    path = os.path.join(package_dir(name), MANIFEST_NAME)
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown tileset: {name}")
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if not manifest.get('tiles'):
+        raise ValueError(f"Tileset {name} has no tiles")
+    for tile in manifest['tiles']:
+        missing = {'name', 'file', 'connections'} - set(tile)
+        if missing:
+            raise ValueError(f"Tile {tile.get('name', '?')} of tileset {name} is missing {sorted(missing)}")
+        if tile.get('symmetry') not in (None, *SYMMETRY_VARIANTS):
+            raise ValueError(f"Tile {tile['name']} of tileset {name} has unknown symmetry {tile['symmetry']!r}")
+    return manifest
+
+
+def _source_stamps(name, manifest):
+    """Modification times of the manifest and every tile file of a package."""
+    folder = package_dir(name)
+    paths = [MANIFEST_NAME] + [tile['file'] for tile in manifest['tiles']]
+    return {path: os.stat(os.path.join(folder, path)).st_mtime_ns for path in paths}
+
+
+def compile_tileset(name):
+    """
+    Compile a tileset package into its binary bundle.
+
+    Args:
+        name: Name of the tileset package
+
+    Returns:
+        Path of the written bundle
+    """
+    manifest = load_manifest(name)
+    folder = package_dir(name)
+    tile_size = manifest.get('tile_size', 16)
+
+    print(f"Compiling tileset {name} ({len(manifest['tiles'])} manifest tiles)...")
+
+    tiles = []
+    for index, entry in enumerate(manifest['tiles']):
+        img = Image.open(os.path.join(folder, entry['file']))
+        img.load()
+        tiles.append({
+            'index': index,
+            'name': entry['name'],
+            'image': img,
+            'file': entry['file'],
+            'connections': entry['connections'],
+            'description': entry.get('description'),
+            'weight': entry.get('weight', 1.0),
+            'symmetry': entry.get('symmetry')
+        })
+
+    # Generated variants are compiled like hand-drawn tiles
+    tiles = expand_symmetry(tiles)
+
+    adjacency = setup_adjacency_rules_from_connections(tiles)
+    rules = compile_adjacency_rules(adjacency, len(tiles))
+    atlas = TileAtlas(tiles, tile_size)
+
+    info = {
+        'version': BUNDLE_VERSION,
+        'name': manifest.get('name', name),
+        'tile_size': tile_size,
+        'n_tiles': len(tiles),
+        'tiles': [{key: tile.get(key) for key in ('name', 'file', 'connections', 'description', 'base')}
+                  for tile in tiles],
+        'sources': _source_stamps(name, manifest)
+    }
+
+    bundle_path = os.path.join(folder, BUNDLE_NAME)
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f,
+                 info=np.frombuffer(json.dumps(info).encode(), dtype=np.uint8),
+                 atlas=atlas.atlas,
+                 # One bit per (direction, tile, neighbor)
+                 rules=np.packbits(rules, axis=-1),
+                 weights=np.array([tile['weight'] for tile in tiles], dtype=np.float64))
+    os.replace(tmp_path, bundle_path)
+
+    print(f"Saved tileset bundle with {len(tiles)} tiles to {bundle_path}")
+    return bundle_path
+
+
+def _bundle_is_stale(name, info):
+    """Check whether a package changed since its bundle was compiled."""
+    if info.get('version') != BUNDLE_VERSION:
+        return True
+    try:
+        return _source_stamps(name, load_manifest(name)) != info['sources']
+    except (OSError, ValueError):
+        return True
+
+
+def _read_bundle(path):
+    """
+    Read a bundle with one file read.
+
+    Returns:
+        Tuple of (info dictionary, atlas, rules, weights)
+    """
+    with open(path, "rb") as f:
+        data = np.load(io.BytesIO(f.read()))
+
+    info = json.loads(data['info'].tobytes().decode())
+    n_tiles = info['n_tiles']
+    rules = np.unpackbits(data['rules'], axis=-1, count=n_tiles).astype(bool)
+    return info, data['atlas'], rules, data['weights']
+
+
+def load_tileset(name):
+    """
+    Load a tileset package from its compiled bundle. The bundle is compiled
+    first if it does not exist yet or the package changed since, and the
+    result is kept until the bundle or a source file of the package changes.
+
+    Args:
+        name: Name of the tileset package
+
+    Returns:
+        Tuple of (tiles, rules, tile_size) where tiles is a list of tile
+        dictionaries (shared, do not modify) and rules are the compiled
+        adjacency masks
+
+    Raises:
+        ValueError: If there is no such tileset
+    """
+    bundle_path = os.path.join(package_dir(name), BUNDLE_NAME)
+
+    with _lock:
+        try:
+            mtime = os.stat(bundle_path).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        # The source stamps are checked too, so edits to the manifest or a
+        # tile image are picked up without a restart
+        cached = _bundles.get(name)
+        if cached is not None and cached[0] == mtime and not _bundle_is_stale(name, cached[1]):
+            return cached[2:]
+
+        if mtime is None:
+            compile_tileset(name)
+        info, atlas, rules, weights = _read_bundle(bundle_path)
+
+        if _bundle_is_stale(name, info):
+            compile_tileset(name)
+            info, atlas, rules, weights = _read_bundle(bundle_path)
+        mtime = os.stat(bundle_path).st_mtime_ns
+
+        folder = package_dir(name)
+        tiles = []
+        for index, entry in enumerate(info['tiles']):
+            tiles.append({
+                'index': index,
+                'name': entry['name'],
+                'image': Image.fromarray(np.ascontiguousarray(atlas[index, :, :, :3])),
+                'path': os.path.join(folder, entry['file']),
+                'connections': entry['connections'],
+                'description': entry.get('description') or '',
+                'weight': float(weights[index])
+            })
+            if entry.get('base') is not None:
+                tiles[-1]['base'] = entry['base']
+
+        # Rendering uses the atlas from the bundle instead of building one
+        cache_tile_atlas(tiles, TileAtlas.from_array(atlas))
+
+        print(f"Loaded tileset {name}: {len(tiles)} tiles")
+        _bundles[name] = (mtime, info, tiles, rules, info['tile_size'])
+        return tiles, rules, info['tile_size']
+
+
+if __name__ == "__main__":
+    # Compile the given tileset packages (all of them if none are given)
+    for tileset_name in sys.argv[1:] or list_tilesets():
+        compile_tileset(tileset_name)
@@ -6,55 +6,480 @@ based on this video: https://youtu.be/rI_y2GAlQFM?si=7CYuEJkDGim_zUD5
 """
 
 from PIL import Image
+import numpy as np
 import os
 
 
-class Cell:
+DIRECTIONS = ['up', 'down', 'left', 'right']
+
+# Grid offset (dx, dy) of the neighbor in each direction
+DIRECTION_OFFSETS = {
+    'up': (0, -1),
+    'down': (0, 1),
+    'left': (-1, 0),
+    'right': (1, 0)
+}
+
+# Index of the direction pointing back, e.g. 'up' <-> 'down'
+OPPOSITE = [1, 0, 3, 2]
+
+# The same tables as arrays, for looking up all four neighbors at once
+ALL_DIRECTIONS = np.arange(len(DIRECTIONS))
+OPPOSITE_INDEX = np.array(OPPOSITE)
+NEIGHBOR_DX = np.array([DIRECTION_OFFSETS[direction][0] for direction in DIRECTIONS])
+NEIGHBOR_DY = np.array([DIRECTION_OFFSETS[direction][1] for direction in DIRECTIONS])
+
+
+class Contradiction(Exception):
     """
-    Represents a single cell in the WFC grid.
-    Each cell can be in a collapsed or uncollapsed state.
+    Raised when propagation leaves a cell with no valid options.
     """
-    
-    def __init__(self, options):
+
+    def __init__(self, x, y):
+        super().__init__(f"Contradiction at cell ({x},{y}): no valid options left")
+        self.x = x
+        self.y = y
+
+
+class Wave:
+    """
+    Compact representation of the whole WFC grid.
+
+    Instead of one Cell object (with its own Python list of options) per grid
+    position, the wave stores every cell's options in a single boolean NumPy
+    array: possible[y, x, t] is True while tile t can still be placed at (x, y).
+
+    For propagation the wave also keeps AC-4 style support counters:
+    support[y, x, d, t] is the number of options left in the neighbor in
+    direction d that are compatible with tile t at (x, y). When a counter
+    drops to zero, t can no longer be placed at (x, y) and is banned too.
+    """
+
+    def __init__(self, tiles_x, tiles_y, rules, batch_propagation=False):
         """
-        Initialize a cell with possible tile options.
-        
+        Initialize a wave where every cell can still be any tile.
+
         Args:
-            options: List of tile indices that could be placed in this cell
+            tiles_x: Width of grid
+            tiles_y: Height of grid
+            rules: Compiled adjacency masks from compile_adjacency_rules()
+            batch_propagation: Let propagate_constraints() ban every pending
+                               cell of a propagation wavefront at once (see
+                               ban_cells()). Much faster with hundreds of
+                               tiles, but the cells change in a different
+                               order, so seeded runs give different results
+                               than with the default cell-by-cell propagation.
         """
-        self.options = options.copy()  # List of possible tile indices
-        self.collapsed = False  # Whether this cell has been determined
-        self.tile_index = None  # The chosen tile index (when collapsed)
-    
-    def collapse(self, tile_index):
+        self.tiles_x = tiles_x
+        self.tiles_y = tiles_y
+        self.rules = rules
+        self.n_tiles = rules.shape[1]
+        self.batch_propagation = batch_propagation
+        self._support_edges = None  # Built by ban_cells() when first needed
+
+        # Smallest integer type that can count every tile
+        count_dtype = np.uint8 if self.n_tiles < 256 else np.uint16
+
+        self.possible = np.ones((tiles_y, tiles_x, self.n_tiles), dtype=bool)  # Options per cell
+        self.counts = np.full((tiles_y, tiles_x), self.n_tiles, dtype=np.int32)  # Number of options per cell
+        self.tile_index = np.full((tiles_y, tiles_x), -1, dtype=np.int32)  # Chosen tile (-1 = uncollapsed)
+
+        # support_rules[d] @ removed gives, for every tile of the neighbor in
+        # direction d, how many of its supports were just removed
+        self.support_rules = rules[OPPOSITE].astype(count_dtype)
+        initial_support = rules.sum(axis=2).astype(count_dtype)  # Shape (4, n_tiles)
+        # The same products computed by summing rows: row t of
+        # support_rows[d] is what removing tile t takes from each neighbor tile
+        self.support_rows = np.ascontiguousarray(self.support_rules.transpose(0, 2, 1))
+        self.support_totals = self.support_rows.sum(axis=1, dtype=count_dtype)
+        self.support = np.empty((tiles_y, tiles_x, len(DIRECTIONS), self.n_tiles), dtype=count_dtype)
+        self.support[:] = initial_support
+
+        # Running totals so progress can be reported without scanning the grid
+        self.collapsed_count = 0
+        self.total_options = tiles_x * tiles_y * self.n_tiles  # Sum of counts over uncollapsed cells
+
+        # Cells whose options shrank since the last time this list was drained
+        self.changed = []
+
+        # Bans waiting to be applied by propagate_constraints(): (x, y, mask)
+        self.pending = []
+
+        # Undo log of (x, y, removed) entries, only kept while backtracking.
+        # removed=None marks the point where the cell at (x, y) was collapsed.
+        self.trail = None
+
+        # Tiles with no compatible neighbor at all in some direction can only
+        # appear on the matching edge of the grid
+        if (initial_support == 0).any():
+            for y in range(tiles_y):
+                for x in range(tiles_x):
+                    for d, direction in enumerate(DIRECTIONS):
+                        dx, dy = DIRECTION_OFFSETS[direction]
+                        if 0 <= x + dx < tiles_x and 0 <= y + dy < tiles_y:
+                            self.ban(x, y, initial_support[d] == 0)
+
+    def _neighbors(self, x, y):
+        # In-bounds neighbors of (x, y) as arrays (direction indices, nx, ny)
+        nxs = x + NEIGHBOR_DX
+        nys = y + NEIGHBOR_DY
+        if 0 < x < self.tiles_x - 1 and 0 < y < self.tiles_y - 1:
+            return ALL_DIRECTIONS, nxs, nys
+        inside = (nxs >= 0) & (nxs < self.tiles_x) & (nys >= 0) & (nys < self.tiles_y)
+        return ALL_DIRECTIONS[inside], nxs[inside], nys[inside]
+
+    def _lost_support(self, removed):
+        # support_rules @ removed for all four directions, as a sum over only
+        # the removed tiles' rows (or the kept ones when fewer), so the cost
+        # follows the number of tiles removed instead of n_tiles squared
+        removed_tiles = np.flatnonzero(removed)
+        if 2 * len(removed_tiles) <= self.n_tiles:
+            return self.support_rows[:, removed_tiles].sum(axis=1, dtype=self.support.dtype)
+        kept_tiles = np.flatnonzero(~removed)
+        return self.support_totals - self.support_rows[:, kept_tiles].sum(axis=1, dtype=self.support.dtype)
+
+    def ban(self, x, y, removed):
         """
-        Collapse this cell to a specific tile.
-        
+        Remove tiles from the options of the cell at (x, y).
+
+        The neighbors' support counters are lowered right away. Neighbor tiles
+        that lose their last support are queued, and propagate_constraints()
+        bans them in turn.
+
         Args:
+            x, y: Coordinates of the cell
+            removed: Boolean array of length n_tiles with the tiles to remove
+
+        Returns:
+            True if the cell lost at least one option, False otherwise
+
+        Raises:
+            Contradiction: If the cell is left with no options
+        """
+        cell = self.possible[y, x]
+        removed = removed & cell
+        n_removed = int(np.count_nonzero(removed))
+        if n_removed == 0:
+            return False
+
+        cell &= ~removed
+        self.counts[y, x] -= n_removed
+        if self.tile_index[y, x] < 0:
+            self.total_options -= n_removed
+
+        # Lower the support counters of all neighbors at once. Each neighbor
+        # sees this cell in the opposite direction.
+        dirs, nxs, nys = self._neighbors(x, y)
+        lost = self._lost_support(removed)[dirs]
+        support = self.support[nys, nxs, OPPOSITE_INDEX[dirs]] - lost
+        self.support[nys, nxs, OPPOSITE_INDEX[dirs]] = support
+
+        unsupported = self.possible[nys, nxs] & (support == 0)
+        for i in np.flatnonzero(unsupported.any(axis=1)):
+            self.pending.append((int(nxs[i]), int(nys[i]), unsupported[i]))
+
+        if self.trail is not None:
+            self.trail.append((x, y, removed))
+        self.changed.append((x, y))
+
+        if self.counts[y, x] == 0:
+            raise Contradiction(x, y)
+        return True
+
+    def ban_cells(self, xs, ys, removed):
+        """
+        Remove tiles from the options of many different cells at once.
+
+        Does the same as calling ban() for every cell, but the support
+        counters are only touched where a removed tile actually supported
+        something: every removed (cell, tile) pair is expanded to the
+        neighbor tiles it supported, so the cost follows the number of
+        removed options instead of cells * n_tiles. Newly unsupported
+        neighbor tiles are queued as one (xs, ys, masks) entry per direction.
+
+        Args:
+            xs, ys: Arrays with the coordinates of the cells (no duplicates)
+            removed: Boolean array of shape (cells, n_tiles) with the tiles
+                     to remove from each cell
+
+        Returns:
+            Number of cells that lost at least one option
+
+        Raises:
+            Contradiction: If a cell is left with no options (after every
+                           cell's removals were applied)
+        """
+        cells = self.possible[ys, xs]
+        removed = removed & cells
+        n_removed = np.count_nonzero(removed, axis=1)
+        hit = n_removed > 0
+        if not hit.all():
+            xs, ys, cells, removed, n_removed = xs[hit], ys[hit], cells[hit], removed[hit], n_removed[hit]
+        if len(xs) == 0:
+            return 0
+
+        self.possible[ys, xs] = cells & ~removed
+        self.counts[ys, xs] -= n_removed.astype(self.counts.dtype)
+        self.total_options -= int(n_removed[self.tile_index[ys, xs] < 0].sum())
+
+        if self._support_edges is None:
+            # Per direction, the neighbor tiles each tile supports, as
+            # (offsets, neighbor tiles) in compressed sparse row form
+            self._support_edges = []
+            for rows in self.support_rows:
+                removed_tile, neighbor_tile = np.nonzero(rows)
+                offsets = np.zeros(self.n_tiles + 1, dtype=np.intp)
+                np.cumsum(np.bincount(removed_tile, minlength=self.n_tiles), out=offsets[1:])
+                self._support_edges.append((offsets, neighbor_tile))
+
+        cell_ids, tile_ids = np.nonzero(removed)
+        for d in ALL_DIRECTIONS:
+            nxs = xs + NEIGHBOR_DX[d]
+            nys = ys + NEIGHBOR_DY[d]
+            inside = (nxs >= 0) & (nxs < self.tiles_x) & (nys >= 0) & (nys < self.tiles_y)
+            keep = inside[cell_ids]
+            cell_d, tile_d = cell_ids[keep], tile_ids[keep]
+
+            # Expand every removed (cell, tile) to the neighbor tiles it supported
+            offsets, neighbor_tile = self._support_edges[d]
+            degree = offsets[tile_d + 1] - offsets[tile_d]
+            total = int(degree.sum())
+            if total == 0:
+                continue
+            first = np.cumsum(degree) - degree
+            edges = np.repeat(offsets[tile_d] - first, degree) + np.arange(total)
+            keys = np.repeat(cell_d, degree) * self.n_tiles + neighbor_tile[edges]
+            keys, lost = np.unique(keys, return_counts=True)
+            cell_k, tile_k = np.divmod(keys, self.n_tiles)
+
+            # Distinct cells have distinct neighbors in the same direction
+            nx, ny = nxs[cell_k], nys[cell_k]
+            support = self.support[ny, nx, OPPOSITE[d], tile_k] - lost.astype(self.support.dtype)
+            self.support[ny, nx, OPPOSITE[d], tile_k] = support
+
+            unsupported = (support == 0) & self.possible[ny, nx, tile_k]
+            if unsupported.any():
+                queued, rows = np.unique(cell_k[unsupported], return_inverse=True)
+                masks = np.zeros((len(queued), self.n_tiles), dtype=bool)
+                masks[rows.reshape(-1), tile_k[unsupported]] = True
+                self.pending.append((nxs[queued], nys[queued], masks))
+
+        coords = list(zip(xs.tolist(), ys.tolist()))
+        if self.trail is not None:
+            self.trail.extend((x, y, cell_removed) for (x, y), cell_removed in zip(coords, removed))
+        self.changed.extend(coords)
+
+        empty = np.flatnonzero(self.counts[ys, xs] == 0)
+        if len(empty):
+            raise Contradiction(int(xs[empty[0]]), int(ys[empty[0]]))
+        return len(xs)
+
+    def collapse(self, x, y, tile_index):
+        """
+        Collapse the cell at (x, y) to a specific tile.
+
+        Args:
+            x, y: Coordinates of the cell
             tile_index: Index of the tile to place in this cell
         """
-        self.collapsed = True
-        self.tile_index = tile_index
-        self.options = [tile_index]  # Only one option remains
-    
-    def is_collapsed(self):
-        """Check if this cell is collapsed."""
-        return self.collapsed
-    
-    def get_entropy(self):
+        removed = self.possible[y, x].copy()
+        removed[tile_index] = False  # Only one option remains
+        self.ban(x, y, removed)
+
+        self.tile_index[y, x] = tile_index
+        self.collapsed_count += 1
+        self.total_options -= 1
+        if self.trail is not None:
+            self.trail.append((x, y, None))
+
+    def undo(self, trail_length):
+        """
+        Roll the wave back to the moment the trail had trail_length entries.
+
+        Args:
+            trail_length: Length of self.trail to return to
+        """
+        self.pending.clear()
+
+        while len(self.trail) > trail_length:
+            x, y, removed = self.trail.pop()
+            self.changed.append((x, y))
+
+            if removed is None:
+                # Undo a collapse; the cell has exactly one option left here
+                self.tile_index[y, x] = -1
+                self.collapsed_count -= 1
+                self.total_options += 1
+                continue
+
+            n_removed = int(np.count_nonzero(removed))
+            self.possible[y, x] |= removed
+            self.counts[y, x] += n_removed
+            if self.tile_index[y, x] < 0:
+                self.total_options += n_removed
+
+            dirs, nxs, nys = self._neighbors(x, y)
+            self.support[nys, nxs, OPPOSITE_INDEX[dirs]] += self._lost_support(removed)[dirs]
+
+    def save_state(self):
+        """
+        Copy the arrays and counters that make up the current state.
+
+        Returns:
+            Tuple that can be passed to restore_state()
+        """
+        return (self.possible.copy(), self.counts.copy(), self.tile_index.copy(),
+                self.support.copy(), self.collapsed_count, self.total_options)
+
+    def restore_state(self, state):
+        """
+        Return to a state previously captured with save_state().
+
+        Args:
+            state: Tuple returned by save_state()
+        """
+        possible, counts, tile_index, support, self.collapsed_count, self.total_options = state
+        self.possible[:] = possible
+        self.counts[:] = counts
+        self.tile_index[:] = tile_index
+        self.support[:] = support
+        self.pending.clear()
+        self.changed.clear()
+        if self.trail is not None:
+            self.trail.clear()
+
+    def constrain(self, x, y, mask):
+        """
+        Remove every option of the cell at (x, y) that is not set in mask.
+
+        Args:
+            x, y: Coordinates of the cell
+            mask: Boolean array of length n_tiles with the tiles still allowed
+
+        Returns:
+            True if the cell lost at least one option, False otherwise
+
+        Raises:
+            Contradiction: If the cell is left with no options
+        """
+        return self.ban(x, y, ~mask)
+
+    def is_collapsed(self, x, y):
+        """Check if the cell at (x, y) is collapsed."""
+        return self.tile_index[y, x] >= 0
+
+    def options(self, x, y):
+        """Get the list of tile indices that are still possible at (x, y)."""
+        return np.flatnonzero(self.possible[y, x]).tolist()
+
+    def get_entropy(self, x, y):
         """
-        Get the entropy (number of possible options) for this cell.
+        Get the entropy (number of possible options) for the cell at (x, y).
         Lower entropy = fewer options = should be collapsed sooner.
         """
-        if self.collapsed:
+        if self.is_collapsed(x, y):
             return 0
-        return len(self.options)
-    
+        return int(self.counts[y, x])
+
     def __repr__(self):
-        if self.collapsed:
-            return f"Cell(collapsed, tile={self.tile_index})"
+        return f"Wave({self.tiles_x}x{self.tiles_y}, {self.n_tiles} tiles, {self.collapsed_count} collapsed)"
+
+
+class EntropyHeap:
+    """
+    Priority queue of uncollapsed cells ordered by entropy.
+
+    Entries are never updated in place. When a cell loses options a new entry
+    is pushed, and old entries are skipped when popped because the cell's
+    option count no longer matches (lazy invalidation). This replaces the
+    full-grid scan for the lowest entropy cell on every iteration.
+    """
+
+    def __init__(self, wave, weights=None, heuristic='count', rng=None):
+        """
+        Build the queue with one entry per uncollapsed cell.
+
+        Args:
+            wave: Wave holding the state of the grid
+            weights: NumPy array of tile weights (needed for 'shannon')
+            heuristic: 'count' (number of options) or 'shannon'
+                       (Shannon entropy weighted by the tile weights)
+            rng: random.Random used for the tie-breaking noise
+                 (defaults to the global random module)
+        """
+        import heapq
+        import random
+
+        if heuristic not in ('count', 'shannon'):
+            raise ValueError(f"Unknown entropy heuristic: {heuristic}")
+
+        self.wave = wave
+        self.heuristic = heuristic
+        self.rng = random if rng is None else rng
+        if heuristic == 'shannon':
+            if weights is None:
+                weights = np.ones(wave.n_tiles)
+            self.weights = weights
+            self.weight_log_weights = weights * np.log(weights)
+
+        self.heap = []
+        for y in range(wave.tiles_y):
+            for x in range(wave.tiles_x):
+                if not wave.is_collapsed(x, y):
+                    self.heap.append(self._entry(x, y, self.rng.random()))
+        heapq.heapify(self.heap)
+
+    def entropy(self, x, y):
+        """
+        Get the entropy of the cell at (x, y) under the chosen heuristic.
+        """
+        if self.heuristic == 'count':
+            return int(self.wave.counts[y, x])
+
+        options = self.wave.possible[y, x]
+        sum_weights = float(options @ self.weights)
+        if sum_weights <= 0:
+            return 0.0
+        sum_weight_logs = float(options @ self.weight_log_weights)
+        return np.log(sum_weights) - sum_weight_logs / sum_weights
+
+    def _entry(self, x, y, noise):
+        # The noise term breaks ties between cells with the same entropy
+        if self.heuristic == 'count':
+            key = (self.entropy(x, y), noise)
         else:
-            return f"Cell({len(self.options)} options)"
+            key = (self.entropy(x, y) + noise * 1e-6, 0)
+        return (key, int(self.wave.counts[y, x]), x, y)
+
+    def update(self, cells):
+        """
+        Push fresh entries for cells whose options changed.
+
+        Args:
+            cells: Iterable of (x, y) coordinates
+        """
+        import heapq
+
+        for x, y in cells:
+            if not self.wave.is_collapsed(x, y):
+                heapq.heappush(self.heap, self._entry(x, y, self.rng.random()))
+
+    def pop(self):
+        """
+        Remove and return the uncollapsed cell with the lowest entropy.
+
+        Returns:
+            Tuple of (x, y) coordinates, or None if all cells are collapsed
+        """
+        import heapq
+
+        while self.heap:
+            _, count, x, y = heapq.heappop(self.heap)
+            # Skip entries for collapsed cells and entries that are out of date
+            if self.wave.is_collapsed(x, y) or self.wave.counts[y, x] != count:
+                continue
+            return x, y
+        return None
 
 
 # ==================== TILE CONFIGURATION SYSTEM ====================
@@ -365,6 +790,107 @@ def can_connect(connection1, connection2):
     return connection1 == connection2
 
 
+# Variants generated for each symmetry class, as (mirrored, clockwise quarter turns).
+# X looks the same in every orientation, I and \ have two distinct rotations,
+# L and T four, and F (no symmetry at all) four rotations of itself and of its
+# mirror image.
+SYMMETRY_VARIANTS = {
+    'X': [(False, 0)],
+    'I': [(False, 0), (False, 1)],
+    '\\': [(False, 0), (False, 1)],
+    'L': [(False, turns) for turns in range(4)],
+    'T': [(False, turns) for turns in range(4)],
+    'F': [(mirrored, turns) for mirrored in (False, True) for turns in range(4)],
+}
+
+
+def transform_connections(connections, mirrored=False, turns=0):
+    """
+    Connections of a tile after mirroring it left to right and then turning
+    it clockwise by some quarter turns.
+
+    Args:
+        connections: Dictionary of connections (up, down, left, right)
+        mirrored: Mirror the tile left to right first
+        turns: Number of clockwise quarter turns
+
+    Returns:
+        New dictionary of connections
+    """
+    conn = dict(connections)
+    if mirrored:
+        conn['left'], conn['right'] = conn['right'], conn['left']
+    for _ in range(turns % 4):
+        # Turning clockwise moves the left side up, the top to the right, ...
+        conn = {'up': conn['left'], 'right': conn['up'], 'down': conn['right'], 'left': conn['down']}
+    return conn
+
+
+def transform_tile_image(img, mirrored=False, turns=0):
+    """
+    Mirror a tile image left to right and then turn it clockwise by some
+    quarter turns. Pixels are moved exactly, without resampling.
+
+    Args:
+        img: PIL Image of the tile
+        mirrored: Mirror the image left to right first
+        turns: Number of clockwise quarter turns
+
+    Returns:
+        New PIL Image
+    """
+    if mirrored:
+        img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    clockwise = {1: Image.Transpose.ROTATE_270, 2: Image.Transpose.ROTATE_180, 3: Image.Transpose.ROTATE_90}
+    if turns % 4:
+        img = img.transpose(clockwise[turns % 4])
+    elif not mirrored:
+        img = img.copy()
+    return img
+
+
+def expand_symmetry(tiles):
+    """
+    Replace every tile that has a 'symmetry' class (see SYMMETRY_VARIANTS)
+    by all its distinct rotated/mirrored variants, with transformed pixels
+    and connections. The first variant keeps the tile's name, the others
+    are named after the transform, e.g. corner_r90 or corner_m_r180.
+    Tiles without a symmetry class are kept as they are.
+
+    Args:
+        tiles: List of tile dictionaries
+
+    Returns:
+        New list of tile dictionaries, indexed 0..n-1; every variant has a
+        'base' (name of the tile it was made from) and a 'variant'
+        ((mirrored, turns)) entry
+    """
+    expanded = []
+
+    for tile in tiles:
+        symmetry = tile.get('symmetry')
+        if symmetry is None:
+            expanded.append(dict(tile, index=len(expanded)))
+            continue
+        if symmetry not in SYMMETRY_VARIANTS:
+            raise ValueError(f"Tile {tile['name']} has unknown symmetry {symmetry!r} "
+                             f"(expected one of {', '.join(SYMMETRY_VARIANTS)})")
+
+        for mirrored, turns in SYMMETRY_VARIANTS[symmetry]:
+            suffix = ("_m" if mirrored else "") + (f"_r{90 * turns}" if turns else "")
+            expanded.append(dict(tile,
+                                 index=len(expanded),
+                                 name=tile['name'] + suffix,
+                                 image=transform_tile_image(tile['image'], mirrored, turns),
+                                 connections=transform_connections(tile['connections'], mirrored, turns),
+                                 base=tile['name'],
+                                 variant=(mirrored, turns)))
+
+    if len(expanded) != len(tiles):
+        print(f"Symmetry expansion: {len(tiles)} tiles -> {len(expanded)} variants")
+    return expanded
+
+
 def load_tiles_from_config(tile_configs=TILE_CONFIGS):
     """
     Load tiles based on configuration dictionary.
@@ -379,6 +905,8 @@ def load_tiles_from_config(tile_configs=TILE_CONFIGS):
             - 'image': PIL Image object
             - 'connections': dictionary of connections (up, down, left, right)
             - 'description': tile description
+        A config entry with a 'symmetry' class is loaded as all its
+        variants, see expand_symmetry()
     """
     # Get tiles folder path
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -402,7 +930,9 @@ def load_tiles_from_config(tile_configs=TILE_CONFIGS):
             continue
         
         try:
+            # Decode now, so the file is closed and rendering never touches the disk
             img = Image.open(tile_path)
+            img.load()
             
             tile_data = {
                 'index': index,
@@ -412,6 +942,8 @@ def load_tiles_from_config(tile_configs=TILE_CONFIGS):
                 'connections': config['connections'],
                 'description': config.get('description', '')
             }
+            if config.get('symmetry') is not None:
+                tile_data['symmetry'] = config['symmetry']
             
             tiles.append(tile_data)
             
@@ -423,6 +955,9 @@ def load_tiles_from_config(tile_configs=TILE_CONFIGS):
         except Exception as e:
             print(f"ERROR loading {tile_path}: {e}")
     
+    # Generate the rotated/mirrored variants of tiles with a symmetry class
+    tiles = expand_symmetry(tiles)
+
     print(f"\nSuccessfully loaded {len(tiles)} tiles (indices 0-{len(tiles)-1})")
     return tiles
 
@@ -615,32 +1150,49 @@ def setup_adjacency_rules(tiles):
     return adjacency
 
 
-def analyze_entropy(grid, tiles_x, tiles_y):
+def compile_adjacency_rules(adjacency, n_tiles):
+    """
+    Turn the adjacency dictionary into per-direction boolean masks.
+
+    rules[d, t] is a boolean array of length n_tiles marking every tile that is
+    allowed next to tile t in direction DIRECTIONS[d], so constraining a
+    neighbor is a single AND instead of a list membership check per tile.
+
+    Args:
+        adjacency: Dictionary of adjacency rules (from setup_adjacency_rules*)
+        n_tiles: Number of tiles in the tileset
+
+    Returns:
+        NumPy bool array of shape (4, n_tiles, n_tiles)
+    """
+    rules = np.zeros((len(DIRECTIONS), n_tiles, n_tiles), dtype=bool)
+
+    for tile_idx, neighbors in adjacency.items():
+        if tile_idx >= n_tiles:
+            continue
+        for d, direction in enumerate(DIRECTIONS):
+            valid = [t for t in neighbors[direction] if t < n_tiles]
+            rules[d, tile_idx, valid] = True
+
+    return rules
+
+
+def analyze_entropy(wave):
     """
     Analyze the entropy of all cells in the grid.
     Entropy = number of possible options for a cell.
     Lower entropy means the cell is more constrained.
     
     Args:
-        grid: 2D array of Cell objects
-        tiles_x: Width of grid
-        tiles_y: Height of grid
+        wave: Wave holding the state of the grid
     
     Returns:
         Statistics about the grid entropy
     """
-    total_entropy = 0
-    uncollapsed_count = 0
-    collapsed_count = 0
-    
-    for y in range(tiles_y):
-        for x in range(tiles_x):
-            cell = grid[y][x]
-            if cell.is_collapsed():
-                collapsed_count += 1
-            else:
-                uncollapsed_count += 1
-                total_entropy += cell.get_entropy()
+    uncollapsed = wave.tile_index < 0
+    uncollapsed_count = int(np.count_nonzero(uncollapsed))
+    collapsed_count = uncollapsed.size - uncollapsed_count
+    total_entropy = int(wave.counts[uncollapsed].sum())
     
     avg_entropy = total_entropy / uncollapsed_count if uncollapsed_count > 0 else 0
     
@@ -652,263 +1204,504 @@ def analyze_entropy(grid, tiles_x, tiles_y):
     }
 
 
-def find_lowest_entropy_cell(grid, tiles_x, tiles_y):
+def find_lowest_entropy_cell(wave, entropy_heap=None, rng=None):
     """
     Find the uncollapsed cell with the lowest entropy.
     This is the cell we should collapse next.
     
     Args:
-        grid: 2D array of Cell objects
-        tiles_x: Width of grid
-        tiles_y: Height of grid
+        wave: Wave holding the state of the grid
+        entropy_heap: Optional EntropyHeap; if given, the cell is taken from
+                      the heap instead of scanning the whole grid
+        rng: random.Random used to break ties (defaults to the global random module)
     
     Returns:
         Tuple of (x, y) coordinates, or None if all cells are collapsed
     """
-    min_entropy = float('inf')
-    candidates = []
-    
-    for y in range(tiles_y):
-        for x in range(tiles_x):
-            cell = grid[y][x]
-            if not cell.is_collapsed():
-                entropy = cell.get_entropy()
-                
-                if entropy < min_entropy:
-                    min_entropy = entropy
-                    candidates = [(x, y)]
-                elif entropy == min_entropy:
-                    candidates.append((x, y))
-    
-    if not candidates:
+    import random
+
+    if entropy_heap is not None:
+        return entropy_heap.pop()
+
+    entropy = np.where(wave.tile_index < 0, wave.counts, np.iinfo(np.int32).max)
+    min_entropy = entropy.min()
+    
+    if min_entropy == np.iinfo(np.int32).max:
         return None
     
     # If multiple cells have same entropy, pick randomly
-    import random
-    return random.choice(candidates)
+    candidates = np.flatnonzero(entropy == min_entropy)
+    if rng is None:
+        rng = random
+    y, x = divmod(int(rng.choice(candidates)), wave.tiles_x)
+    return x, y
 
 
-def propagate_constraints(grid, x, y, adjacency, tiles_x, tiles_y):
+def propagate_constraints(wave):
     """
-    Propagate constraints from a collapsed cell to its neighbors.
-    This reduces the options for neighboring cells based on adjacency rules.
+    Propagate every pending option removal through the grid (AC-4).
+    
+    Each removal lowers the support counters of the four neighbors (see
+    Wave.ban). Any neighbor tile whose support from that side drops to zero
+    is banned as well, and its removal is propagated in turn, whether or not
+    the cell is collapsed. The result is arc consistent: every remaining option of every
+    cell has at least one compatible option in each neighbor.
     
     Args:
-        grid: 2D array of Cell objects
-        x, y: Coordinates of the just-collapsed cell
-        adjacency: Dictionary of adjacency rules
-        tiles_x: Width of grid
-        tiles_y: Height of grid
+        wave: Wave holding the state of the grid
     
     Returns:
         Number of cells that were constrained
+    
+    Raises:
+        Contradiction: If a cell is left with no valid options
     """
     changes = 0
-    stack = [(x, y)]
     
-    while stack:
-        cx, cy = stack.pop()
-        current_cell = grid[cy][cx]
-        
-        if not current_cell.is_collapsed():
-            continue
-        
-        current_tile = current_cell.tile_index
-        
-        # Check all four neighbors
-        neighbors = [
-            (cx, cy - 1, 'up'),      # Cell above
-            (cx, cy + 1, 'down'),    # Cell below
-            (cx - 1, cy, 'left'),    # Cell to left
-            (cx + 1, cy, 'right')    # Cell to right
-        ]
-        
-        for nx, ny, direction in neighbors:
-            # Check if neighbor is in bounds
-            if nx < 0 or nx >= tiles_x or ny < 0 or ny >= tiles_y:
-                continue
-            
-            neighbor_cell = grid[ny][nx]
-            
-            # Skip if already collapsed
-            if neighbor_cell.is_collapsed():
-                continue
-            
-            # Get valid tiles for this direction
-            valid_tiles = adjacency[current_tile][direction]
-            
-            # Constrain neighbor's options
-            old_options = neighbor_cell.options.copy()
-            neighbor_cell.options = [t for t in neighbor_cell.options if t in valid_tiles]
-            
-            # If options changed, add to stack to propagate further
-            if neighbor_cell.options != old_options:
+    try:
+        if wave.batch_propagation:
+            while wave.pending:
+                changes += _ban_pending_batch(wave)
+        while wave.pending:
+            x, y, unsupported = wave.pending.pop()
+            if wave.ban(x, y, unsupported):
                 changes += 1
-                if (nx, ny) not in stack:
-                    stack.append((nx, ny))
-                    
-                # Check for contradiction (no valid options)
-                if len(neighbor_cell.options) == 0:
-                    # Contradiction! This shouldn't happen with good rules
-                    # For now, reset to all options
-                    neighbor_cell.options = list(range(len(adjacency)))
+    except Contradiction:
+        wave.pending.clear()
+        raise
     
     return changes
 
 
-def render_grid_snapshot(grid, tiles, tiles_x, tiles_y, tile_size, output_path):
+def _ban_pending_batch(wave):
+    """
+    Apply every queued ban of a wave in one Wave.ban_cells() call, merging
+    the bans queued for the same cell.
+
+    Returns:
+        Number of cells that lost at least one option
+    """
+    batch = wave.pending[:]
+    wave.pending.clear()
+
+    xs = np.concatenate([np.atleast_1d(entry[0]) for entry in batch])
+    ys = np.concatenate([np.atleast_1d(entry[1]) for entry in batch])
+    masks = np.concatenate([entry[2].reshape(-1, wave.n_tiles) for entry in batch])
+
+    # One row per cell: OR together the masks of repeated cells
+    keys = ys * wave.tiles_x + xs
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    if len(starts) == len(keys):
+        return wave.ban_cells(xs, ys, masks)
+    merged = np.logical_or.reduceat(masks[order], starts, axis=0)
+
+    return wave.ban_cells(xs[order][starts], ys[order][starts], merged)
+
+
+def render_tile_grid(tile_indices, tiles, tile_size, scale=1, placeholder=None):
+    """
+    Render a 2D array of tile indices to an image.
+    The frame is gathered from the tileset's atlas in one NumPy operation
+    (see classes/wfc_render.py) instead of pasting cell by cell.
+    
+    Args:
+        tile_indices: 2D NumPy array of tile indices (-1 = uncollapsed)
+        tiles: List of tile dictionaries
+        tile_size: Size of each tile in pixels
+        scale: Integer factor to scale the image up by
+        placeholder: RGB color for uncollapsed cells (None leaves them white)
+    
+    Returns:
+        PIL Image of the grid
+    """
+    from classes.wfc_render import PLACEHOLDER_COLOR, get_tile_atlas
+
+    atlas = get_tile_atlas(tiles, tile_size, PLACEHOLDER_COLOR if placeholder is None else placeholder)
+    return atlas.render(tile_indices, scale, placeholder=placeholder is not None)
+
+
+def render_grid_snapshot(wave, tiles, tile_size, output_path):
     """
     Render the current state of the grid to an image.
     Uncollapsed cells are shown with a grey placeholder.
     
     Args:
-        grid: 2D array of Cell objects
+        wave: Wave holding the state of the grid
         tiles: List of tile dictionaries
-        tiles_x: Width of grid
-        tiles_y: Height of grid
         tile_size: Size of each tile in pixels
         output_path: Path to save the snapshot
     """
-    img_width = tiles_x * tile_size
-    img_height = tiles_y * tile_size
-    img = Image.new('RGB', (img_width, img_height), color='white')
-    
-    for y in range(tiles_y):
-        for x in range(tiles_x):
-            cell = grid[y][x]
-            
-            if cell.is_collapsed():
-                # Use the actual tile
-                tile_img = tiles[cell.tile_index]['image']
-            else:
-                # Use a grey square for uncollapsed cells
-                tile_img = Image.new('RGB', (tile_size, tile_size), color=(200, 200, 200))
-            
-            paste_x = x * tile_size
-            paste_y = y * tile_size
-            img.paste(tile_img, (paste_x, paste_y))
-    
     # Scale up 2x
-    scaled_width = img_width * 2
-    scaled_height = img_height * 2
-    img = img.resize((scaled_width, scaled_height), Image.NEAREST)
+    img = render_tile_grid(wave.tile_index, tiles, tile_size, scale=2, placeholder=(200, 200, 200))
     img.save(output_path)
 
 
-def weighted_random_choice(options, tiles):
+def get_tile_weights(tiles, weights=None):
+    """
+    Look up the weight of every tile: the tile's own 'weight' (set by
+    tileset packages), else its TILE_WEIGHTS entry, else 1.0. Symmetry
+    variants fall back to the entries of the tile they were made from.
+    
+    Args:
+        tiles: List of tile dictionaries
+        weights: Optional dictionary of tile name -> weight that overrides
+                 both
+    
+    Returns:
+        NumPy float array with one weight per tile index
+    """
+    weights = weights or {}
+    result = []
+    for tile in tiles:
+        names = (tile['name'], tile.get('base', tile['name']))
+        if names[0] in weights or names[1] in weights:
+            result.append(weights.get(names[0], weights.get(names[1])))
+        elif 'weight' in tile:
+            result.append(tile['weight'])
+        else:
+            result.append(TILE_WEIGHTS.get(names[0], TILE_WEIGHTS.get(names[1], 1.0)))
+    return np.array(result, dtype=np.float64)
+
+
+def weighted_random_choice(options, tiles, rng=None, weights=None):
     """
     Choose a random tile from options, weighted by TILE_WEIGHTS.
     
     Args:
         options: List of tile indices to choose from
         tiles: List of tile dictionaries
+        rng: random.Random to draw from (defaults to the global random module)
+        weights: Optional array of weights per tile index (from
+                 get_tile_weights) to use instead of TILE_WEIGHTS
     
     Returns:
         Chosen tile index
     """
     import random
+
+    if rng is None:
+        rng = random
     
     # Get weights for each option
-    weights = []
-    for tile_idx in options:
-        tile_name = tiles[tile_idx]['name']
-        weight = TILE_WEIGHTS.get(tile_name, 1.0)
-        weights.append(weight)
-    
-    # Use random.choices for weighted selection
-    chosen = random.choices(options, weights=weights, k=1)[0]
+    if weights is not None:
+        option_weights = weights[options].tolist()
+    else:
+        option_weights = []
+        for tile_idx in options:
+            tile_name = tiles[tile_idx]['name']
+            option_weights.append(TILE_WEIGHTS.get(tile_name, 1.0))
+    
+    # Use random.choices for weighted selection (uniform if every option has weight 0)
+    chosen = rng.choices(options, weights=option_weights if any(option_weights) else None, k=1)[0]
     return chosen
 
 
-def collapse_wfc(grid, tiles, adjacency, tiles_x, tiles_y, max_iterations=1000, save_steps=False, tile_size=16):
+# What collapse_wfc can do when propagation runs into a contradiction
+CONTRADICTION_STRATEGIES = ('stop', 'backtrack', 'restart')
+
+
+def backtrack(wave, decisions, budget):
+    """
+    Undo recent collapses until the wave is consistent again.
+    The tile chosen at every undone collapse is banned from its cell, so the
+    solver does not make the same choice twice.
+    
+    Args:
+        wave: Wave with an undo trail (wave.trail is not None)
+        decisions: List of (trail length, x, y, tile) for each collapse,
+                   most recent last; undone entries are popped
+        budget: Maximum number of collapses to undo
+    
+    Returns:
+        Tuple of (recovered, backtracks used)
+    """
+    used = 0
+    while decisions and used < budget:
+        trail_length, x, y, tile = decisions.pop()
+        wave.undo(trail_length)
+        used += 1
+        
+        banned = np.zeros(wave.n_tiles, dtype=bool)
+        banned[tile] = True
+        try:
+            wave.ban(x, y, banned)
+            propagate_constraints(wave)
+            return True, used
+        except Contradiction:
+            continue
+    
+    return False, used
+
+
+def _progress(wave, iteration):
+    """
+    Progress of a running solve, from the counters the wave keeps up to date
+    (the same numbers analyze_entropy() computes by scanning the grid).
+    """
+    total_cells = wave.tiles_x * wave.tiles_y
+    uncollapsed = total_cells - wave.collapsed_count
+    return {
+        'iteration': iteration,
+        'collapsed': wave.collapsed_count,
+        'total': total_cells,
+        'average_entropy': wave.total_options / uncollapsed if uncollapsed > 0 else 0
+    }
+
+
+def collapse_wfc(wave, tiles, max_iterations=None, save_steps=False, tile_size=16, heuristic='count',
+                 strategy='backtrack', max_backtracks=1000, max_restarts=5, backtrack_depth=256, verbose=True,
+                 rng=None, weights=None, steps_dir=None, progress_callback=None,
+                 progress_every=10, step_every=1, step_min_progress=0, step_format='png'):
     """
     Main Wave Function Collapse algorithm.
     Iteratively collapses cells starting with lowest entropy.
     
     Args:
-        grid: 2D array of Cell objects
+        wave: Wave holding the state of the grid
         tiles: List of tile dictionaries
-        adjacency: Dictionary of adjacency rules
-        tiles_x: Width of grid
-        tiles_y: Height of grid
         max_iterations: Maximum iterations to prevent infinite loops
+                        (None = run until every cell is collapsed)
         save_steps: Whether to save intermediate snapshots
         tile_size: Size of tiles for rendering snapshots
+        heuristic: 'count' to pick the cell with the fewest options, or
+                   'shannon' for Shannon entropy weighted by TILE_WEIGHTS
+        strategy: What to do when a contradiction happens:
+                  'stop' gives up and leaves the remaining cells empty,
+                  'backtrack' undoes the latest collapses (and starts over
+                  once max_backtracks is used up), 'restart' starts over
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+        backtrack_depth: Number of recent collapses that can be undone; older
+                         undo history is dropped to keep memory bounded
+        verbose: Whether to print progress (errors are always printed)
+        rng: random.Random that drives every random choice, so a run can be
+             reproduced from its seed (defaults to an unseeded generator)
+        weights: Optional dictionary of tile name -> weight overriding TILE_WEIGHTS
+        steps_dir: Folder to save the snapshots in (required with save_steps)
+        progress_callback: Optional function called every progress_every
+                           iterations (and once at the end) with a dictionary
+                           of 'iteration', 'collapsed', 'total' and
+                           'average_entropy'
+        progress_every: Number of iterations between progress updates
+        step_every: Save a snapshot at most every this many collapses
+        step_min_progress: Only save a snapshot once at least this many
+                           percent more of the grid is collapsed than in
+                           the previous snapshot (0 = no minimum)
+        step_format: 'png' saves every snapshot as steps_dir/step_NNN.png,
+                     'log' records every collapse in one compact binary
+                     event log (steps_dir/steps.wfclog) plus the tile atlas
+                     image (steps_dir/atlas.png) for the page to replay
     
     Returns:
-        Number of iterations used
+        Dictionary with the run statistics:
+            - 'iterations': number of iterations used
+            - 'contradiction': (x, y) of the cell left without options,
+              or None if the grid was solved
+            - 'contradictions': number of contradictions hit
+            - 'backtracks': number of collapses undone
+            - 'restarts': number of times the solve started over
     """
-    import random
     import os
+    import random
     
-    print("\n=== Starting Wave Function Collapse ===")
+    if strategy not in CONTRADICTION_STRATEGIES:
+        raise ValueError(f"Unknown contradiction strategy: {strategy}")
+    
+    if verbose:
+        print("\n=== Starting Wave Function Collapse ===")
+
+    total_cells = wave.tiles_x * wave.tiles_y
+    result = {'iterations': 0, 'contradiction': None, 'contradictions': 0, 'backtracks': 0, 'restarts': 0}
+
+    # Settle any constraints that were placed on the wave before solving
+    try:
+        propagate_constraints(wave)
+    except Contradiction as e:
+        print(f"ERROR: {e}")
+        result['contradiction'] = (e.x, e.y)
+        return result
     
     # Create steps directory if saving snapshots
+    step_log = None
     if save_steps:
-        steps_dir = "static/images/WFC/WFCOutput/steps"
+        if steps_dir is None:
+            raise ValueError("steps_dir is required when save_steps is set")
+        if step_format not in ('png', 'log'):
+            raise ValueError(f"Unknown step format: {step_format}")
         os.makedirs(steps_dir, exist_ok=True)
         print(f"  Saving step-by-step snapshots to {steps_dir}/")
-    
-    iteration = 0
-    while iteration < max_iterations:
-        # Find cell with lowest entropy
-        cell_coords = find_lowest_entropy_cell(grid, tiles_x, tiles_y)
-        
-        if cell_coords is None:
-            print(f"All cells collapsed after {iteration} iterations!")
-            break
-        
-        x, y = cell_coords
-        cell = grid[y][x]
+
+        from classes.wfc_render import FrameBuffer, get_tile_atlas
+
+        if step_format == 'log':
+            from classes.wfc_steplog import ATLAS_NAME, LOG_NAME, StepLog
+
+            atlas = get_tile_atlas(tiles, tile_size)
+            atlas.sheet().save(os.path.join(steps_dir, ATLAS_NAME))
+            step_log = StepLog(os.path.join(steps_dir, LOG_NAME), wave.tiles_x, wave.tiles_y, len(tiles))
+        else:
+            # One frame that is kept up to date cell by cell (scaled 2x like
+            # render_grid_snapshot)
+            frames = FrameBuffer(get_tile_atlas(tiles, tile_size), wave.tiles_x, wave.tiles_y, scale=2)
+        saved_steps = 0
+        last_step_iteration = 0
+        last_step_collapsed = wave.collapsed_count
+
+    # The log is closed even if the solve raises, so no file handle is left open
+    try:
+        # Contradiction recovery: an undo trail for backtracking and a copy of
+        # the starting state for restarts
+        initial_state = None
+        if strategy != 'stop' and max_restarts > 0:
+            initial_state = wave.save_state()
+        if strategy == 'backtrack':
+            wave.trail = []
+        decisions = []  # (trail length before the collapse, x, y, tile)
+        backtracks = 0  # Backtracks used in the current attempt
+
+        # Entropy index, updated only for cells that propagation touched
+        if rng is None:
+            rng = random.Random()
+        tile_weights = get_tile_weights(tiles, weights)
+        entropy_heap = EntropyHeap(wave, tile_weights, heuristic, rng)
+        wave.changed.clear()
+    
+        iteration = 0
+        while max_iterations is None or iteration < max_iterations:
+            # Find cell with lowest entropy
+            cell_coords = find_lowest_entropy_cell(wave, entropy_heap)
         
-        # Collapse this cell to a weighted random valid option
-        if len(cell.options) == 0:
-            print(f"ERROR: Cell at ({x},{y}) has no valid options!")
-            break
+            if cell_coords is None:
+                if verbose:
+                    print(f"All cells collapsed after {iteration} iterations!")
+                break
         
-        # Apply weights to tile selection
-        chosen_tile = weighted_random_choice(cell.options, tiles)
-        cell.collapse(chosen_tile)
+            x, y = cell_coords
+            options = wave.options(x, y)
         
-        # Propagate constraints to neighbors
-        changes = propagate_constraints(grid, x, y, adjacency, tiles_x, tiles_y)
+            # Apply weights to tile selection
+            chosen_tile = weighted_random_choice(options, tiles, rng, tile_weights)
+            if wave.trail is not None:
+                decisions.append((len(wave.trail), x, y, chosen_tile))
+            wave.collapse(x, y, chosen_tile)
+            iteration += 1
+            restarted = False
         
-        iteration += 1
+            # Propagate constraints to neighbors
+            try:
+                propagate_constraints(wave)
+            except Contradiction as e:
+                result['contradictions'] += 1
+                recovered = False
+            
+                if strategy == 'backtrack':
+                    recovered, used = backtrack(wave, decisions, max_backtracks - backtracks)
+                    backtracks += used
+                    result['backtracks'] += used
+            
+                if not recovered and initial_state is not None and result['restarts'] < max_restarts:
+                    # Start over with a new seed drawn from the current generator,
+                    # so the whole run stays reproducible from the first seed
+                    result['restarts'] += 1
+                    restart_seed = rng.randrange(2 ** 32)
+                    if verbose:
+                        print(f"  {e}, restarting with seed {restart_seed} ({result['restarts']}/{max_restarts})")
+                    rng = random.Random(restart_seed)
+                    wave.restore_state(initial_state)
+                    decisions.clear()
+                    backtracks = 0
+                    entropy_heap = EntropyHeap(wave, tile_weights, heuristic, rng)
+                    restarted = True
+                    recovered = True
+            
+                if not recovered:
+                    print(f"ERROR: {e}")
+                    result['contradiction'] = (e.x, e.y)
+                    break
+
+            # Log the collapsed cell and any cells cleared by backtracking
+            # (after a restart any cell may have changed)
+            if step_log is not None:
+                step_log.record(wave.tile_index, None if restarted else wave.changed + [(x, y)])
+
+            entropy_heap.update(wave.changed)
+            wave.changed.clear()
+
+            # Only keep undo history for the most recent collapses
+            if len(decisions) > 2 * backtrack_depth:
+                drop = len(decisions) - backtrack_depth
+                cut = decisions[drop][0]
+                del wave.trail[:cut]
+                decisions = [(trail_length - cut, dx, dy, tile) for trail_length, dx, dy, tile in decisions[drop:]]
         
-        # Save snapshot after each collapse if enabled
-        if save_steps:
-            snapshot_path = f"static/images/WFC/WFCOutput/steps/step_{iteration:03d}.png"
-            render_grid_snapshot(grid, tiles, tiles_x, tiles_y, tile_size, snapshot_path)
+            # Save a snapshot if enough has happened since the previous one
+            if (save_steps and step_log is None and iteration - last_step_iteration >= step_every
+                    and (wave.collapsed_count - last_step_collapsed) * 100 >= step_min_progress * total_cells):
+                saved_steps += 1
+                frames.update(wave.tile_index)
+                frames.save(os.path.join(steps_dir, f"step_{saved_steps:03d}.png"))
+                last_step_iteration = iteration
+                last_step_collapsed = wave.collapsed_count
         
-        # Progress update every 10 iterations
-        if iteration % 10 == 0:
-            stats = analyze_entropy(grid, tiles_x, tiles_y)
-            print(f"  Iteration {iteration}: Collapsed {stats['collapsed']}/{tiles_x * tiles_y}, "
-                  f"Avg Entropy: {stats['average_entropy']:.2f}")
-    
-    # Save final snapshot if enabled
-    if save_steps:
-        print(f"  Saved {iteration + 1} snapshots (one per collapse)")
-    
-    return iteration
-
-
-def replace_blanks_with_buildings(grid, tiles, tiles_x, tiles_y):
+            # Progress update every progress_every iterations
+            if iteration % progress_every == 0 and (verbose or progress_callback is not None):
+                progress = _progress(wave, iteration)
+                if verbose:
+                    print(f"  Iteration {iteration}: Collapsed {progress['collapsed']}/{total_cells}, "
+                          f"Avg Entropy: {progress['average_entropy']:.2f}")
+                if progress_callback is not None:
+                    progress_callback(progress)
+    
+        wave.trail = None
+        if progress_callback is not None:
+            progress_callback(_progress(wave, iteration))
+    
+        # Save final snapshot if enabled
+        if step_log is not None:
+            # Catch up on a collapse that ended in an unrecovered contradiction
+            step_log.record(wave.tile_index)
+            print(f"  Logged {step_log.steps} steps")
+        elif save_steps:
+            if last_step_iteration != iteration:
+                saved_steps += 1
+                frames.update(wave.tile_index)
+                frames.save(os.path.join(steps_dir, f"step_{saved_steps:03d}.png"))
+            print(f"  Saved {saved_steps} snapshots")
+    finally:
+        if step_log is not None:
+            step_log.close()
+
+    if verbose and result['contradictions']:
+        print(f"  Contradictions: {result['contradictions']}, backtracks: {result['backtracks']}, "
+              f"restarts: {result['restarts']}")
+    
+    result['iterations'] = iteration
+    return result
+
+
+def replace_blanks_with_buildings(wave, tiles, rng=None):
     """
     Post-process the grid to replace blank tiles with random building tiles.
     
     Args:
-        grid: 2D array of Cell objects
-        tiles: List of tile dictionaries
-        tiles_x: Width of grid
-        tiles_y: Height of grid
+        wave: Wave holding the state of the grid
+        tiles: List of tile dictionaries; new entries are appended, so pass
+               a copy when the tiles come from the tileset registry
+        rng: random.Random to draw from (defaults to the global random module)
     
     Returns:
         Number of tiles replaced
     """
     import random
+
+    if rng is None:
+        rng = random
     
-    # Load building tiles
+    from classes.wfc_registry import load_tile_image
+
+    # Load building tiles (decoded once per process)
     script_dir = os.path.dirname(os.path.abspath(__file__))
     tiles_folder = os.path.join(script_dir, "..", "static", "images", "WFC", "WFCTiles", "basic_tiles")
     tiles_folder = os.path.normpath(tiles_folder)
@@ -920,8 +1713,7 @@ def replace_blanks_with_buildings(grid, tiles, tiles_x, tiles_y):
         building_path = os.path.join(tiles_folder, building_file)
         if os.path.exists(building_path):
             try:
-                img = Image.open(building_path)
-                building_images.append(img)
+                building_images.append(load_tile_image(building_path))
             except Exception as e:
                 print(f"Warning: Could not load {building_file}: {e}")
     
@@ -944,12 +1736,11 @@ def replace_blanks_with_buildings(grid, tiles, tiles_x, tiles_y):
     
     # Replace all blank tiles with random buildings
     replaced_count = 0
-    for y in range(tiles_y):
-        for x in range(tiles_x):
-            cell = grid[y][x]
-            if cell.is_collapsed() and cell.tile_index == blank_idx:
+    for y in range(wave.tiles_y):
+        for x in range(wave.tiles_x):
+            if wave.tile_index[y, x] == blank_idx:
                 # Replace with a random building
-                random_building = random.choice(building_images)
+                random_building = rng.choice(building_images)
                 # Store the building image in the tiles list temporarily
                 # We'll create a new tile entry for this building
                 new_tile_idx = len(tiles)
@@ -959,7 +1750,7 @@ def replace_blanks_with_buildings(grid, tiles, tiles_x, tiles_y):
                     'image': random_building,
                     'path': 'runtime_generated'
                 })
-                cell.tile_index = new_tile_idx
+                wave.tile_index[y, x] = new_tile_idx
                 replaced_count += 1
     
     print(f"  Replaced {replaced_count} blank tiles with buildings")
@@ -973,7 +1764,10 @@ def replace_blanks_with_buildings(grid, tiles, tiles_x, tiles_y):
 
 
 
-def setup(tile_size=16, output_width=160, output_height=160, input_image_path=None, save_steps=False, use_config=True):
+def setup(tile_size=16, output_width=160, output_height=160, input_image_path=None, save_steps=False, use_config=True,
+          heuristic='count', strategy='backtrack', max_backtracks=1000, max_restarts=5, seed=None, weights=None,
+          use_cache=True, output_dir=None, save_to_gallery=True, progress_callback=None, step_every=1,
+          step_min_progress=0, step_format='png', tileset=None, model='tiled'):
    
    
     """
@@ -983,40 +1777,148 @@ def setup(tile_size=16, output_width=160, output_height=160, input_image_path=No
         tile_size: Size of each tile in pixels (e.g., 16x16)
         output_width: Width of output image in pixels
         output_height: Height of output image in pixels
-        input_image_path: Path to the input tileset image
+        input_image_path: Path to the sample image of the overlapping model
+                          (defaults to static/images/WFC/test.png)
         save_steps: Whether to save step-by-step collapse snapshots
         use_config: If True, use TILE_CONFIGS; if False, use legacy file-based loading
+        heuristic: Entropy heuristic for picking the next cell ('count' or 'shannon')
+        strategy: Contradiction recovery ('stop', 'backtrack' or 'restart')
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+        seed: Seed for the run; the same seed and settings always give the
+              same city (a random seed is picked if None)
+        weights: Optional dictionary of tile name -> weight overriding TILE_WEIGHTS
+        use_cache: Reuse a previously generated image for the same seed and
+                   settings (with save_steps only for the 'log' step format,
+                   whose step log is cached with the image)
+        output_dir: Folder for output.png, the solved grid (city.npz) and
+                    the steps/ snapshots (defaults to a new folder under
+                    static/images/WFC/runs, so concurrent runs never
+                    overwrite each other)
+        save_to_gallery: Whether to also save a copy of the city to the gallery
+        progress_callback: Optional function receiving progress updates from collapse_wfc()
+        step_every: With save_steps, save a snapshot at most every this many collapses
+        step_min_progress: With save_steps, only save a snapshot once this many
+                           percent more of the grid is collapsed
+        step_format: With save_steps, 'png' for one image per step or 'log'
+                     for a single binary step log (see collapse_wfc())
+        tileset: Optional name of a tileset package to use instead of
+                 TILE_CONFIGS, loaded from its compiled bundle (see
+                 classes/tilesets.py); the grid keeps output_width // tile_size
+                 by output_height // tile_size tiles at the tileset's tile size
+        model: 'tiled' places the tiles of the tileset, 'overlapping' learns
+               patterns from input_image_path instead (see
+               classes/wfc_overlap.py); tile settings are then ignored
     
     Returns:
         Path to the generated output image
     """
+    import random
+    import shutil
+    from classes.wfc_grid import GRID_NAME
 
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+
+    print(f"Setup: tile_size={tile_size}, output={output_width}x{output_height}, seed={seed}")
+
+    if model == 'overlapping':
+        from classes.wfc_overlap import setup_overlapping
+
+        return setup_overlapping(input_image_path, tile_size, output_width, output_height, save_steps,
+                                 heuristic=heuristic, strategy=strategy, max_backtracks=max_backtracks,
+                                 max_restarts=max_restarts, seed=seed, use_cache=use_cache, output_dir=output_dir,
+                                 save_to_gallery=save_to_gallery, progress_callback=progress_callback,
+                                 step_every=step_every, step_min_progress=step_min_progress,
+                                 step_format=step_format)
+    if model != 'tiled':
+        raise ValueError(f"Unknown WFC model: {model}")
 
-    print(f"Setup: tile_size={tile_size}, output={output_width}x{output_height}")
     print(f"Mode: {'Config-based' if use_config else 'File-based (legacy)'}")
     
-    # Load tiles
-    if use_config:
-        tiles = load_tiles_from_config(TILE_CONFIGS)
-        adjacency = setup_adjacency_rules_from_connections(tiles)
+    # Load tiles (config-based tilesets are cached for the whole process)
+    if tileset is not None:
+        from classes.tilesets import load_tileset
+
+        # Keep the requested grid size in tiles, at the tileset's tile size
+        tiles_x, tiles_y = output_width // tile_size, output_height // tile_size
+        tiles, rules, tile_size = load_tileset(tileset)
+        output_width, output_height = tiles_x * tile_size, tiles_y * tile_size
+        adjacency = None
+        print(f"Tileset: {tileset} ({len(tiles)} tiles, {tile_size}px)")
+    elif use_config:
+        from classes.wfc_registry import get_tileset
+
+        tiles, adjacency, rules = get_tileset(TILE_CONFIGS)
     else:
         tiles = load_tiles()
         adjacency = setup_adjacency_rules(tiles)
+        rules = None
     
     # Set default input path if none provided
     if input_image_path is None:
         input_image_path = "static/images/WFC/test.png"
     
-    # Set output path
-    output_path = "static/images/WFC/WFCOutput/output.png"
+    # Give the run a folder of its own, after clearing out old runs
+    run_dir = None
+    if output_dir is None:
+        from classes.wfc_runs import RUNS_DIR, evict_outputs, finish_run, new_run_dir
+
+        evict_outputs(RUNS_DIR)
+        output_dir = run_dir = new_run_dir(seed)
+
+    # The run folder stays marked as running (safe from eviction) until the city is written
+    try:
+        # Set output path
+        output_path = os.path.join(output_dir, "output.png")
     
-    # Ensure output directory exists
-    os.makedirs("static/images/WFC/WFCOutput", exist_ok=True)
+        # Ensure output directory exists
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Return the cached image if this exact city was generated before
+        key = None
+        if use_cache and (not save_steps or step_format == 'log'):
+            from classes.wfc_cache import cache_key, get_cached, get_cached_grid, get_cached_steps, tileset_hash
+
+            key = cache_key(seed, tileset_hash(tiles), get_tile_weights(tiles, weights).tolist(),
+                            output_width // tile_size, output_height // tile_size, tile_size,
+                            use_config=use_config, tileset=tileset, heuristic=heuristic, strategy=strategy,
+                            max_backtracks=max_backtracks, max_restarts=max_restarts)
+            cached_path = get_cached(key)
+            cached_grid = get_cached_grid(key)
+            cached_steps = get_cached_steps(key) if save_steps else None
+            # The grid (other scales, rerolls) and any steps asked for are needed too,
+            # entries without them are solved again
+            if cached_path is not None and cached_grid is not None and (cached_steps or not save_steps):
+                if save_steps:
+                    from classes.wfc_steplog import ATLAS_NAME, LOG_NAME
+
+                    steps_dir = os.path.join(output_dir, "steps")
+                    os.makedirs(steps_dir, exist_ok=True)
+                    shutil.copyfile(cached_steps[0], os.path.join(steps_dir, LOG_NAME))
+                    shutil.copyfile(cached_steps[1], os.path.join(steps_dir, ATLAS_NAME))
+                shutil.copyfile(cached_grid, os.path.join(output_dir, GRID_NAME))
+                shutil.copyfile(cached_path, output_path)
+                print(f"Loaded cached city from {cached_path}")
+                return output_path
     
-    # Call draw function to create the image
-    draw(tiles, adjacency, tile_size, output_width, output_height, input_image_path, output_path, save_steps)
+        # Call draw function to create the image
+        draw(tiles, adjacency, tile_size, output_width, output_height, input_image_path, output_path, save_steps,
+             heuristic=heuristic, strategy=strategy, max_backtracks=max_backtracks, max_restarts=max_restarts,
+             seed=seed, weights=weights, steps_dir=os.path.join(output_dir, "steps"),
+             save_to_gallery=save_to_gallery, progress_callback=progress_callback, step_every=step_every,
+             step_min_progress=step_min_progress, step_format=step_format,
+             grid_path=os.path.join(output_dir, GRID_NAME), rules=rules)
+
+        if key is not None:
+            from classes.wfc_cache import store
+            store(key, output_path, os.path.join(output_dir, GRID_NAME),
+                  steps_dir=os.path.join(output_dir, "steps") if save_steps else None)
     
-    return output_path
+        return output_path
+    finally:
+        if run_dir is not None:
+            finish_run(run_dir)
 
 
 
@@ -1026,7 +1928,10 @@ def setup(tile_size=16, output_width=160, output_height=160, input_image_path=No
 
 
 
-def draw(tiles, adjacency, tile_size, output_width, output_height, input_path, output_path, save_steps=False):
+def draw(tiles, adjacency, tile_size, output_width, output_height, input_path, output_path, save_steps=False,
+         heuristic='count', strategy='backtrack', max_backtracks=1000, max_restarts=5, seed=None, weights=None,
+         steps_dir=None, save_to_gallery=True, progress_callback=None, step_every=1, step_min_progress=0,
+         step_format='png', grid_path=None, rules=None):
     
     
     """
@@ -1041,7 +1946,26 @@ def draw(tiles, adjacency, tile_size, output_width, output_height, input_path, o
         input_path: Path to input image
         output_path: Path to save output image
         save_steps: Whether to save step-by-step snapshots
+        heuristic: Entropy heuristic for picking the next cell ('count' or 'shannon')
+        strategy: Contradiction recovery ('stop', 'backtrack' or 'restart')
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+        seed: Seed for the random generator (None = unseeded)
+        weights: Optional dictionary of tile name -> weight overriding TILE_WEIGHTS
+        steps_dir: Folder to save the snapshots in (defaults to steps/ next
+                   to output_path)
+        save_to_gallery: Whether to also save a copy of the city to the gallery
+        progress_callback: Optional function receiving progress updates from collapse_wfc()
+        step_every: With save_steps, save a snapshot at most every this many collapses
+        step_min_progress: With save_steps, only save a snapshot once this many
+                           percent more of the grid is collapsed
+        step_format: With save_steps, 'png' for one image per step or 'log'
+                     for a single binary step log (see collapse_wfc())
+        grid_path: Optional path to also save the solved grid to as a
+                   compact .npz file (see classes/wfc_grid.py)
+        rules: Already compiled adjacency rules (compiled from adjacency if None)
     """
+    import random
 
     
     print(f"Drawing image...")
@@ -1059,68 +1983,68 @@ def draw(tiles, adjacency, tile_size, output_width, output_height, input_path, o
     
     print(f"  Grid: {tiles_x}x{tiles_y} tiles ({tiles_x * tiles_y} total)")
     
-    # Initialize the grid with cells
+    # Initialize the wave
     # Each cell starts with all tiles as options
-    grid = []
-    all_tile_indices = list(range(len(tiles)))  # [0, 1, 2, 3, 4] for 5 tiles
-    
-    for y in range(tiles_y):
-        row = []
-        for x in range(tiles_x):
-            # Create a new cell with all tiles as possible options
-            cell = Cell(all_tile_indices)
-            row.append(cell)
-        grid.append(row)
+    if rules is None:
+        rules = compile_adjacency_rules(adjacency, len(tiles))
+    wave = Wave(tiles_x, tiles_y, rules)
     
     print(f"  Created {tiles_y}x{tiles_x} grid with {tiles_y * tiles_x} cells")
-    print(f"  Each cell starts with {len(all_tile_indices)} possible options")
+    print(f"  Each cell starts with {wave.n_tiles} possible options")
     
     # Analyze initial entropy
-    stats = analyze_entropy(grid, tiles_x, tiles_y)
+    stats = analyze_entropy(wave)
     print(f"\n  Initial State:")
     print(f"    Collapsed: {stats['collapsed']}")
     print(f"    Uncollapsed: {stats['uncollapsed']}")
     print(f"    Average Entropy: {stats['average_entropy']:.2f}")
     
     # Run the Wave Function Collapse algorithm
-    iterations = collapse_wfc(grid, tiles, adjacency, tiles_x, tiles_y, 
-                              save_steps=save_steps, tile_size=tile_size)
+    if steps_dir is None:
+        steps_dir = os.path.join(os.path.dirname(output_path), "steps")
+    result = collapse_wfc(wave, tiles, save_steps=save_steps, tile_size=tile_size, heuristic=heuristic,
+                          strategy=strategy, max_backtracks=max_backtracks, max_restarts=max_restarts,
+                          rng=random.Random(seed), weights=weights, steps_dir=steps_dir,
+                          progress_callback=progress_callback, step_every=step_every,
+                          step_min_progress=step_min_progress, step_format=step_format)
     
     # Analyze final entropy
-    stats = analyze_entropy(grid, tiles_x, tiles_y)
+    stats = analyze_entropy(wave)
     print(f"\n  Final State:")
     print(f"    Collapsed: {stats['collapsed']}")
     print(f"    Uncollapsed: {stats['uncollapsed']}")
-    print(f"    Used {iterations} iterations")
-    
-    # Now render the grid to an image
-    img = Image.new('RGB', (output_width, output_height), color='white')
+    print(f"    Used {result['iterations']} iterations")
+    print(f"    Contradictions: {result['contradictions']} "
+          f"(backtracks: {result['backtracks']}, restarts: {result['restarts']})")
+    if result['contradiction'] is not None:
+        print(f"    Stopped at a contradiction in cell {result['contradiction']}")
     
-    for y in range(tiles_y):
-        for x in range(tiles_x):
-            cell = grid[y][x]
-            
-            if cell.is_collapsed():
-                # Get the tile for this cell
-                tile_img = tiles[cell.tile_index]['image']
-                
-                # Calculate position to paste
-                paste_x = x * tile_size
-                paste_y = y * tile_size
-                
-                # Paste the tile
-                img.paste(tile_img, (paste_x, paste_y))
+    # Now render the grid to an image, on a white canvas of the full output size
+    from classes.wfc_render import get_tile_atlas, upscale
+
+    grid = get_tile_atlas(tiles, tile_size).render_array(wave.tile_index, placeholder=False)
+    canvas = np.full((output_height, output_width, 3), 255, dtype=np.uint8)
+    canvas[:grid.shape[0], :grid.shape[1]] = grid
     
     print(f"  Rendered all cells to image")
     
     # Scale up the image by 2x for better readability
     scaled_width = output_width * 2
     scaled_height = output_height * 2
-    img = img.resize((scaled_width, scaled_height), Image.NEAREST)
+    img = Image.fromarray(upscale(canvas, 2))
     print(f"  Scaled image to {scaled_width}x{scaled_height} (2x)")
     
     img.save(output_path)
     print(f"Saved image to {output_path}")
+
+    if grid_path is not None:
+        from classes.wfc_grid import save_grid
+
+        save_grid(grid_path, wave.tile_index, tiles, seed, get_tile_weights(tiles, weights))
+        print(f"Saved grid to {grid_path}")
+
+    if not save_to_gallery:
+        return
     
     # Save a copy to the gallery with timestamp
     from datetime import datetime
@@ -1140,5 +2064,5 @@ if __name__ == "__main__":
     print("="*60)
     output = setup(tile_size=16, output_width=256, output_height=256, save_steps=True, use_config=True)
     print(f"Done! Check {output}")
-    print(f"Step-by-step snapshots saved to static/images/WFC/WFCOutput/steps/")
+    print(f"Step-by-step snapshots saved to {os.path.join(os.path.dirname(output), 'steps')}/")
 
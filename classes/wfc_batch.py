@@ -0,0 +1,113 @@
+"""
+Batch generation of many WFC cities across several processes
+
+Each worker process loads the tiles and compiles the adjacency rules once
+when it starts, then solves as many cities as it is handed. Results are
+yielded in the order the workers finish them.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import random
+
+from classes.wfc import TILE_CONFIGS, Wave, collapse_wfc, render_tile_grid
+from classes.wfc_registry import get_tileset
+
+
+# Tileset of the current worker process, set up by _init_worker()
+_worker_tiles = None
+_worker_rules = None
+
+
+def _init_worker(tile_configs):
+    """
+    Load the tiles and adjacency rules once per worker process.
+
+    Args:
+        tile_configs: Tile configuration dictionary
+    """
+    global _worker_tiles, _worker_rules
+
+    _worker_tiles, _, _worker_rules = get_tileset(tile_configs)
+
+
+def _generate_one(seed, tiles_x, tiles_y, tile_size, output_dir, strategy):
+    """
+    Solve and save a single city inside a worker process.
+
+    Returns:
+        Dictionary with the seed, the image path and the solver statistics
+    """
+    wave = Wave(tiles_x, tiles_y, _worker_rules)
+    stats = collapse_wfc(wave, _worker_tiles, tile_size=tile_size, strategy=strategy, verbose=False,
+                         rng=random.Random(seed))
+
+    output_path = os.path.join(output_dir, f"city_{seed}.png")
+    img = render_tile_grid(wave.tile_index, _worker_tiles, tile_size, scale=2)
+    img.save(output_path)
+
+    return {
+        'seed': seed,
+        'path': output_path,
+        'stats': stats
+    }
+
+
+def generate_batch(n, seeds=None, size=(10, 10), workers=None, tile_size=16,
+                   output_dir=None, strategy='backtrack', tile_configs=TILE_CONFIGS):
+    """
+    Generate n independent cities on a pool of worker processes.
+
+    This is a generator: each city is yielded as soon as a worker finishes
+    it, so callers can start using the first maps while the rest are
+    still being solved.
+
+    Args:
+        n: Number of cities to generate
+        seeds: Optional list of at least n seeds (random seeds if None)
+        size: (tiles_x, tiles_y) size of every city in tiles
+        workers: Number of worker processes (defaults to the CPU count)
+        tile_size: Size of each tile in pixels
+        output_dir: Folder to save the city images in (defaults to a new run
+                    folder under static/images/WFC/runs, evicted like the
+                    other runs)
+        strategy: Contradiction recovery used for each city
+        tile_configs: Tile configuration dictionary
+
+    Yields:
+        Dictionaries with 'seed', 'path' and 'stats' for each city
+    """
+    if seeds is None:
+        seeds = [random.randrange(2 ** 32) for _ in range(n)]
+    elif len(seeds) < n:
+        raise ValueError(f"Expected at least {n} seeds, got {len(seeds)}")
+
+    tiles_x, tiles_y = size
+    run_dir = None
+    if output_dir is None:
+        from classes.wfc_runs import RUNS_DIR, evict_outputs, new_run_dir
+
+        evict_outputs(RUNS_DIR)
+        output_dir = run_dir = new_run_dir()
+    os.makedirs(output_dir, exist_ok=True)
+
+    print(f"Generating {n} cities of {tiles_x}x{tiles_y} tiles with {workers or os.cpu_count()} workers...")
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(tile_configs,))
+    try:
+        futures = [executor.submit(_generate_one, seed, tiles_x, tiles_y, tile_size, output_dir, strategy)
+                   for seed in seeds[:n]]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # Don't keep solving if the caller stopped early
+        executor.shutdown(wait=True, cancel_futures=True)
+        if run_dir is not None:
+            from classes.wfc_runs import finish_run
+
+            finish_run(run_dir)
+
+
+if __name__ == "__main__":
+    for city in generate_batch(8, workers=4):
+        print(f"  City {city['seed']} -> {city['path']}")
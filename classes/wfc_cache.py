@@ -0,0 +1,181 @@
+"""
+On-disk cache of generated WFC cities
+
+With an explicit seed a run is fully reproducible: the same seed, tileset,
+tile weights, grid size and solver settings always give the same city. The
+finished image (and the solved grid and step log, when the run saved them)
+is stored under a hash of all of those, so asking for the same city again
+is a file copy instead of a full solve.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+from classes.wfc_runs import evict_outputs
+
+
+CACHE_DIR = "static/images/WFC/cache"
+MAX_CACHE_BYTES = 100 * 1024 * 1024
+
+# id(tiles) -> (tiles, number of tiles, hash), see tileset_hash()
+_hash_cache = {}
+
+
+def tileset_hash(tiles):
+    """
+    Hash the tile names, connections and image files of a tileset.
+    The result is remembered for the tiles list it was computed for, so the
+    shared tilesets of the registry are only hashed once.
+
+    Args:
+        tiles: List of tile dictionaries
+
+    Returns:
+        Hex digest that changes whenever any tile changes
+    """
+    cached = _hash_cache.get(id(tiles))
+    if cached is not None and cached[0] is tiles and cached[1] == len(tiles):
+        return cached[2]
+
+    digest = hashlib.sha256()
+
+    for tile in tiles:
+        digest.update(tile['name'].encode())
+        digest.update(json.dumps(tile.get('connections'), sort_keys=True).encode())
+
+        path = tile.get('path')
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    result = digest.hexdigest()[:16]
+    if len(_hash_cache) >= 8:
+        _hash_cache.clear()
+    _hash_cache[id(tiles)] = (tiles, len(tiles), result)
+    return result
+
+
+def cache_key(seed, tileset_digest, weights, tiles_x, tiles_y, tile_size, **settings):
+    """
+    Build the cache key of a run.
+
+    Args:
+        seed: Seed of the run
+        tileset_digest: Result of tileset_hash()
+        weights: List of the weight of every tile
+        tiles_x: Width of grid
+        tiles_y: Height of grid
+        tile_size: Size of each tile in pixels
+        **settings: Any other solver settings that change the output
+
+    Returns:
+        Hex string naming the cached image
+    """
+    payload = json.dumps({
+        'seed': seed,
+        'tileset': tileset_digest,
+        'weights': list(weights),
+        'grid': [tiles_x, tiles_y],
+        'tile_size': tile_size,
+        'settings': settings
+    }, sort_keys=True)
+
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def get_cached(key, cache_dir=CACHE_DIR):
+    """
+    Look up a cached image.
+
+    Args:
+        key: Result of cache_key()
+        cache_dir: Folder holding the cache
+
+    Returns:
+        Path to the cached image, or None if it is not cached
+    """
+    path = os.path.join(cache_dir, f"{key}.png")
+    if os.path.exists(path):
+        return path
+    return None
+
+
+def get_cached_grid(key, cache_dir=CACHE_DIR):
+    """
+    Look up the cached grid of a city.
+
+    Args:
+        key: Result of cache_key()
+        cache_dir: Folder holding the cache
+
+    Returns:
+        Path to the cached .npz grid, or None if it is not cached
+    """
+    path = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.exists(path):
+        return path
+    return None
+
+
+def get_cached_steps(key, cache_dir=CACHE_DIR):
+    """
+    Look up the cached step log of a city (only 'log' format steps are
+    cached, see classes/wfc_steplog.py).
+
+    Args:
+        key: Result of cache_key()
+        cache_dir: Folder holding the cache
+
+    Returns:
+        Tuple of (path to the cached step log, path to the cached tile
+        atlas), or None if they are not cached
+    """
+    paths = (os.path.join(cache_dir, f"{key}.wfclog"), os.path.join(cache_dir, f"{key}.atlas.png"))
+    if all(os.path.exists(path) for path in paths):
+        return paths
+    return None
+
+
+def _store_file(source, path):
+    # Copy to a temporary name first so readers never see a partial file; the
+    # name is unique per call, threads of one process may store the same key
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def store(key, image_path, grid_path=None, cache_dir=CACHE_DIR, steps_dir=None):
+    """
+    Add a generated image, and optionally its solved grid and step log, to
+    the cache.
+
+    Args:
+        key: Result of cache_key()
+        image_path: Path of the image to cache
+        grid_path: Optional path of the .npz grid saved with the image
+        cache_dir: Folder holding the cache
+        steps_dir: Optional steps/ folder of the run; its step log and tile
+                   atlas are cached if the run wrote them
+
+    Returns:
+        Path to the cached copy of the image
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.png")
+
+    if grid_path is not None and os.path.exists(grid_path):
+        _store_file(grid_path, os.path.join(cache_dir, f"{key}.npz"))
+    if steps_dir is not None:
+        from classes.wfc_steplog import ATLAS_NAME, LOG_NAME
+
+        if os.path.exists(os.path.join(steps_dir, LOG_NAME)):
+            _store_file(os.path.join(steps_dir, ATLAS_NAME), os.path.join(cache_dir, f"{key}.atlas.png"))
+            _store_file(os.path.join(steps_dir, LOG_NAME), os.path.join(cache_dir, f"{key}.wfclog"))
+    _store_file(image_path, path)
+
+    # Keep the cache bounded by size, not age: old seeds stay valid forever
+    evict_outputs(cache_dir, max_age=None, max_entries=None, max_bytes=MAX_CACHE_BYTES, min_age=0)
+    return path
@@ -0,0 +1,204 @@
+"""
+Chunked Wave Function Collapse for maps that are too big to solve at once
+
+The map is split into fixed-size chunks that are solved one after another.
+Each chunk takes the already collapsed edge of the chunk above it and the
+chunk to its left as boundary constraints, so the roads line up across the
+seams. Finished chunks are written straight to disk as image tiles in a
+slippy-map z/x/y layout, and only the edges needed by the next chunks are
+kept in memory.
+"""
+
+from PIL import Image
+import numpy as np
+import json
+import math
+import os
+import random
+
+from classes.wfc import (
+    TILE_CONFIGS,
+    DIRECTIONS,
+    Contradiction,
+    Wave,
+    collapse_wfc,
+    render_tile_grid,
+)
+from classes.wfc_registry import get_tileset
+
+
+def constrain_chunk_edges(wave, rules, top_edge=None, left_edge=None, bottom_edge=None, right_edge=None):
+    """
+    Restrict the border cells of a chunk to tiles that fit the chunks
+    that were already solved around it.
+
+    Args:
+        wave: Wave of the chunk (nothing collapsed yet)
+        rules: Compiled adjacency masks from compile_adjacency_rules()
+        top_edge: Tile indices of the row just above the chunk, or None
+        left_edge: Tile indices of the column just left of the chunk, or None
+        bottom_edge: Tile indices of the row just below the chunk, or None
+        right_edge: Tile indices of the column just right of the chunk, or None
+                    (-1 entries mean the neighboring cell was never solved)
+
+    Raises:
+        Contradiction: If the border cells cannot satisfy every neighbor
+    """
+    # Each edge, with the direction from the neighbor to the chunk cell
+    edges = [
+        (top_edge, 'down', lambda i: (i, 0)),
+        (left_edge, 'right', lambda i: (0, i)),
+        (bottom_edge, 'up', lambda i: (i, wave.tiles_y - 1)),
+        (right_edge, 'left', lambda i: (wave.tiles_x - 1, i)),
+    ]
+
+    for edge, direction, cell in edges:
+        if edge is None:
+            continue
+        d = DIRECTIONS.index(direction)
+        for i, tile in enumerate(edge):
+            if tile >= 0:
+                # Tiles allowed next to the neighboring tile, on this cell's side
+                x, y = cell(i)
+                wave.constrain(x, y, rules[d, tile])
+
+
+def render_chunk(tile_indices, tiles, tile_size, chunk_size):
+    """
+    Render a solved chunk to an image of chunk_size x chunk_size tiles.
+    Partial chunks on the map edge are padded with white so every image
+    tile has the same size.
+
+    Args:
+        tile_indices: 2D array of tile indices (-1 = unsolved)
+        tiles: List of tile dictionaries
+        tile_size: Size of each tile in pixels
+        chunk_size: Width and height of a full chunk in tiles
+
+    Returns:
+        PIL Image of the chunk
+    """
+    img_size = chunk_size * tile_size
+    img = Image.new('RGB', (img_size, img_size), color='white')
+    img.paste(render_tile_grid(tile_indices, tiles, tile_size), (0, 0))
+
+    return img
+
+
+def generate_chunked(tiles_x, tiles_y, chunk_size=32, tile_size=16, output_dir=None, zoom=None, strategy='backtrack', tile_configs=TILE_CONFIGS, seed=None):
+    """
+    Generate a city of tiles_x x tiles_y tiles chunk by chunk.
+
+    Chunks are solved in row-major order and saved as
+    output_dir/{zoom}/{chunk x}/{chunk y}.png as soon as they are done.
+    Only the bottom row of the previous chunk row and the right column of
+    the previous chunk are kept, so memory does not grow with the map size
+    (apart from one row of tile indices as wide as the map).
+
+    Chunks on the same anti-diagonal (chunk x + chunk y) only depend on
+    chunks of earlier diagonals, so they could be solved in parallel.
+
+    Args:
+        tiles_x: Width of the map in tiles
+        tiles_y: Height of the map in tiles
+        chunk_size: Width and height of a chunk in tiles
+        tile_size: Size of each tile in pixels
+        output_dir: Folder for the z/x/y image tiles and metadata.json
+                    (defaults to a new run folder under static/images/WFC/runs,
+                    evicted like the other runs)
+        zoom: Zoom level to store the chunks under (defaults to the smallest
+              level whose 2^zoom x 2^zoom tile grid holds every chunk)
+        strategy: Contradiction recovery used for each chunk
+        tile_configs: Tile configuration dictionary
+        seed: Seed for the whole map (None = unseeded); chunks are solved in
+              a fixed order, so the same seed gives the same map
+
+    Returns:
+        Dictionary with the map metadata (also saved as metadata.json)
+    """
+    if output_dir is None:
+        from classes.wfc_runs import RUNS_DIR, evict_outputs, finish_run, new_run_dir
+
+        evict_outputs(RUNS_DIR)
+        run_dir = new_run_dir(seed)
+        # The folder stays marked as running (safe from eviction) until every chunk is written
+        try:
+            return generate_chunked(tiles_x, tiles_y, chunk_size, tile_size, run_dir, zoom, strategy,
+                                    tile_configs, seed)
+        finally:
+            finish_run(run_dir)
+
+    rng = random.Random(seed)
+
+    tiles, _, rules = get_tileset(tile_configs)
+
+    chunks_x = math.ceil(tiles_x / chunk_size)
+    chunks_y = math.ceil(tiles_y / chunk_size)
+    if zoom is None:
+        zoom = math.ceil(math.log2(max(chunks_x, chunks_y, 1)))
+
+    print(f"\n=== Chunked WFC: {tiles_x}x{tiles_y} tiles in {chunks_x}x{chunks_y} chunks of {chunk_size} ===")
+
+    # Bottom row of the chunk row above, for the whole map width
+    bottom_edge = np.full(tiles_x, -1, dtype=np.int32)
+    failed_chunks = 0
+
+    for cy in range(chunks_y):
+        # Right column of the chunk to the left
+        right_edge = None
+
+        for cx in range(chunks_x):
+            x0 = cx * chunk_size
+            y0 = cy * chunk_size
+            width = min(chunk_size, tiles_x - x0)
+            height = min(chunk_size, tiles_y - y0)
+
+            wave = Wave(width, height, rules)
+            top_edge = bottom_edge[x0:x0 + width] if cy > 0 else None
+
+            try:
+                constrain_chunk_edges(wave, rules, top_edge, right_edge)
+                result = collapse_wfc(wave, tiles, tile_size=tile_size, strategy=strategy, verbose=False, rng=rng)
+                solved = result['contradiction'] is None
+            except Contradiction as e:
+                print(f"ERROR: {e}")
+                solved = False
+            if not solved:
+                failed_chunks += 1
+                print(f"  WARNING: chunk ({cx},{cy}) could not be fully solved")
+
+            # Keep the edges the next chunks depend on
+            tile_indices = wave.tile_index
+            bottom_edge[x0:x0 + width] = tile_indices[-1]
+            right_edge = tile_indices[:, -1].copy()
+
+            # Stream the finished chunk to disk
+            chunk_dir = os.path.join(output_dir, str(zoom), str(cx))
+            os.makedirs(chunk_dir, exist_ok=True)
+            render_chunk(tile_indices, tiles, tile_size, chunk_size).save(os.path.join(chunk_dir, f"{cy}.png"))
+
+        print(f"  Finished chunk row {cy + 1}/{chunks_y}")
+
+    metadata = {
+        'tiles_x': tiles_x,
+        'tiles_y': tiles_y,
+        'chunk_size': chunk_size,
+        'tile_size': tile_size,
+        'chunks_x': chunks_x,
+        'chunks_y': chunks_y,
+        'zoom': zoom,
+        'output_dir': output_dir,
+        'seed': seed,
+        'failed_chunks': failed_chunks,
+        'tiles': [tile['name'] for tile in tiles]
+    }
+    with open(os.path.join(output_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    print(f"Saved {chunks_x * chunks_y} chunks to {output_dir}/{zoom}/")
+    return metadata
+
+
+if __name__ == "__main__":
+    # Generate a 256x256 tile city as 8x8 chunks
+    generate_chunked(256, 256, chunk_size=32)
@@ -0,0 +1,98 @@
+"""
+Compact storage of solved WFC grids
+
+A solved city is fully described by its grid of tile indices, so it is
+saved as a small compressed .npz file: the indices as uint8 (uint16 for
+tilesets of 256+ tiles) plus the seed, tileset hash, tile names and weights
+as metadata. The city can then be rendered again at any scale without
+solving it again.
+"""
+
+import json
+import numpy as np
+
+from classes.wfc_cache import tileset_hash
+
+
+GRID_NAME = "city.npz"
+
+
+def save_grid(path, tile_indices, tiles, seed=None, weights=None):
+    """
+    Save a solved grid.
+
+    Args:
+        path: Path of the .npz file to write
+        tile_indices: 2D array of tile indices (-1 = uncollapsed)
+        tiles: List of tile dictionaries the grid was solved with
+        seed: Seed of the run, if known
+        weights: List of the weight of every tile, if known
+    """
+    # Store -1 (uncollapsed) as the largest value of the unsigned type
+    dtype = np.uint8 if len(tiles) < 255 else np.uint16
+    empty = np.iinfo(dtype).max
+    grid = np.where(tile_indices >= 0, tile_indices, empty).astype(dtype)
+
+    metadata = {
+        'seed': seed,
+        'tileset': tileset_hash(tiles),
+        'tiles': [tile['name'] for tile in tiles],
+        'weights': None if weights is None else [float(w) for w in weights]
+    }
+
+    with open(path, "wb") as f:
+        np.savez_compressed(f, grid=grid, metadata=np.frombuffer(json.dumps(metadata).encode(), dtype=np.uint8))
+
+
+def load_grid(path):
+    """
+    Load a grid saved with save_grid().
+
+    Args:
+        path: Path of the .npz file
+
+    Returns:
+        Tuple of (2D int32 array of tile indices with -1 = uncollapsed,
+        metadata dictionary)
+    """
+    with np.load(path) as data:
+        grid = data['grid']
+        metadata = json.loads(data['metadata'].tobytes().decode())
+
+    tile_index = grid.astype(np.int32)
+    tile_index[grid == np.iinfo(grid.dtype).max] = -1
+    return tile_index, metadata
+
+
+def render_grid_file(path, tiles, tile_size=16, scale=2, output_path=None):
+    """
+    Render a saved grid again, at any integer scale.
+
+    Args:
+        path: Path of the .npz file
+        tiles: List of tile dictionaries (must be the tileset the grid was
+               solved with)
+        tile_size: Size of each tile in pixels
+        scale: Integer factor to scale the image up by
+        output_path: Optional path to save the image to
+
+    Returns:
+        PIL Image of the city
+
+    Raises:
+        ValueError: If the tiles are not the ones the grid was saved with
+    """
+    from classes.wfc import render_tile_grid
+
+    tile_index, metadata = load_grid(path)
+
+    names = [tile['name'] for tile in tiles]
+    if names != metadata['tiles']:
+        raise ValueError(f"{path} was solved with a different tileset")
+    if tileset_hash(tiles) != metadata['tileset']:
+        print(f"WARNING: the tile images changed since {path} was saved")
+
+    img = render_tile_grid(tile_index, tiles, tile_size, scale=scale)
+    if output_path is not None:
+        img.save(output_path)
+    return img
@@ -0,0 +1,280 @@
+"""
+Rerolling a region of a solved WFC grid
+
+Instead of generating the whole city again, only the cells of a rectangle
+(or any mask) are un-collapsed and solved again. The wave only covers the
+bounding box of the region: cells of the box outside the region keep their
+tile, and the border of the box is constrained by the fixed cells around it
+(the same way chunks are stitched together in classes/wfc_chunks.py), so
+the new tiles always connect to the rest of the city. Separate parts of a
+mask are solved one after another, each in its own box.
+
+Only the boxes are rendered again and pasted into the existing image,
+so both the solve and the render scale with the edited area, not the map.
+"""
+
+import os
+import random
+
+import numpy as np
+from PIL import Image
+
+from classes.wfc import Contradiction, Wave, collapse_wfc
+from classes.wfc_chunks import constrain_chunk_edges
+from classes.wfc_grid import load_grid, save_grid
+
+
+def region_mask(shape, rect=None, mask=None):
+    """
+    Build the boolean mask of the cells to reroll.
+
+    Args:
+        shape: (tiles_y, tiles_x) of the grid
+        rect: Optional (x, y, width, height) rectangle in tiles; parts
+              outside the grid are ignored
+        mask: Optional boolean array of the grid's shape (combined with
+              rect if both are given)
+
+    Returns:
+        Boolean array of the grid's shape
+
+    Raises:
+        ValueError: If neither rect nor mask is given, the mask has the wrong
+                    shape, or the region holds no cells
+    """
+    if rect is None and mask is None:
+        raise ValueError("A rectangle or a mask is required")
+
+    region = np.zeros(shape, dtype=bool)
+    if rect is not None:
+        x, y, width, height = (int(v) for v in rect)
+        region[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)] = True
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != tuple(shape):
+            raise ValueError(f"Mask has shape {mask.shape}, the grid is {tuple(shape)}")
+        region = region | mask if rect is not None else mask.copy()
+
+    if not region.any():
+        raise ValueError("The region does not contain any cell of the grid")
+    return region
+
+
+def region_components(region):
+    """
+    Split a region into its 4-connected parts, so separate spots of a mask
+    are each solved in their own small box instead of one box spanning them.
+
+    Args:
+        region: Boolean mask of the cells to reroll
+
+    Returns:
+        List of boolean masks, one per connected part
+    """
+    from collections import deque
+
+    tiles_y, tiles_x = region.shape
+    label = np.full(region.shape, -1, dtype=np.int32)
+    components = []
+
+    for start in zip(*np.nonzero(region)):
+        if label[start] >= 0:
+            continue
+        component = np.zeros(region.shape, dtype=bool)
+        label[start] = len(components)
+        queue = deque([start])
+        while queue:
+            y, x = queue.popleft()
+            component[y, x] = True
+            for ny, nx in ((y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)):
+                if 0 <= ny < tiles_y and 0 <= nx < tiles_x and region[ny, nx] and label[ny, nx] < 0:
+                    label[ny, nx] = len(components)
+                    queue.append((ny, nx))
+        components.append(component)
+
+    return components
+
+
+def region_bounds(region):
+    """
+    Args:
+        region: Boolean mask of the cells to reroll
+
+    Returns:
+        (x, y, width, height) of the bounding box of the region
+    """
+    ys = np.flatnonzero(region.any(axis=1))
+    xs = np.flatnonzero(region.any(axis=0))
+    return int(xs[0]), int(ys[0]), int(xs[-1] - xs[0] + 1), int(ys[-1] - ys[0] + 1)
+
+
+def reroll_region(tile_index, tiles, rules, region, seed=None, heuristic='count', strategy='backtrack',
+                  max_backtracks=1000, max_restarts=5, weights=None):
+    """
+    Solve the cells of a region of a solved grid again.
+
+    Args:
+        tile_index: 2D array of tile indices of the solved grid (-1 = unsolved)
+        tiles: List of tile dictionaries the grid was solved with
+        rules: Compiled adjacency masks of those tiles
+        region: Boolean mask of the cells to reroll (see region_mask());
+                unsolved cells inside its bounding box are solved too
+        seed: Seed of the reroll (None = unseeded)
+        heuristic: Entropy heuristic for picking the next cell
+        strategy: Contradiction recovery ('stop', 'backtrack' or 'restart')
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+        weights: Optional dictionary of tile name -> weight
+
+    Returns:
+        Tuple of (new 2D array of tile indices, (x, y, width, height) of the
+        rerolled box, collapse_wfc() result dictionary). If the region could
+        not be solved the grid is returned unchanged and the result's
+        'contradiction' is set.
+    """
+    x0, y0, width, height = region_bounds(region)
+    x1, y1 = x0 + width, y0 + height
+    tiles_y, tiles_x = tile_index.shape
+
+    box = tile_index[y0:y1, x0:x1]
+    fixed = ~region[y0:y1, x0:x1] & (box >= 0)
+
+    print(f"Rerolling {int(np.count_nonzero(~fixed))} cells in the {width}x{height} box at ({x0},{y0})")
+
+    wave = Wave(width, height, rules)
+    result = {'iterations': 0, 'contradiction': None, 'contradictions': 0, 'backtracks': 0, 'restarts': 0}
+    try:
+        # The cells just outside the box are fixed
+        constrain_chunk_edges(wave, rules,
+                              top_edge=tile_index[y0 - 1, x0:x1] if y0 > 0 else None,
+                              left_edge=tile_index[y0:y1, x0 - 1] if x0 > 0 else None,
+                              bottom_edge=tile_index[y1, x0:x1] if y1 < tiles_y else None,
+                              right_edge=tile_index[y0:y1, x1] if x1 < tiles_x else None)
+
+        # So are the cells of the box outside the region
+        for y, x in zip(*np.nonzero(fixed)):
+            wave.collapse(int(x), int(y), int(box[y, x]))
+
+        result = collapse_wfc(wave, tiles, heuristic=heuristic, strategy=strategy,
+                              max_backtracks=max_backtracks, max_restarts=max_restarts, verbose=False,
+                              rng=random.Random(seed), weights=weights)
+    except Contradiction as e:
+        print(f"ERROR: {e}")
+        result['contradiction'] = (e.x + x0, e.y + y0)
+
+    if result['contradiction'] is not None:
+        print("  WARNING: the region could not be solved, keeping the old tiles")
+        return tile_index, (x0, y0, width, height), result
+
+    new_index = tile_index.copy()
+    new_index[y0:y1, x0:x1] = np.where(fixed, box, wave.tile_index)
+    return new_index, (x0, y0, width, height), result
+
+
+def patch_image(image_path, tile_index, tiles, tile_size, boxes, scale=2):
+    """
+    Render some boxes of the grid again and paste them into an existing image.
+
+    Args:
+        image_path: Path of the image of the whole grid (rendered at scale)
+        tile_index: 2D array of tile indices of the whole grid
+        tiles: List of tile dictionaries
+        tile_size: Size of each tile in pixels
+        boxes: List of (x, y, width, height) boxes in tiles
+        scale: Integer factor the image was scaled up by
+    """
+    from classes.wfc_render import get_tile_atlas
+
+    atlas = get_tile_atlas(tiles, tile_size)
+    with Image.open(image_path) as img:
+        img = img.convert('RGB')
+
+    for x, y, width, height in boxes:
+        patch = atlas.render(tile_index[y:y + height, x:x + width], scale=scale, placeholder=False)
+        img.paste(patch, (x * tile_size * scale, y * tile_size * scale))
+
+    # Write to a temporary name first so readers never see a partial file
+    tmp_path = f"{image_path}.{os.getpid()}.tmp.png"
+    img.save(tmp_path)
+    os.replace(tmp_path, image_path)
+
+
+def reroll_grid_file(grid_path, tiles, rules, tile_size=16, rect=None, mask=None, seed=None, image_path=None,
+                     scale=2, heuristic='count', strategy='backtrack', max_backtracks=1000, max_restarts=5):
+    """
+    Reroll a region of a grid saved with save_grid(), in place.
+
+    The grid file is updated with the new tiles, and if image_path is given
+    the rerolled box is redrawn in that image. The weights saved with the
+    grid are used again, so the region matches the rest of the city.
+
+    Args:
+        grid_path: Path of the .npz grid file
+        tiles: List of tile dictionaries (must be the tileset the grid was
+               solved with)
+        rules: Compiled adjacency masks of those tiles
+        tile_size: Size of each tile in pixels
+        rect: Optional (x, y, width, height) rectangle in tiles
+        mask: Optional boolean mask of the grid's shape
+        seed: Seed of the reroll (a random seed is picked if None)
+        image_path: Optional image of the grid to update
+        scale: Integer factor the image was scaled up by
+        heuristic: Entropy heuristic for picking the next cell
+        strategy: Contradiction recovery ('stop', 'backtrack' or 'restart')
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+
+    Returns:
+        Dictionary with the 'seed' of the reroll, the rerolled 'boxes'
+        (x, y, width, height of each connected part of the region), whether
+        every part was 'solved' and the number of 'changed' cells. Parts
+        that could not be solved keep their old tiles.
+
+    Raises:
+        ValueError: If the tiles are not the ones the grid was saved with or
+                    the region is invalid
+    """
+    tile_index, metadata = load_grid(grid_path)
+
+    names = [tile['name'] for tile in tiles]
+    if names != metadata['tiles']:
+        raise ValueError(f"{grid_path} was solved with a different tileset")
+
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+
+    weights = None
+    if metadata['weights'] is not None:
+        weights = dict(zip(metadata['tiles'], metadata['weights']))
+
+    rng = random.Random(seed)
+    region = region_mask(tile_index.shape, rect, mask)
+
+    # Each part is solved against the tiles of the parts solved before it
+    new_index = tile_index
+    boxes = []
+    solved = True
+    for component in region_components(region):
+        new_index, bounds, result = reroll_region(new_index, tiles, rules, component, rng.randrange(2 ** 32),
+                                                  heuristic=heuristic, strategy=strategy,
+                                                  max_backtracks=max_backtracks, max_restarts=max_restarts,
+                                                  weights=weights)
+        boxes.append(bounds)
+        solved = solved and result['contradiction'] is None
+    changed = int(np.count_nonzero(new_index != tile_index))
+
+    if changed:
+        tmp_path = f"{grid_path}.{os.getpid()}.tmp.npz"
+        save_grid(tmp_path, new_index, tiles, metadata['seed'], metadata['weights'])
+        os.replace(tmp_path, grid_path)
+
+        if image_path is not None:
+            patch_image(image_path, new_index, tiles, tile_size, boxes, scale)
+    print(f"Rerolled {changed} cells of {grid_path} in {len(boxes)} part(s) (seed {seed})")
+
+    return {
+        'seed': seed,
+        'boxes': boxes,
+        'solved': solved,
+        'changed': changed
+    }
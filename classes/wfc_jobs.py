@@ -0,0 +1,233 @@
+"""
+Background generation jobs for the WFC web API
+
+A job runs setup() on a small pool of worker threads instead of the Flask
+request thread. Clients create a job, then poll its status or stream its
+progress as Server-Sent Events, and fetch the image once it is done.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+
+from classes.tilesets import load_tileset
+from classes.wfc import setup
+from classes.wfc_registry import get_tileset
+
+
+class Job:
+    """
+    State of one generation job. Updated by the worker thread and read by
+    request threads, so every change goes through update(), which also
+    wakes up anyone waiting for progress.
+    """
+
+    def __init__(self, job_id, params):
+        self.id = job_id
+        self.params = params
+        self.status = 'queued'
+        self.progress = None
+        self.image_path = None
+        self.error = None
+        self.created = time.time()
+        self.version = 0
+        self._changed = threading.Condition()
+        self._edit_lock = threading.Lock()
+
+    def update(self, **fields):
+        """Set some fields and notify waiting streams."""
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait(self, version, timeout):
+        """
+        Wait until the job changes past the given version.
+
+        Args:
+            version: Last version the caller has seen
+            timeout: Seconds to wait at most
+
+        Returns:
+            The current version
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def to_dict(self):
+        """JSON friendly summary of the job."""
+        with self._changed:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'params': self.params,
+                'progress': self.progress,
+                'error': self.error
+            }
+
+
+class JobManager:
+    """
+    Runs WFC jobs on a fixed number of worker threads and keeps the
+    finished ones around for a while so clients can fetch the result.
+    """
+
+    def __init__(self, output_dir="static/images/WFC/jobs", workers=2, max_jobs=100):
+        """
+        Args:
+            output_dir: Folder for the job images (one subfolder per job)
+            workers: Number of jobs that may run at the same time
+            max_jobs: Number of jobs to remember; the oldest finished jobs
+                      are dropped first
+        """
+        self.output_dir = output_dir
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wfc-job")
+
+    def submit(self, tiles_x=10, tiles_y=10, tile_size=16, seed=None, weights=None, tileset=None, model='tiled'):
+        """
+        Create a job and queue it.
+
+        Args:
+            tiles_x: Width of the city in tiles
+            tiles_y: Height of the city in tiles
+            tile_size: Size of each tile in pixels
+            seed: Seed of the city (random if None)
+            weights: Optional dictionary of tile name -> weight
+            tileset: Optional tileset package to use (its own tile size
+                     replaces tile_size)
+            model: 'tiled' or 'overlapping' (learns from the sample image)
+
+        Returns:
+            The new Job
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+
+        params = {
+            'tiles_x': tiles_x,
+            'tiles_y': tiles_y,
+            'tile_size': tile_size,
+            'seed': seed,
+            'weights': weights,
+            'tileset': tileset,
+            'model': model
+        }
+        job = Job(uuid.uuid4().hex, params)
+
+        with self._lock:
+            self._forget_old_jobs()
+            self.jobs[job.id] = job
+
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """
+        Returns:
+            The Job with this id, or None if it is unknown
+        """
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def reroll(self, job, rect=None, mask=None, seed=None):
+        """
+        Solve a region of a finished job's city again and update its grid
+        and image in place (see classes/wfc_inpaint.py).
+
+        Args:
+            job: Finished Job of the tiled model
+            rect: Optional (x, y, width, height) rectangle in tiles
+            mask: Optional boolean mask of the grid's shape
+            seed: Seed of the reroll (random if None)
+
+        Returns:
+            Dictionary from reroll_grid_file()
+
+        Raises:
+            ValueError: If the job has no saved grid or the region is invalid
+        """
+        from classes.wfc_grid import GRID_NAME
+        from classes.wfc_inpaint import reroll_grid_file
+
+        if job.params['model'] != 'tiled':
+            raise ValueError("Only cities of the tiled model can be rerolled")
+        grid_path = os.path.join(os.path.dirname(job.image_path), GRID_NAME)
+        if not os.path.exists(grid_path):
+            raise ValueError("This city has no saved grid to reroll")
+
+        if job.params['tileset'] is not None:
+            tiles, rules, tile_size = load_tileset(job.params['tileset'])
+        else:
+            tiles, _, rules = get_tileset()
+            tile_size = job.params['tile_size']
+
+        # One edit at a time per city, so rerolls never overwrite each other
+        with job._edit_lock:
+            return reroll_grid_file(grid_path, tiles, rules, tile_size, rect=rect, mask=mask, seed=seed,
+                                    image_path=job.image_path)
+
+    def _forget_old_jobs(self):
+        """Drop the oldest finished jobs, and their images, once more than max_jobs are kept."""
+        finished = sorted((job for job in self.jobs.values() if job.status in ('done', 'failed')),
+                          key=lambda job: job.created)
+        while len(self.jobs) >= self.max_jobs and finished:
+            job = finished.pop(0)
+            del self.jobs[job.id]
+            shutil.rmtree(os.path.join(self.output_dir, job.id), ignore_errors=True)
+
+    def _run(self, job):
+        """Worker thread: run one job and record the outcome."""
+        params = job.params
+        job.update(status='running', progress={'iteration': 0, 'collapsed': 0,
+                                                'total': params['tiles_x'] * params['tiles_y'],
+                                                'average_entropy': None})
+        try:
+            image_path = setup(tile_size=params['tile_size'],
+                               output_width=params['tiles_x'] * params['tile_size'],
+                               output_height=params['tiles_y'] * params['tile_size'],
+                               seed=params['seed'], weights=params['weights'], tileset=params['tileset'],
+                               model=params['model'],
+                               output_dir=os.path.join(self.output_dir, job.id), save_to_gallery=False,
+                               progress_callback=lambda progress: job.update(progress=progress))
+            job.update(status='done', image_path=image_path)
+        except Exception as e:
+            print(f"WFC job {job.id} failed: {e}")
+            job.update(status='failed', error=str(e))
+
+    def stream(self, job, heartbeat=15):
+        """
+        Server-Sent Events for a job: one 'progress' event whenever the job
+        changes, then a final 'done' or 'failed' event.
+
+        Args:
+            job: Job to follow
+            heartbeat: Seconds between keep-alive comments while nothing changes
+
+        Yields:
+            SSE formatted strings
+        """
+        version = None
+        while True:
+            current = job.wait(version, heartbeat)
+            if current == version:
+                # Keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            version = current
+
+            state = job.to_dict()
+            event = state['status'] if state['status'] in ('done', 'failed') else 'progress'
+            yield f"event: {event}\ndata: {json.dumps(state)}\n\n"
+            if event != 'progress':
+                return
@@ -0,0 +1,426 @@
+"""
+Overlapping model of Wave Function Collapse
+
+Instead of hand-made tiles with connections, the overlapping model learns
+from a sample image: every N x N window of the sample is a pattern, and two
+patterns may be neighbors if they agree on the pixels where they overlap.
+Each cell of the output gets one pattern and shows its top-left pixel, so
+the output looks locally like the sample everywhere.
+
+Patterns are solved on the same Wave / collapse_wfc() core as the tiled
+model: each pattern becomes a "tile" whose weight is how often it occurs
+in the sample, and the overlap rules are compiled to the same (4, T, T)
+masks as compile_adjacency_rules() produces.
+
+Extraction is vectorized: the sample is mapped to palette indices, every
+window is taken at once with sliding_window_view, and windows are
+deduplicated by a packed integer key (the pattern's hash) with np.unique.
+"""
+
+import os
+
+from PIL import Image
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from classes.wfc import DIRECTIONS, Wave, analyze_entropy, collapse_wfc
+from classes.wfc_render import PLACEHOLDER_COLOR
+
+
+DEFAULT_SAMPLE = "static/images/WFC/test.png"
+MAX_SAMPLE_SIZE = 64  # Samples are reduced to at most this many pixels per side
+
+
+def native_pixel_size(sample):
+    """
+    Size of the "big pixels" of an upscaled pixel art image: the largest
+    block size that every color change lines up with.
+
+    Args:
+        sample: (height, width, 3) uint8 array
+
+    Returns:
+        Tuple of (block width, block height) in pixels
+    """
+    sizes = []
+    for axis in (1, 0):
+        length = sample.shape[axis]
+        before = sample.take(np.arange(length - 1), axis=axis)
+        after = sample.take(np.arange(1, length), axis=axis)
+        changes = np.nonzero(np.any(before != after, axis=(1 - axis, 2)))[0] + 1
+        sizes.append(int(np.gcd.reduce(np.append(changes, length))))
+    return sizes[0], sizes[1]
+
+
+def load_sample(path, max_size=MAX_SAMPLE_SIZE):
+    """
+    Load a sample image and reduce it to a small grid of pixels. Upscaled
+    pixel art is first shrunk back to its native pixels, then anything
+    still larger than max_size is shrunk by a whole factor (nearest
+    neighbor, so no new colors appear).
+
+    Args:
+        path: Path of the sample image
+        max_size: Largest width/height of the reduced sample
+
+    Returns:
+        (height, width, 3) uint8 array
+    """
+    img = Image.open(path).convert('RGB')
+    sample = np.asarray(img)
+
+    block_w, block_h = native_pixel_size(sample)
+    if block_w > 1 or block_h > 1:
+        sample = sample[::block_h, ::block_w]
+
+    factor = -(-max(sample.shape[:2]) // max_size)  # Ceiling division
+    if factor > 1:
+        sample = sample[::factor, ::factor]
+
+    print(f"Sample {path}: {img.width}x{img.height} -> {sample.shape[1]}x{sample.shape[0]} pixels")
+    return np.ascontiguousarray(sample)
+
+
+def _pattern_variants(windows, symmetry):
+    """
+    The windows plus their rotated/reflected copies, in the usual order
+    (original, reflected, rotated, rotated + reflected, ...).
+
+    Args:
+        windows: (M, n, n) array of windows
+        symmetry: Number of the 8 variants to use (1 = only the original)
+
+    Returns:
+        (M * symmetry, n, n) array
+    """
+    variants = [windows]
+    rotated = windows
+    while len(variants) < symmetry:
+        variants.append(rotated[:, :, ::-1])
+        if len(variants) == symmetry:
+            break
+        rotated = np.rot90(rotated, axes=(1, 2))
+        variants.append(rotated)
+    return np.concatenate(variants[:symmetry])
+
+
+def _unique_rows(rows, n_colors):
+    """
+    Deduplicate rows of palette indices. Rows are packed into one uint64
+    key each (a collision-free hash) when they fit, otherwise compared as
+    whole rows.
+
+    Args:
+        rows: (M, k) integer array
+        n_colors: Number of palette colors
+
+    Returns:
+        Tuple of (index of the first occurrence of every unique row,
+        unique id of every row, number of occurrences of every unique row)
+    """
+    bits = max(1, int(n_colors - 1).bit_length())
+    if bits * rows.shape[1] <= 64:
+        shifts = np.arange(rows.shape[1], dtype=np.uint64) * np.uint64(bits)
+        keys = np.bitwise_or.reduce(rows.astype(np.uint64) << shifts, axis=1)
+        _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    else:
+        _, first, inverse, counts = np.unique(rows, axis=0, return_index=True, return_inverse=True,
+                                              return_counts=True)
+    return first, inverse.reshape(-1), counts
+
+
+def extract_patterns(sample, n=3, periodic=True, symmetry=1):
+    """
+    Extract every n x n pattern of a sample and count how often it occurs.
+
+    Args:
+        sample: (height, width, 3) uint8 array
+        n: Pattern size
+        periodic: Treat the sample as wrapping around at its edges, so
+                  every pixel starts a pattern
+        symmetry: Number of rotated/reflected variants of each window to
+                  add (1-8)
+
+    Returns:
+        Tuple of (patterns as a (T, n, n) array of palette indices,
+        pattern counts as a (T,) array, palette as a (colors, 3) array)
+    """
+    if not 1 <= symmetry <= 8:
+        raise ValueError("symmetry must be between 1 and 8")
+
+    # Palette indices instead of RGB triples
+    packed = (sample[..., 0].astype(np.uint32) << 16) | (sample[..., 1].astype(np.uint32) << 8) | sample[..., 2]
+    colors, indices = np.unique(packed, return_inverse=True)
+    indices = indices.reshape(packed.shape).astype(np.uint16)
+    palette = np.stack([(colors >> 16) & 255, (colors >> 8) & 255, colors & 255], axis=1).astype(np.uint8)
+
+    if periodic:
+        indices = np.pad(indices, ((0, n - 1), (0, n - 1)), mode='wrap')
+    windows = sliding_window_view(indices, (n, n)).reshape(-1, n, n)
+    windows = _pattern_variants(windows, symmetry)
+
+    first, _, counts = _unique_rows(windows.reshape(len(windows), -1), len(palette))
+    patterns = np.ascontiguousarray(windows[first])
+
+    print(f"Extracted {len(patterns)} unique {n}x{n} patterns from {len(windows)} windows "
+          f"({len(palette)} colors)")
+    return patterns, counts, palette
+
+
+def pattern_rules(patterns, n_colors):
+    """
+    Compile which patterns may be neighbors: pattern b may be right of
+    pattern a if a without its first column equals b without its last
+    column (and likewise for the other directions). The overlaps are
+    deduplicated to ids, so each direction is a single comparison of two
+    id vectors.
+
+    Args:
+        patterns: (T, n, n) array of palette indices
+        n_colors: Number of palette colors
+
+    Returns:
+        NumPy bool array of shape (4, T, T), rules[d, a, b] = b may be the
+        neighbor of a in direction DIRECTIONS[d]
+    """
+    count = len(patterns)
+    rules = np.zeros((len(DIRECTIONS), count, count), dtype=bool)
+
+    def overlap_ids(first, second):
+        rows = np.concatenate([first.reshape(count, -1), second.reshape(count, -1)])
+        ids = _unique_rows(rows, n_colors)[1]
+        return ids[:count], ids[count:]
+
+    a, b = overlap_ids(patterns[:, :, 1:], patterns[:, :, :-1])
+    right = a[:, None] == b[None, :]
+    a, b = overlap_ids(patterns[:, 1:, :], patterns[:, :-1, :])
+    down = a[:, None] == b[None, :]
+
+    rules[DIRECTIONS.index('right')] = right
+    rules[DIRECTIONS.index('left')] = right.T
+    rules[DIRECTIONS.index('down')] = down
+    rules[DIRECTIONS.index('up')] = down.T
+    return rules
+
+
+def pattern_tiles(patterns, counts, palette, pixel_size=1):
+    """
+    Tile dictionaries for collapse_wfc(): every pattern is shown as a
+    block of its top-left pixel's color and weighted by its count.
+
+    Args:
+        patterns: (T, n, n) array of palette indices
+        counts: (T,) array of pattern counts
+        palette: (colors, 3) array
+        pixel_size: Size of the block of each pattern in pixels
+
+    Returns:
+        List of tile dictionaries
+    """
+    tiles = []
+    for index, (pattern, count) in enumerate(zip(patterns, counts)):
+        color = tuple(int(c) for c in palette[pattern[0, 0]])
+        tiles.append({
+            'index': index,
+            'name': f"pattern_{index}",
+            'image': Image.new('RGB', (pixel_size, pixel_size), color=color),
+            'connections': None,
+            'description': f"{patterns.shape[1]}x{patterns.shape[1]} pattern seen {int(count)} times",
+            'weight': float(count)
+        })
+    return tiles
+
+
+def render_patterns(tile_index, patterns, palette, placeholder=PLACEHOLDER_COLOR):
+    """
+    Render a solved pattern grid. Every cell shows its pattern's top-left
+    pixel, and the last row and column of cells also draw the rest of their
+    pattern, so a grid of w x h cells gives (w + n - 1) x (h + n - 1) pixels.
+
+    Args:
+        tile_index: 2D array of pattern indices (-1 = uncollapsed)
+        patterns: (T, n, n) array of palette indices
+        palette: (colors, 3) array
+        placeholder: RGB color of uncollapsed cells
+
+    Returns:
+        (height, width, 3) uint8 array
+    """
+    n = patterns.shape[1]
+    rows, cols = tile_index.shape
+
+    ys = np.arange(rows + n - 1)
+    xs = np.arange(cols + n - 1)
+    cell_y = np.minimum(ys, rows - 1)
+    cell_x = np.minimum(xs, cols - 1)
+
+    cells = tile_index[cell_y[:, None], cell_x[None, :]]
+    colors = palette[patterns[np.maximum(cells, 0), (ys - cell_y)[:, None], (xs - cell_x)[None, :]]]
+    colors[cells < 0] = placeholder
+    return colors
+
+
+def generate_overlapping(input_path=DEFAULT_SAMPLE, output_path=None, width=48, height=48, n=3, periodic_input=True,
+                         symmetry=1, scale=4, max_sample_size=MAX_SAMPLE_SIZE, heuristic='shannon',
+                         strategy='backtrack', max_backtracks=1000, max_restarts=5, seed=None, save_steps=False,
+                         steps_dir=None, progress_callback=None, step_every=1, step_min_progress=0,
+                         step_format='png'):
+    """
+    Generate an image that looks like a sample image with the overlapping model.
+
+    Args:
+        input_path: Path of the sample image
+        output_path: Optional path to save the result to
+        width: Width of the result in sample pixels
+        height: Height of the result in sample pixels
+        n: Pattern size (3 is the usual choice)
+        periodic_input: Treat the sample as wrapping around at its edges
+        symmetry: Number of rotated/reflected variants of each pattern (1-8)
+        scale: Integer factor to scale the result (and the snapshots) up by
+        max_sample_size: Largest width/height the sample is reduced to
+        heuristic: Entropy heuristic ('count' or 'shannon')
+        strategy: Contradiction recovery ('stop', 'backtrack' or 'restart')
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+        seed: Seed for the random generator (None = unseeded)
+        save_steps: Whether to save step-by-step snapshots
+        steps_dir: Folder to save the snapshots in
+        progress_callback: Optional function receiving progress updates from collapse_wfc()
+        step_every: With save_steps, save a snapshot at most every this many collapses
+        step_min_progress: With save_steps, only save a snapshot once this many
+                           percent more of the grid is collapsed
+        step_format: With save_steps, 'png' or 'log' (see collapse_wfc())
+
+    Returns:
+        Tuple of (PIL Image of the result, run statistics from collapse_wfc())
+    """
+    import random
+    from classes.wfc_render import upscale
+
+    if width < n or height < n:
+        raise ValueError(f"The output must be at least {n}x{n} pixels")
+
+    sample = load_sample(input_path, max_sample_size)
+    patterns, counts, palette = extract_patterns(sample, n, periodic_input, symmetry)
+    rules = pattern_rules(patterns, len(palette))
+    tiles = pattern_tiles(patterns, counts, palette, pixel_size=scale)
+
+    # The last n - 1 pixels of each row and column come from the last cells' patterns
+    wave = Wave(width - n + 1, height - n + 1, rules, batch_propagation=True)
+    print(f"  Grid: {wave.tiles_x}x{wave.tiles_y} cells, {wave.n_tiles} patterns")
+
+    if save_steps and steps_dir is None and output_path is not None:
+        steps_dir = os.path.join(os.path.dirname(output_path), "steps")
+    result = collapse_wfc(wave, tiles, save_steps=save_steps, tile_size=scale, heuristic=heuristic,
+                          strategy=strategy, max_backtracks=max_backtracks, max_restarts=max_restarts,
+                          rng=random.Random(seed), steps_dir=steps_dir, progress_callback=progress_callback,
+                          step_every=step_every, step_min_progress=step_min_progress, step_format=step_format)
+
+    stats = analyze_entropy(wave)
+    print(f"  Collapsed {stats['collapsed']}/{wave.tiles_x * wave.tiles_y} cells in {result['iterations']} "
+          f"iterations (contradictions: {result['contradictions']})")
+
+    img = Image.fromarray(upscale(render_patterns(wave.tile_index, patterns, palette), scale))
+    if output_path is not None:
+        img.save(output_path)
+        print(f"Saved image to {output_path}")
+    return img, result
+
+
+def setup_overlapping(input_image_path=None, tile_size=16, output_width=160, output_height=160, save_steps=False,
+                      n=3, symmetry=1, heuristic='shannon', strategy='backtrack', max_backtracks=1000,
+                      max_restarts=5, seed=None, use_cache=True, output_dir=None, save_to_gallery=True,
+                      progress_callback=None, step_every=1, step_min_progress=0, step_format='png'):
+    """
+    Run the overlapping model the way setup() runs the tiled one: in its own
+    run folder, with the on-disk cache and a copy in the gallery. Each
+    generated pixel is drawn tile_size // 4 pixels wide, and the image is
+    scaled 2x like the tiled cities, so both models fill the same output size.
+
+    Args:
+        input_image_path: Path of the sample image (defaults to DEFAULT_SAMPLE)
+        tile_size: Tile size of the matching tiled city
+        output_width: Width of the matching tiled city in pixels
+        output_height: Height of the matching tiled city in pixels
+        save_steps: Whether to save step-by-step snapshots
+        n: Pattern size
+        symmetry: Number of rotated/reflected variants of each pattern (1-8)
+        heuristic: Entropy heuristic ('count' or 'shannon')
+        strategy: Contradiction recovery ('stop', 'backtrack' or 'restart')
+        max_backtracks: Number of collapses that may be undone per attempt
+        max_restarts: Number of times the solve may start over
+        seed: Seed for the run
+        use_cache: Reuse a previously generated image for the same seed,
+                   sample and settings (not used with save_steps)
+        output_dir: Folder for output.png and steps/ (defaults to a new run folder)
+        save_to_gallery: Whether to also save a copy to the gallery
+        progress_callback: Optional function receiving progress updates from collapse_wfc()
+        step_every: With save_steps, save a snapshot at most every this many collapses
+        step_min_progress: With save_steps, only save a snapshot once this many
+                           percent more of the grid is collapsed
+        step_format: With save_steps, 'png' or 'log' (see collapse_wfc())
+
+    Returns:
+        Path to the generated output image
+    """
+    import hashlib
+    import shutil
+    from datetime import datetime
+
+    if input_image_path is None:
+        input_image_path = DEFAULT_SAMPLE
+
+    pixel_size = max(1, tile_size // 4)
+    width = output_width // pixel_size
+    height = output_height // pixel_size
+    print(f"Overlapping model: {n}x{n} patterns of {input_image_path}, {width}x{height} pixels")
+
+    run_dir = None
+    if output_dir is None:
+        from classes.wfc_runs import RUNS_DIR, evict_outputs, finish_run, new_run_dir
+
+        evict_outputs(RUNS_DIR)
+        output_dir = run_dir = new_run_dir(seed)
+
+    # The run folder stays marked as running (safe from eviction) until the image is written
+    try:
+        output_path = os.path.join(output_dir, "output.png")
+        os.makedirs(output_dir, exist_ok=True)
+
+        key = None
+        if use_cache and not save_steps:
+            from classes.wfc_cache import cache_key, get_cached
+
+            with open(input_image_path, 'rb') as f:
+                sample_digest = hashlib.sha256(f.read()).hexdigest()[:16]
+            key = cache_key(seed, sample_digest, [], width, height, pixel_size, model='overlapping', n=n,
+                            symmetry=symmetry, heuristic=heuristic, strategy=strategy,
+                            max_backtracks=max_backtracks, max_restarts=max_restarts)
+            cached_path = get_cached(key)
+            if cached_path is not None:
+                shutil.copyfile(cached_path, output_path)
+                print(f"Loaded cached image from {cached_path}")
+                return output_path
+
+        generate_overlapping(input_image_path, output_path, width, height, n=n, symmetry=symmetry,
+                             scale=2 * pixel_size, heuristic=heuristic, strategy=strategy,
+                             max_backtracks=max_backtracks, max_restarts=max_restarts, seed=seed,
+                             save_steps=save_steps, steps_dir=os.path.join(output_dir, "steps"),
+                             progress_callback=progress_callback, step_every=step_every,
+                             step_min_progress=step_min_progress, step_format=step_format)
+
+        if key is not None:
+            from classes.wfc_cache import store
+            store(key, output_path)
+
+        if save_to_gallery:
+            gallery_dir = "static/images/gallery"
+            os.makedirs(gallery_dir, exist_ok=True)
+            gallery_path = os.path.join(gallery_dir, f"overlap_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png")
+            shutil.copyfile(output_path, gallery_path)
+            print(f"Saved copy to gallery: {gallery_path}")
+
+        return output_path
+    finally:
+        if run_dir is not None:
+            finish_run(run_dir)
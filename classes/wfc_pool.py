@@ -0,0 +1,221 @@
+"""
+Pre-warmed pool of generated WFC cities
+
+A background thread keeps a bounded queue of finished cities, each with its
+step-by-step snapshots, in its own folder. The web page pops the next ready
+city instead of solving one while the visitor waits; taking a city frees a
+slot in the queue, which lets the producer start on the next one.
+"""
+
+from collections import deque
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+
+from classes.tilesets import load_tileset
+from classes.wfc import setup
+from classes.wfc_runs import finish_run, new_run_dir
+from classes.wfc_steplog import LOG_NAME, read_step_log
+
+
+# Seconds a served city stays on disk (the page loads its files right after)
+SERVED_MAX_AGE = 10 * 60
+
+# city.json is renamed to this once the city is handed out
+SERVED_NAME = "served.json"
+
+
+class CityPool:
+    """
+    Bounded queue of ready-made cities filled by a background thread.
+
+    Every city lives in a folder of its own under pool_dir (named after the
+    time, seed and tileset, see new_run_dir()) with output.png, steps/ and
+    city.json. Cities that were already handed out are kept on disk for
+    keep_served seconds (the page still loads their snapshots and image)
+    and then deleted.
+    """
+
+    def __init__(self, pool_dir="static/images/WFC/pool", size=4, keep_served=SERVED_MAX_AGE, **city_settings):
+        """
+        Args:
+            pool_dir: Folder that holds the generated cities
+            size: Number of ready cities to keep queued
+            keep_served: Seconds a handed out city is kept on disk
+            **city_settings: Extra keyword arguments for setup()
+                             (tile_size, output_width, output_height, ...)
+        """
+        self.pool_dir = pool_dir
+        self.city_settings = city_settings
+        self.ready = queue.Queue(maxsize=size)
+        self.served = deque()
+        self.keep_served = keep_served
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Queue any finished cities left over from a previous run that were
+        not handed out yet, and start the background producer. Calling
+        start() again does nothing.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            os.makedirs(self.pool_dir, exist_ok=True)
+            served = []
+            for name in sorted(os.listdir(self.pool_dir)):
+                city_dir = os.path.join(self.pool_dir, name)
+                info_path = os.path.join(city_dir, "city.json")
+                served_path = os.path.join(city_dir, SERVED_NAME)
+
+                if os.path.exists(info_path) and not self.ready.full():
+                    with open(info_path) as f:
+                        self.ready.put(json.load(f))
+                elif os.path.exists(served_path):
+                    # Handed out before the restart, deleted once old enough
+                    served.append((os.path.getmtime(served_path), city_dir))
+                else:
+                    # Unfinished or surplus city
+                    shutil.rmtree(city_dir, ignore_errors=True)
+            self.served.extend(sorted(served))
+
+            print(f"City pool: {self.ready.qsize()} cities ready in {self.pool_dir}")
+
+            self._thread = threading.Thread(target=self._run, name="wfc-city-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background producer after the city it is working on."""
+        self._stop.set()
+
+    def _run(self):
+        """Producer loop: generate cities until stopped, waiting while the queue is full."""
+        while not self._stop.is_set():
+            try:
+                city = self.generate()
+            except Exception as e:
+                print(f"City pool: error generating city: {e}")
+                self._stop.wait(1)
+                continue
+
+            # Blocks while the queue is full, until get() frees a slot
+            while not self._stop.is_set():
+                try:
+                    self.ready.put(city, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def generate(self, seed=None, tileset=None):
+        """
+        Generate one city into the pool folder.
+
+        The city is built in a new folder of its own; its city.json is
+        written last, so a half-written city is never queued on startup.
+
+        Args:
+            seed: Seed of the city (random if None)
+            tileset: Optional tileset package to use instead of the pool's
+                     own tile settings
+
+        Returns:
+            Dictionary with the city's 'seed', 'tileset', 'tile_size',
+            'dir', 'image' and 'steps'
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+
+        settings = dict(self.city_settings)
+        if tileset is not None:
+            settings['tileset'] = tileset
+        tileset = settings.get('tileset')
+        if tileset is not None:
+            tile_size = load_tileset(tileset)[2]
+        else:
+            tile_size = settings.get('tile_size', 16)
+
+        # Every generation gets a folder of its own, so requests for the same
+        # seed never delete each other's files
+        city_dir = new_run_dir(seed if tileset is None else f"{tileset}_{seed}", self.pool_dir)
+
+        try:
+            # With 'log' steps the city and its step log come from the cache when
+            # the seed was generated before (e.g. a shared or bookmarked city)
+            setup(save_steps=True, seed=seed, use_cache=True, output_dir=city_dir, save_to_gallery=False,
+                  **settings)
+
+            # Steps are either one binary log or one PNG per step
+            steps_dir = os.path.join(city_dir, "steps")
+            if os.path.exists(os.path.join(steps_dir, LOG_NAME)):
+                steps = read_step_log(os.path.join(steps_dir, LOG_NAME))[0]['steps']
+            else:
+                steps = len(os.listdir(steps_dir))
+
+            city = {
+                'seed': seed,
+                'tileset': tileset,
+                'tile_size': tile_size,
+                'dir': city_dir,
+                'image': os.path.join(city_dir, "output.png"),
+                'steps': steps
+            }
+
+            # city.json is written last (and atomically), it marks the city as complete
+            info_path = os.path.join(city_dir, "city.json")
+            with open(f"{info_path}.tmp", "w") as f:
+                json.dump(city, f, indent=2)
+            os.replace(f"{info_path}.tmp", info_path)
+        except BaseException:
+            # Don't leave a folder behind for every failed attempt
+            shutil.rmtree(city_dir, ignore_errors=True)
+            raise
+        finish_run(city_dir)
+        return city
+
+    def get(self, seed=None, tileset=None):
+        """
+        Take the next ready city. If the pool is empty (e.g. right after
+        startup or during a burst of requests) a city is generated on the
+        spot instead.
+
+        Args:
+            seed: Generate this specific city now instead of taking a queued one
+            tileset: Generate a city of this tileset package now instead of
+                     taking a queued one
+
+        Returns:
+            Dictionary with the city's 'seed', 'tileset', 'tile_size', 'dir',
+            'image' and 'steps'
+        """
+        if seed is not None or tileset is not None:
+            city = self.generate(seed, tileset)
+        else:
+            try:
+                city = self.ready.get_nowait()
+            except queue.Empty:
+                print("City pool: empty, generating a city now")
+                city = self.generate()
+
+        # Mark the city as served, so it is not queued again after a restart
+        try:
+            os.replace(os.path.join(city['dir'], "city.json"), os.path.join(city['dir'], SERVED_NAME))
+        except OSError:
+            pass
+
+        # Delete cities that were handed out long enough ago; by age, not count,
+        # so a burst of requests never removes files a page is still loading
+        now = time.time()
+        with self._lock:
+            self.served.append((now, city['dir']))
+            while self.served and now - self.served[0][0] > self.keep_served:
+                shutil.rmtree(self.served.popleft()[1], ignore_errors=True)
+
+        return city
@@ -0,0 +1,130 @@
+"""
+Process-wide cache of loaded tilesets
+
+Loading a tileset means opening and decoding every tile PNG and building
+the adjacency rules, which used to happen on every request. The registry
+does it once per process and hands out the same tiles and compiled rules
+until TILE_CONFIGS or one of the tile files changes.
+
+The cached tiles are shared, so callers must not modify them.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+from PIL import Image
+
+from classes.wfc import (
+    TILE_CONFIGS,
+    compile_adjacency_rules,
+    load_tiles_from_config,
+    setup_adjacency_rules_from_connections,
+)
+
+
+_lock = threading.Lock()
+_tilesets = {}  # config fingerprint -> cached tileset
+_images = {}    # path -> (mtime, decoded image)
+
+
+def _file_stamp(path):
+    """Modification time of a file, or None if it is missing."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _watched_paths(tiles):
+    """
+    Files whose changes invalidate a tileset: every tile image plus the
+    folders holding them (so a tile file that was missing and is added
+    later is noticed too).
+    """
+    paths = [tile['path'] for tile in tiles]
+    return paths + sorted({os.path.dirname(path) for path in paths})
+
+
+def config_fingerprint(tile_configs):
+    """
+    Hash of a tile configuration dictionary, so edits to it are noticed.
+
+    Args:
+        tile_configs: Tile configuration dictionary
+
+    Returns:
+        Hex digest of the configuration
+    """
+    payload = json.dumps(tile_configs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_tileset(tile_configs=TILE_CONFIGS):
+    """
+    Get the tiles, adjacency rules and compiled rules of a tileset, loading
+    them only if they are not cached yet or something changed since.
+
+    Args:
+        tile_configs: Tile configuration dictionary
+
+    Returns:
+        Tuple of (tiles, adjacency, rules) as returned by
+        load_tiles_from_config(), setup_adjacency_rules_from_connections()
+        and compile_adjacency_rules()
+    """
+    key = config_fingerprint(tile_configs)
+
+    with _lock:
+        cached = _tilesets.get(key)
+        if cached is not None:
+            # One stat per tile file: reload if any of them changed
+            stamps = [_file_stamp(path) for path in cached['stamps']]
+            if stamps == list(cached['stamps'].values()):
+                return cached['tiles'], cached['adjacency'], cached['rules']
+            print("Tile files changed, reloading tileset")
+
+        tiles = load_tiles_from_config(tile_configs)
+        adjacency = setup_adjacency_rules_from_connections(tiles)
+        rules = compile_adjacency_rules(adjacency, len(tiles))
+
+        _tilesets[key] = {
+            'tiles': tiles,
+            'adjacency': adjacency,
+            'rules': rules,
+            'stamps': {path: _file_stamp(path) for path in _watched_paths(tiles)}
+        }
+        return tiles, adjacency, rules
+
+
+def load_tile_image(path):
+    """
+    Open and decode an image once, reusing it until the file changes.
+
+    Args:
+        path: Path of the image
+
+    Returns:
+        Decoded PIL Image (shared, do not modify)
+    """
+    stamp = _file_stamp(path)
+
+    with _lock:
+        cached = _images.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+    img = Image.open(path)
+    img.load()
+
+    with _lock:
+        _images[path] = (stamp, img)
+    return img
+
+
+def clear():
+    """Forget every cached tileset and image."""
+    with _lock:
+        _tilesets.clear()
+        _images.clear()
@@ -0,0 +1,290 @@
+"""
+NumPy rendering of WFC tile grids
+
+All tile images are packed into one atlas array when it is first needed,
+together with a placeholder square for uncollapsed cells and a white square
+for empty ones. A whole frame is then a single fancy-indexing gather from
+the tile-index grid. Integer upscaling is done once per tile on the atlas
+(np.repeat + a zero-stride broadcast), so scaled frames are gathered
+directly and the cost no longer depends on a Python loop over the cells.
+"""
+
+from collections import OrderedDict
+from PIL import Image
+import numpy as np
+
+
+PLACEHOLDER_COLOR = (200, 200, 200)
+BACKGROUND_COLOR = (255, 255, 255)
+
+# Atlases of recently used tilesets, see get_tile_atlas()
+_atlas_cache = OrderedDict()
+_ATLAS_CACHE_SIZE = 8
+
+
+class TileAtlas:
+    """
+    Every tile of a tileset as one (n_tiles + 2, tile_size, tile_size, 4)
+    uint8 array. Entry n_tiles is the placeholder for uncollapsed cells and
+    entry n_tiles + 1 is the plain background.
+
+    Pixels are stored as RGBX (the fourth byte is padding) because that is
+    Pillow's own in-memory layout, so turning a rendered frame into an Image
+    is a plain copy instead of a per-pixel unpack.
+    """
+
+    def __init__(self, tiles, tile_size, placeholder=PLACEHOLDER_COLOR, background=BACKGROUND_COLOR):
+        """
+        Args:
+            tiles: List of tile dictionaries
+            tile_size: Size of each tile in pixels
+            placeholder: RGB color of uncollapsed cells
+            background: RGB color of cells without a tile
+        """
+        self.n_tiles = len(tiles)
+        self.tile_size = tile_size
+        self.placeholder_index = self.n_tiles
+        self.background_index = self.n_tiles + 1
+
+        self.atlas = np.full((self.n_tiles + 2, tile_size, tile_size, 4), 255, dtype=np.uint8)
+        for i, tile in enumerate(tiles):
+            # Same result as pasting the tile onto a white tile_size square
+            cell = Image.new('RGB', (tile_size, tile_size), color=background)
+            cell.paste(tile['image'].convert('RGB'), (0, 0))
+            self.atlas[i, :, :, :3] = np.asarray(cell)
+        self.atlas[self.placeholder_index, :, :, :3] = placeholder
+        self.atlas[self.background_index, :, :, :3] = background
+
+        # Atlases with every tile already upscaled, by scale factor
+        self._scaled = {1: self.atlas}
+
+    @classmethod
+    def from_array(cls, atlas):
+        """
+        Wrap an atlas array that was built before, e.g. one stored in a
+        compiled tileset bundle.
+
+        Args:
+            atlas: (n_tiles + 2, tile_size, tile_size, 4) uint8 array
+
+        Returns:
+            TileAtlas
+        """
+        self = cls.__new__(cls)
+        self.n_tiles = atlas.shape[0] - 2
+        self.tile_size = atlas.shape[1]
+        self.placeholder_index = self.n_tiles
+        self.background_index = self.n_tiles + 1
+        self.atlas = atlas
+        self._scaled = {1: atlas}
+        return self
+
+    def scaled(self, scale):
+        """
+        Get the atlas with every tile upscaled by an integer factor, so
+        scaled frames are gathered directly instead of upscaled afterwards.
+
+        Args:
+            scale: Integer scale factor
+
+        Returns:
+            (n_tiles + 2, tile_size * scale, tile_size * scale, 4) uint8 array
+        """
+        if scale not in self._scaled:
+            self._scaled[scale] = np.stack([upscale(cell, scale) for cell in self.atlas])
+        return self._scaled[scale]
+
+    def sheet(self):
+        """
+        The atlas as one image strip, tile i at x = i * tile_size (the
+        placeholder and the background come after the last tile). Used by
+        the page that replays step logs.
+
+        Returns:
+            PIL Image of (n_tiles + 2) * tile_size x tile_size pixels
+        """
+        strip = np.ascontiguousarray(self.atlas[:, :, :, :3].transpose(1, 0, 2, 3))
+        return Image.fromarray(strip.reshape(self.tile_size, -1, 3))
+
+    def cell_indices(self, tile_indices, placeholder=True):
+        """
+        Map a tile-index grid (-1 = uncollapsed) to atlas entries.
+
+        Args:
+            tile_indices: 2D array of tile indices
+            placeholder: Show uncollapsed cells as the placeholder
+                         (False shows them as background)
+
+        Returns:
+            2D array of atlas indices
+        """
+        empty = self.placeholder_index if placeholder else self.background_index
+        return np.where(tile_indices >= 0, tile_indices, empty)
+
+    def _render_rgbx(self, tile_indices, scale, placeholder):
+        """Gather a frame as a contiguous (height, width, 4) RGBX array."""
+        height, width = tile_indices.shape
+        size = self.tile_size * scale
+
+        # (rows, cols, size, size, 4) -> (rows * size, cols * size, 4)
+        cells = self.scaled(scale)[self.cell_indices(tile_indices, placeholder)]
+        return cells.transpose(0, 2, 1, 3, 4).reshape(height * size, width * size, 4)
+
+    def render_array(self, tile_indices, scale=1, placeholder=True):
+        """
+        Render a tile-index grid to an RGB array.
+
+        Args:
+            tile_indices: 2D array of tile indices (-1 = uncollapsed)
+            scale: Integer factor to scale the image up by
+            placeholder: Show uncollapsed cells as the placeholder
+
+        Returns:
+            (height, width, 3) uint8 array
+        """
+        return self._render_rgbx(tile_indices, scale, placeholder)[..., :3]
+
+    def render(self, tile_indices, scale=1, placeholder=True):
+        """
+        Render a tile-index grid to a PIL image.
+
+        Args:
+            tile_indices: 2D array of tile indices (-1 = uncollapsed)
+            scale: Integer factor to scale the image up by
+            placeholder: Show uncollapsed cells as the placeholder
+
+        Returns:
+            PIL Image of the grid
+        """
+        frame = self._render_rgbx(tile_indices, scale, placeholder)
+        height, width = frame.shape[:2]
+        return Image.frombytes('RGB', (width, height), frame, 'raw', 'RGBX')
+
+
+def upscale(frame, scale):
+    """
+    Nearest-neighbor integer upscale of an image array.
+
+    Args:
+        frame: (height, width, channels) array
+        scale: Integer scale factor
+
+    Returns:
+        (height * scale, width * scale, channels) array
+    """
+    if scale == 1:
+        return frame
+
+    height, width, channels = frame.shape
+    # Repeat the pixels of each row, then repeat whole rows through a
+    # zero-stride view so they are copied as contiguous blocks
+    rows = np.repeat(frame, scale, axis=1)
+    view = np.broadcast_to(rows[:, None], (height, scale, width * scale, channels))
+    return view.reshape(height * scale, width * scale, channels)
+
+
+def cache_tile_atlas(tiles, atlas, placeholder=PLACEHOLDER_COLOR):
+    """
+    Make get_tile_atlas() return an existing atlas for a tiles list.
+
+    Args:
+        tiles: List of tile dictionaries
+        atlas: TileAtlas of those tiles
+        placeholder: RGB color of uncollapsed cells used in the atlas
+    """
+    _atlas_cache[(id(tiles), atlas.tile_size, tuple(placeholder))] = (tiles, atlas)
+    if len(_atlas_cache) > _ATLAS_CACHE_SIZE:
+        _atlas_cache.popitem(last=False)
+
+
+def get_tile_atlas(tiles, tile_size, placeholder=PLACEHOLDER_COLOR):
+    """
+    Get the atlas of a tileset, building it the first time it is used.
+
+    Args:
+        tiles: List of tile dictionaries
+        tile_size: Size of each tile in pixels
+        placeholder: RGB color of uncollapsed cells
+
+    Returns:
+        TileAtlas
+    """
+    key = (id(tiles), tile_size, tuple(placeholder))
+    cached = _atlas_cache.get(key)
+
+    # The tiles list is kept in the entry, so a matching id is the same list
+    if cached is not None and cached[0] is tiles and len(tiles) == cached[1].n_tiles:
+        _atlas_cache.move_to_end(key)
+        return cached[1]
+
+    atlas = TileAtlas(tiles, tile_size, placeholder)
+    _atlas_cache[key] = (tiles, atlas)
+    if len(_atlas_cache) > _ATLAS_CACHE_SIZE:
+        _atlas_cache.popitem(last=False)
+    return atlas
+
+
+class FrameBuffer:
+    """
+    A persistent rendered frame of a grid. Each update() only redraws the
+    cells whose tile changed since the previous one, so recording a frame
+    per step does not re-render the whole grid every time.
+    """
+
+    def __init__(self, atlas, tiles_x, tiles_y, scale=1, placeholder=True):
+        """
+        Args:
+            atlas: TileAtlas of the tileset
+            tiles_x: Width of grid
+            tiles_y: Height of grid
+            scale: Integer factor to scale the frame up by
+            placeholder: Show uncollapsed cells as the placeholder
+        """
+        self.atlas = atlas
+        self.scale = scale
+        self.placeholder = placeholder
+        self.cell_size = atlas.tile_size * scale
+        self.tile_index = np.full((tiles_y, tiles_x), -1, dtype=np.int32)
+        self.frame = atlas._render_rgbx(self.tile_index, scale, placeholder)
+
+    def update(self, tile_indices):
+        """
+        Redraw the cells that changed.
+
+        Args:
+            tile_indices: Current 2D array of tile indices (-1 = uncollapsed)
+
+        Returns:
+            Number of cells redrawn
+        """
+        ys, xs = np.nonzero(tile_indices != self.tile_index)
+        if len(ys) == 0:
+            return 0
+
+        changed = tile_indices[ys, xs]
+        cells = self.atlas.scaled(self.scale)[self.atlas.cell_indices(changed, self.placeholder)]
+
+        # View the frame as (rows, cell y, cols, cell x, 4) and write the changed cells in place
+        tiles_y, tiles_x = self.tile_index.shape
+        size = self.cell_size
+        self.frame.reshape(tiles_y, size, tiles_x, size, 4)[ys, :, xs] = cells
+
+        self.tile_index[ys, xs] = changed
+        return len(ys)
+
+    def image(self):
+        """
+        Returns:
+            PIL Image of the current frame
+        """
+        height, width = self.frame.shape[:2]
+        return Image.frombytes('RGB', (width, height), self.frame, 'raw', 'RGBX')
+
+    def save(self, output_path):
+        """
+        Save the current frame.
+
+        Args:
+            output_path: Path to save the frame
+        """
+        self.image().save(output_path)
@@ -0,0 +1,153 @@
+"""
+Per-run output folders for WFC and cleanup of old outputs
+
+Every run writes its image and step snapshots to a folder of its own, so
+concurrent requests (or several server processes) never overwrite each
+other's files. Old run folders are evicted by age, count and total size;
+a folder is marked as running until its run finishes, so a long solve is
+never evicted while it is still writing.
+"""
+
+import os
+import shutil
+import time
+import uuid
+
+
+RUNS_DIR = "static/images/WFC/runs"
+
+# Default limits for evict_outputs()
+MAX_AGE = 60 * 60            # 1 hour
+MAX_ENTRIES = 50
+MAX_BYTES = 200 * 1024 * 1024
+MIN_AGE = 60                 # never touch anything newer, it may still be in use
+
+# Marker file inside a run folder while its run is still writing
+RUNNING_NAME = ".running"
+
+
+def new_run_dir(seed=None, runs_dir=RUNS_DIR):
+    """
+    Create a unique folder for one run, marked as running until
+    finish_run() is called for it.
+
+    Args:
+        seed: Seed of the run, used to make the folder name readable
+        runs_dir: Parent folder of all runs
+
+    Returns:
+        Path to the new folder
+    """
+    name = time.strftime("%Y%m%d_%H%M%S")
+    if seed is not None:
+        name += f"_{seed}"
+    name += f"_{uuid.uuid4().hex[:8]}"
+
+    run_dir = os.path.join(runs_dir, name)
+    os.makedirs(run_dir)
+    open(os.path.join(run_dir, RUNNING_NAME), "w").close()
+    return run_dir
+
+
+def finish_run(run_dir):
+    """
+    Mark a run folder from new_run_dir() as finished, so evict_outputs()
+    may delete it once it is old enough.
+
+    Args:
+        run_dir: Path of the run folder
+    """
+    try:
+        os.remove(os.path.join(run_dir, RUNNING_NAME))
+    except OSError:
+        pass
+
+
+def _is_running(path, now, max_age):
+    """Whether a folder is marked as running (markers older than max_age are left by crashed runs)."""
+    try:
+        started = os.path.getmtime(os.path.join(path, RUNNING_NAME))
+    except OSError:
+        return False
+    return max_age is None or now - started <= max_age
+
+
+def _entry_size(path):
+    """Size in bytes of a file, or of all files inside a folder."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def evict_outputs(folder, max_age=MAX_AGE, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, min_age=MIN_AGE):
+    """
+    Delete the oldest files/folders directly inside a folder until it is
+    within the limits. Entries modified less than min_age seconds ago are
+    always kept, since another request may still be serving them, and so are
+    run folders that are still marked as running (see new_run_dir()).
+
+    Args:
+        folder: Folder to clean up
+        max_age: Delete entries older than this many seconds (None = no limit)
+        max_entries: Keep at most this many entries (None = no limit)
+        max_bytes: Keep the total size below this many bytes (None = no limit)
+        min_age: Seconds an entry is protected after its last change
+
+    Returns:
+        Number of entries deleted
+    """
+    if not os.path.isdir(folder):
+        return 0
+
+    now = time.time()
+    entries = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            entries.append((os.path.getmtime(path), path, _entry_size(path)))
+        except OSError:
+            # Deleted by someone else in the meantime
+            pass
+
+    # Oldest first
+    entries.sort()
+    count = len(entries)
+    total_bytes = sum(size for _, _, size in entries)
+    deleted = 0
+
+    for mtime, path, size in entries:
+        age = now - mtime
+        if age < min_age:
+            break
+        if os.path.isdir(path) and _is_running(path, now, max_age):
+            continue
+
+        too_old = max_age is not None and age > max_age
+        too_many = max_entries is not None and count > max_entries
+        too_big = max_bytes is not None and total_bytes > max_bytes
+        if not (too_old or too_many or too_big):
+            break
+
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        count -= 1
+        total_bytes -= size
+        deleted += 1
+
+    if deleted:
+        print(f"Evicted {deleted} old outputs from {folder}")
+    return deleted
@@ -0,0 +1,138 @@
+"""
+Compact binary log of the steps of a WFC solve
+
+Instead of one PNG per step, a solve can be recorded as a single file of
+(step, x, y, tile) events: every time a cell gets a tile (or loses it again
+when backtracking) one 10 byte record is written. Together with the tile
+atlas image, the page replays the log on a canvas.
+
+File layout (little endian):
+    header: b"WFCL", version (uint8), tiles_x, tiles_y, n_tiles (uint16)
+    records: step (uint32), x (uint16), y (uint16), tile (int16, -1 = cleared)
+"""
+
+import struct
+import numpy as np
+
+
+MAGIC = b"WFCL"
+VERSION = 1
+HEADER = struct.Struct("<4sBHHH")
+RECORD_DTYPE = np.dtype([('step', '<u4'), ('x', '<u2'), ('y', '<u2'), ('tile', '<i2')])
+
+LOG_NAME = "steps.wfclog"
+ATLAS_NAME = "atlas.png"
+
+
+class StepLog:
+    """
+    Writer for a step log. The tiles the log has written so far are kept,
+    so each record() only writes the cells that really changed.
+    """
+
+    def __init__(self, path, tiles_x, tiles_y, n_tiles):
+        """
+        Args:
+            path: Path of the log file to create
+            tiles_x: Width of grid
+            tiles_y: Height of grid
+            n_tiles: Number of tiles in the tileset
+        """
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, tiles_x, tiles_y, n_tiles))
+        self.tile_index = np.full((tiles_y, tiles_x), -1, dtype=np.int16)
+        self.steps = 0
+
+    def record(self, tile_indices, cells=None):
+        """
+        Write one step: every cell whose tile differs from the log's state.
+        Nothing is written (and no step is counted) if no tile changed.
+
+        Args:
+            tile_indices: Current 2D array of tile indices (-1 = uncollapsed)
+            cells: Optional list of (x, y) cells that may have changed; only
+                   these are compared (None compares the whole grid)
+
+        Returns:
+            Number of events written
+        """
+        if cells is None:
+            ys, xs = np.nonzero(tile_indices != self.tile_index)
+        else:
+            coords = np.array(cells, dtype=np.intp).reshape(-1, 2)
+            xs, ys = coords[:, 0], coords[:, 1]
+            differs = tile_indices[ys, xs] != self.tile_index[ys, xs]
+            xs, ys = xs[differs], ys[differs]
+            if len(xs) > 1:
+                # A cell can be listed more than once
+                flat = np.unique(ys * tile_indices.shape[1] + xs)
+                ys, xs = np.divmod(flat, tile_indices.shape[1])
+
+        if len(xs) == 0:
+            return 0
+
+        self.steps += 1
+        records = np.empty(len(xs), dtype=RECORD_DTYPE)
+        records['step'] = self.steps
+        records['x'] = xs
+        records['y'] = ys
+        records['tile'] = tile_indices[ys, xs]
+        self.file.write(records.tobytes())
+
+        self.tile_index[ys, xs] = records['tile']
+        return len(xs)
+
+    def close(self):
+        """Finish writing the log (closing it again does nothing)."""
+        self.file.close()
+
+
+def read_step_log(path):
+    """
+    Read a step log.
+
+    Args:
+        path: Path of the log file
+
+    Returns:
+        Tuple of (header dictionary, structured array of records)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, tiles_x, tiles_y, n_tiles = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} WFC step log")
+
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, offset=HEADER.size)
+    header = {
+        'tiles_x': tiles_x,
+        'tiles_y': tiles_y,
+        'n_tiles': n_tiles,
+        'steps': int(records['step'][-1]) if len(records) else 0
+    }
+    return header, records
+
+
+def replay_step_log(path, step=None):
+    """
+    Rebuild the tile grid of a logged solve at some step.
+
+    Args:
+        path: Path of the log file
+        step: Step to stop at (None = the end of the solve)
+
+    Returns:
+        2D array of tile indices (-1 = uncollapsed)
+    """
+    header, records = read_step_log(path)
+    if step is not None:
+        records = records[records['step'] <= step]
+
+    tile_index = np.full((header['tiles_y'], header['tiles_x']), -1, dtype=np.int32)
+    # A cell can be logged many times (backtracking), its last record wins;
+    # np.unique on the reversed records finds each cell's last one
+    flat = records['y'].astype(np.intp) * header['tiles_x'] + records['x']
+    cells, last = np.unique(flat[::-1], return_index=True)
+    tile_index.flat[cells] = records['tile'][len(records) - 1 - last]
+    return tile_index
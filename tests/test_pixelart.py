@@ -0,0 +1,55 @@
+import io
+import math
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from classes import pixelart
+from classes.ingest import open_upload
+
+
+def brute_force_block_mean(pixels, pixel_size):
+    height, width = pixels.shape[:2]
+    blocks = np.empty((math.ceil(height / pixel_size), math.ceil(width / pixel_size), 3))
+    for by in range(blocks.shape[0]):
+        for bx in range(blocks.shape[1]):
+            block = pixels[by * pixel_size:(by + 1) * pixel_size, bx * pixel_size:(bx + 1) * pixel_size]
+            blocks[by, bx] = block.reshape(-1, 3).mean(axis=0)
+    return blocks
+
+
+@pytest.mark.parametrize("size, pixel_size", [
+    ((103, 77), 8),
+    ((250, 131), 8),
+    ((250, 131), 7),
+    ((64, 48), 16),
+    ((97, 61), 10),
+    ((5, 3), 8),
+])
+def test_png_block_mean_matches_brute_force(size, pixel_size):
+    pixels = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    upload = io.BytesIO()
+    Image.fromarray(pixels).save(upload, format='PNG')
+    upload.seek(0)
+
+    # Decoded the way pixelate() decodes uploads
+    scale = math.gcd(pixel_size, 8)
+    img, full_size = open_upload(
+        upload, lambda width, height: (math.ceil(width / scale), math.ceil(height / scale)), 'RGB', reduce=False)
+    blocks = pixelart.block_mean(img, full_size, pixel_size)
+
+    expected = brute_force_block_mean(pixels.astype(np.float64), pixel_size)
+    assert blocks.shape == expected.shape
+    # Image.reduce() rounds in fixed point, so one level of difference is allowed
+    assert np.abs(blocks - expected).max() <= 1
+
+
+def test_pixelate_keeps_the_upload_size():
+    upload = io.BytesIO()
+    Image.new('RGB', (103, 77), (200, 30, 60)).save(upload, format='PNG')
+    upload.seek(0)
+
+    result = pixelart.pixelate(upload, 8, palette='pico-8')
+    assert result.size == (103, 77)
+    assert result.mode == 'P'